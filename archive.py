@@ -0,0 +1,344 @@
+import array
+import bisect
+import collections
+import concurrent.futures
+import csv
+import itertools
+import json
+import logging
+import mmap
+import os
+import sys
+import time
+import urllib.parse
+
+from next_bus import (ARCHIVE_MAX_AGE, BATCH_CHUNK, DECODE_ERRORS, DEFAULT_HOST, DIR_PATH, RECORDS,
+                      ROUTE_PATH, STOP_PATH, TIME_PATH, Catalog, Departure, Direction, Route, Stop,
+                      decode_rows, departures_from, match_first, recompute_realtime)
+
+METADATA_FILE='metadata.tsv'
+DEPARTURES_FILE='departures.tsv'
+RESPONSES_FILE='responses.log'
+SERVICE_PREFIX='/NexTrip/'
+INDEX_FILE='departures.index'
+INDEX_VERSION=2
+RESOLVED_MAX_ENTRIES=100000
+
+worker_archive = None
+worker_host = None
+
+
+class Archive(object):
+    # NexTrip responses kept in a directory. metadata.tsv holds the routes,
+    # directions and stops in the catalog format; departures.tsv is an
+    # append-only log with a `fetched (ms), url, rows` line per departures
+    # response. Each URL's fetch times and line offsets are indexed in
+    # departures.index (a JSON header line, then the raw int64 arrays), which
+    # is extended as the log grows, and lines are read straight from a memory
+    # map of the log.
+
+    def __init__(self, path, max_age=ARCHIVE_MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        self.metadata = Catalog(os.path.join(path, METADATA_FILE))
+        self.index = None
+        self.log = None
+        self.resolved = {}
+
+    def append(self, url, fetched, times):
+        os.makedirs(self.path, exist_ok=True)
+        rows = json.dumps([list(t) for t in times], separators=(',', ':'))
+        line = '{}\t{}\t{}\n'.format(int(fetched), url, rows).encode('utf-8')
+        fd = os.open(os.path.join(self.path, DEPARTURES_FILE), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    def load_index(self):
+        # Returns {url: (fetch times, line offsets)}, both sorted by time.
+        log_path = os.path.join(self.path, DEPARTURES_FILE)
+        index_path = os.path.join(self.path, INDEX_FILE)
+        size = os.path.getsize(log_path) if os.path.exists(log_path) else 0
+
+        try:
+            with open(index_path, 'rb') as f:
+                indexed, urls = decode_index(f.read())
+            if indexed > size:
+                indexed, urls = 0, {}
+        except Exception:
+            # Archives get copied around; a missing, corrupt or foreign
+            # index is just rebuilt from the log.
+            indexed, urls = 0, {}
+
+        if indexed == size:
+            return urls
+
+        with open(log_path, 'rb') as f:
+            f.seek(indexed)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break  # still being written
+                fetched, url, _ = line.split(b'\t', 2)
+                times, offsets = urls.setdefault(url.decode('utf-8'), (array.array('q'), array.array('q')))
+                at = bisect.bisect_right(times, int(fetched))
+                times.insert(at, int(fetched))
+                offsets.insert(at, indexed)
+                indexed += len(line)
+
+        try:
+            with open(index_path + '.partial', 'wb') as f:
+                f.write(encode_index(indexed, urls))
+            os.replace(index_path + '.partial', index_path)
+        except OSError as e:
+            logging.warning('WARNING: Could not save archive index: {}'.format(e))
+        return urls
+
+    def open(self):
+        self.index = self.load_index()
+        self.log = b''
+        log_path = os.path.join(self.path, DEPARTURES_FILE)
+        if os.path.exists(log_path) and os.path.getsize(log_path):
+            with open(log_path, 'rb') as f:
+                self.log = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def departures_at(self, url, date_time):
+        # The last departures recorded for `url` at or before `date_time`,
+        # if recorded within max_age seconds of it.
+        if self.index is None:
+            self.open()
+
+        found = self.index.get(url)
+        if found is None:
+            return None
+
+        times, offsets = found
+        at = bisect.bisect_right(times, date_time) - 1
+        if at < 0 or date_time - times[at] > self.max_age * 1000:
+            return None
+
+        start = offsets[at]
+        line = self.log[start:self.log.find(b'\n', start)]
+        return decode_rows(line.split(b'\t', 2)[2], Departure)
+
+    def resolve(self, host, route, stop, direction):
+        key = (route.lower(), stop.lower(), direction.lower())
+        if key not in self.resolved:
+            if len(self.resolved) >= RESOLVED_MAX_ENTRIES:
+                self.resolved.clear()
+            self.resolved[key] = self.lookup(host, route, stop, direction)
+        return self.resolved[key]
+
+    def lookup(self, host, route, stop, direction):
+        route = match_first('Route', self.metadata.get(host + ROUTE_PATH, Route), route, 'description')
+        if route is None:
+            return None
+
+        directions = self.metadata.get(host + DIR_PATH.format(route=route.route), Direction)
+        direction = match_first('Direction', directions, direction, 'text')
+        if direction is None:
+            return None
+
+        stops = self.metadata.get(host + STOP_PATH.format(route=route.route, direction=direction.value), Stop)
+        stop = match_first('Stop', stops, stop, 'text')
+        if stop is None:
+            return None
+
+        return route, direction, stop
+
+    def next_departure(self, host, route, stop, direction, date_time):
+        # The next departure as it would have been answered at `date_time`
+        # (ms), or None when the archive can't say.
+        details = self.resolve(host, route, stop, direction)
+        if details is None:
+            return None
+
+        route, direction, stop = details
+        now = int(date_time)
+        times = self.departures_at(host + TIME_PATH.format(route=route.route, direction=direction.value,
+                                                           stop=stop.value), now)
+        if times is None:
+            return None
+
+        times = [t for t in times if t.time >= now]
+        departures = departures_from(recompute_realtime(times, date_time), date_time, count=1)
+        return departures and departures[0][0]
+
+
+class Recorder(object):
+    # Appends every upstream response to responses.log in the archive: a
+    # `fetched (ms), status, seconds taken, body length, url` line, then the
+    # body as received. Each response goes out in a single write to a file
+    # opened for appending, so several threads or processes can record into
+    # one archive. Departures responses are also added to the departures
+    # log, and routes, directions and stops to metadata.tsv, for `batch`.
+
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.archive = Archive(path)
+        self.fd = os.open(os.path.join(path, RESPONSES_FILE), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.recorded = set()
+
+    def record(self, url, endpoint_name, status, seconds, body, fetched=None):
+        fetched = int(time.time() * 1000) if fetched is None else fetched
+        header = '{}\t{}\t{:.6f}\t{}\t{}\n'.format(fetched, status, seconds, len(body), url)
+        os.write(self.fd, header.encode('utf-8') + body + b'\n')
+
+        if status != 200 or endpoint_name not in RECORDS:
+            return
+        try:
+            records = [RECORDS[endpoint_name].from_json(item) for item in json.loads(body.decode('utf-8'))]
+        except DECODE_ERRORS:
+            return
+        if endpoint_name == 'Time':
+            self.archive.append(url, fetched, records)
+        else:
+            self.archive.metadata.append(url, ('', '', json.dumps(records, separators=(',', ':'))))
+            self.recorded.add(url)
+
+    def record_records(self, url, endpoint_name, records):
+        # Routes, directions and stops answered from the cache or catalog,
+        # recorded as if just fetched (once per recorder), so the archive
+        # can replay and batch the lookups that used them.
+        if url in self.recorded or endpoint_name == 'Time':
+            return
+        body = json.dumps([record.to_json() for record in records]).encode('utf-8')
+        self.record(url, endpoint_name, 200, 0, body)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ResponseLog(object):
+    # The responses a Recorder wrote, read from a memory map of the log.
+    # responses maps each recorded path (and query) to its
+    # (status, seconds, body start, body end) entries in recorded order.
+
+    def __init__(self, path):
+        self.responses = collections.defaultdict(list)
+        self.log = b''
+        log_path = os.path.join(path, RESPONSES_FILE)
+        if os.path.exists(log_path) and os.path.getsize(log_path):
+            with open(log_path, 'rb') as f:
+                self.log = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        pos = 0
+        while pos < len(self.log):
+            end = self.log.find(b'\n', pos)
+            if end < 0:
+                break
+            _, status, seconds, length, url = self.log[pos:end].decode('utf-8').split('\t', 4)
+            start, pos = end + 1, end + 1 + int(length) + 1
+            if pos > len(self.log):
+                break  # still being written
+            self.responses[request_key(url)].append((int(status), float(seconds), start, start + int(length)))
+
+    def __len__(self):
+        return sum(len(entries) for entries in self.responses.values())
+
+    def body(self, entry):
+        return memoryview(self.log)[entry[2]:entry[3]]
+
+
+def encode_index(indexed, urls):
+    header = {'version': INDEX_VERSION, 'indexed': indexed,
+              'urls': [[url, len(times)] for url, (times, _) in urls.items()]}
+    parts = [json.dumps(header, separators=(',', ':')).encode('utf-8') + b'\n']
+    for columns in urls.values():
+        for column in columns:
+            if sys.byteorder != 'little':
+                column = array.array('q', column)
+                column.byteswap()
+            parts.append(column.tobytes())
+    return b''.join(parts)
+
+
+def decode_index(data):
+    # Returns (indexed, urls) as written by encode_index; raises ValueError
+    # for another version or a truncated file.
+    end = data.index(b'\n')
+    header = json.loads(data[:end].decode('utf-8'))
+    if header['version'] != INDEX_VERSION or not isinstance(header['indexed'], int):
+        raise ValueError('Unknown archive index')
+
+    urls = {}
+    pos = end + 1
+    for url, count in header['urls']:
+        columns = []
+        for _ in range(2):
+            column = array.array('q', data[pos:pos + count * 8])
+            if len(column) != count:
+                raise ValueError('Truncated archive index')
+            if sys.byteorder != 'little':
+                column.byteswap()
+            columns.append(column)
+            pos += count * 8
+        urls[url] = tuple(columns)
+    if pos != len(data):
+        raise ValueError('Truncated archive index')
+    return header['indexed'], urls
+
+
+def request_key(url):
+    # Recorded URLs are as next_bus built them, requests arrive quoted.
+    # Paths are keyed from /NexTrip on, so responses recorded from a host
+    # with a path prefix (such as a pretenders mock) replay at the root.
+    url = urllib.parse.urlsplit(url.strip())
+    path = urllib.parse.unquote(url.path)
+    path = path[max(path.find(SERVICE_PREFIX), 0):]
+    return path + ('?' + url.query if url.query else '')
+
+
+def init_worker(path, host, max_age):
+    global worker_archive, worker_host
+    # Millions of queries would mean millions of "not found" lines; the
+    # results already show which queries went unanswered.
+    logging.disable(logging.CRITICAL)
+    worker_archive = Archive(path, max_age)
+    worker_host = host
+
+
+def answer_chunk(rows):
+    answers = []
+    for row in rows:
+        try:
+            route, stop, direction, date_time = row
+            answers.append(worker_archive.next_departure(worker_host, route, stop, direction, date_time))
+        except ValueError:
+            answers.append(None)
+    return answers
+
+
+def run_batch(path, rows, out, host=DEFAULT_HOST, processes=None, chunk_size=BATCH_CHUNK,
+              max_age=ARCHIVE_MAX_AGE):
+    # Answers (route, stop, direction, date_time) rows from the archive at
+    # `path` on a pool of processes and writes each row with its departure
+    # to `out` as CSV, in input order. Rows are read a chunk at a time and
+    # at most two chunks per process are in flight, so memory stays flat
+    # however long the input is. Returns (queries, answered).
+    processes = processes or os.cpu_count() or 1
+    Archive(path).load_index()  # so the workers all find an up to date index
+
+    writer = csv.writer(out, lineterminator='\n')
+    rows = iter(rows)
+    chunks = iter(lambda: list(itertools.islice(rows, chunk_size)), [])
+    pending = collections.deque()
+    queries = answered = 0
+
+    def write(chunk, future):
+        nonlocal queries, answered
+        for row, departure in zip(chunk, future.result()):
+            writer.writerow(list(row) + [departure or '-'])
+            queries += 1
+            answered += departure is not None
+
+    with concurrent.futures.ProcessPoolExecutor(processes, initializer=init_worker,
+                                                initargs=(path, host, max_age)) as executor:
+        for chunk in chunks:
+            pending.append((chunk, executor.submit(answer_chunk, chunk)))
+            if len(pending) >= 2 * processes:
+                write(*pending.popleft())
+        while pending:
+            write(*pending.popleft())
+
+    return queries, answered
@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+import asyncio
+import gc
+import http.server
+import inspect
+import json
+import os
+import socketserver
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+
+import click
+
+import next_bus
+from next_bus import ROUTE_PATH, DIR_PATH, STOP_PATH, TIME_PATH
+
+BASELINE_FILE='bench_baseline.json'
+TOLERANCE=0.25
+SCRIPT_NAME=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'next_bus.py')
+PROFILED_FUNCTIONS=['lookup_route', 'lookup_direction', 'lookup_stop', 'lookup_next_time', 'fetch_first',
+                    'match_first', 'match_index', 'make_request', 'read_records', 'iter_json_array',
+                    'fetch_aged_departures', 'departures_from']
+PROFILE_FRAMES=64
+# Each cycle decodes three new metadata responses, and the last
+# MATCH_INDEXES of them keep their match indexes: that much memory is
+# expected to build up before a steady state is reached.
+PROFILE_WARMUP=next_bus.MATCH_INDEXES // 3 + 1
+PROFILE_GROWTH=1024
+
+
+class FakeNexTrip(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    # A local stand-in for the NexTrip service with made up routes, stops and
+    # departures. Every response is delayed by `latency` seconds.
+    daemon_threads = True
+
+    def __init__(self, routes=100, stops=50, departures=10, latency=0.0, port=0):
+        http.server.HTTPServer.__init__(self, ('127.0.0.1', port), FakeNexTripHandler)
+        self.latency = latency
+        self.requests = 0
+        self.bodies = {
+            ROUTE_PATH: json.dumps([{'Description': 'Route {} - Downtown'.format(i),
+                                     'ProviderID': '8', 'Route': str(i)}
+                                    for i in range(routes)]),
+            'directions': json.dumps([{'Text': 'NORTHBOUND', 'Value': '4'},
+                                      {'Text': 'SOUTHBOUND', 'Value': '1'}]),
+            'stops': json.dumps([{'Text': 'Stop {} Ave'.format(i), 'Value': 'S{}'.format(i)}
+                                 for i in range(stops)]),
+        }
+        self.departures = departures
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def body(self, path):
+        parts = urllib.parse.unquote(path).strip('/').split('/')
+        if path == ROUTE_PATH:
+            return self.bodies[ROUTE_PATH]
+        if parts[:2] == ['NexTrip', 'Directions']:
+            return self.bodies['directions']
+        if parts[:2] == ['NexTrip', 'Stops']:
+            return self.bodies['stops']
+        if len(parts) == 4:
+            now = int(time.time()) * 1000
+            return json.dumps([{'Actual': i % 2 == 0, 'BlockNumber': 1000 + i,
+                                'DepartureText': '{} Min'.format(5 + i * 10),
+                                'DepartureTime': '\\/Date({}-0500)\\/'.format(now + (5 + i * 10) * 60000),
+                                'Description': 'Downtown', 'Gate': '', 'Route': parts[1],
+                                'RouteDirection': 'SOUTHBOUND', 'Terminal': '',
+                                'VehicleHeading': 0, 'VehicleLatitude': 44.95,
+                                'VehicleLongitude': -93.26}
+                               for i in range(self.departures)])
+        return None
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+
+class FakeNexTripHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.server.requests += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        body = self.server.body(self.path)
+        if body is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        payload = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {'median': statistics.median(samples),
+            'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+            'min': samples[0]}
+
+
+def bench_cold_start(server, runs):
+    # Whole process runs: without a cache, then again with a warm one.
+    query = ['-h', server.url, 'Route 7 -', 'Stop 3 Ave', 'south']
+    with tempfile.TemporaryDirectory() as cache_dir:
+        env = dict(os.environ, NEXT_BUS_CACHE=os.path.join(cache_dir, 'cache.sqlite3'))
+        run = lambda *args: subprocess.run([sys.executable, SCRIPT_NAME] + list(args), env=env,
+                                           stdout=subprocess.DEVNULL, check=True)
+        results = {
+            'help': summarize([timed(run, '--help')[0] for _ in range(runs)]),
+            'uncached': summarize([timed(run, '--no-cache', *query)[0] for _ in range(runs)]),
+        }
+        run(*query)
+        results['cached'] = summarize([timed(run, *query)[0] for _ in range(runs)])
+    return results
+
+
+def bench_lookups(server, runs):
+    next_bus.use_cache(None)
+    next_bus.use_session(next_bus.PooledSession())
+    host = server.url
+    samples = {'lookup_route': [], 'lookup_direction': [], 'lookup_stop': [], 'lookup_next_time': []}
+
+    for _ in range(runs):
+        elapsed, route = timed(next_bus.lookup_route, 'Route 7 -', host + ROUTE_PATH)
+        samples['lookup_route'].append(elapsed)
+        elapsed, direction = timed(next_bus.lookup_direction, 'south', route, host + DIR_PATH)
+        samples['lookup_direction'].append(elapsed)
+        elapsed, stop = timed(next_bus.lookup_stop, 'Stop 3 Ave', route, direction, host + STOP_PATH)
+        samples['lookup_stop'].append(elapsed)
+        elapsed, _ = timed(next_bus.lookup_next_time, None, route, direction, stop, host + TIME_PATH)
+        samples['lookup_next_time'].append(elapsed)
+
+    return {stage: summarize(times) for stage, times in samples.items()}
+
+
+def bench_batch(server, queries, concurrency):
+    next_bus.use_cache(None)
+    next_bus.use_session(next_bus.PooledSession(pool_size=concurrency))
+    batch = [('Route {} -'.format(i % 20), 'Stop {} Ave'.format(i % 7), 'south')
+             for i in range(queries)]
+    elapsed, results = timed(asyncio.run, next_bus.next_bus_many(batch, host=server.url,
+                                                                  concurrency=concurrency))
+    return {'queries': queries, 'seconds': elapsed, 'per_second': queries / elapsed,
+            'failed': results.count(None)}
+
+
+def resolution_cycle(host):
+    # One full lookup without any caching, as a long-running poller makes.
+    route = next_bus.lookup_route('Route 7 -', host + ROUTE_PATH)
+    direction = next_bus.lookup_direction('south', route, host + DIR_PATH)
+    stop = next_bus.lookup_stop('Stop 3 Ave', route, direction, host + STOP_PATH)
+    return next_bus.lookup_next_time(None, route, direction, stop, host + TIME_PATH)
+
+
+def function_lines(names):
+    # {name: (first line, last line)} of next_bus functions, looking
+    # through the @traced wrappers.
+    lines = {}
+    for name in names:
+        fn = inspect.unwrap(getattr(next_bus, name))
+        source, first = inspect.getsourcelines(fn)
+        lines[name] = (first, first + len(source) - 1)
+    return lines
+
+
+def memory_by_function(snapshot, lines):
+    # Live memory blocks and bytes per function, counting everything
+    # allocated while a function was on the stack (callees included).
+    filename = os.path.abspath(next_bus.__file__)
+    found = {name: {'blocks': 0, 'bytes': 0} for name in lines}
+    for stat in snapshot.statistics('traceback'):
+        names = set(name for frame in stat.traceback if frame.filename == filename
+                    for name, (first, last) in lines.items() if first <= frame.lineno <= last)
+        for name in names:
+            found[name]['blocks'] += stat.count
+            found[name]['bytes'] += stat.size
+    return found
+
+
+def profile_memory(cycle, cycles, warmup=PROFILE_WARMUP, tolerance=PROFILE_GROWTH,
+                   functions=PROFILED_FUNCTIONS):
+    # Runs `cycle` warmup + cycles times under tracemalloc. Reports the
+    # memory each function still holds after the last cycle and how much
+    # that grew per cycle since the first measured one; functions growing
+    # by more than `tolerance` bytes a cycle are listed under `growing`.
+    lines = function_lines(functions)
+    tracemalloc.start(PROFILE_FRAMES)
+    try:
+        for _ in range(warmup):
+            cycle()
+
+        cycle()
+        gc.collect()  # so garbage waiting on the collector doesn't look like growth
+        first = memory_by_function(tracemalloc.take_snapshot(), lines)
+        for _ in range(cycles - 1):
+            cycle()
+        gc.collect()
+        last = memory_by_function(tracemalloc.take_snapshot(), lines)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    for name, held in last.items():
+        held['growth'] = (held['bytes'] - first[name]['bytes']) / max(cycles - 1, 1)
+    return {
+        'cycles': cycles,
+        'warmup': warmup,
+        'current': current,
+        'peak': peak,
+        'functions': last,
+        'growing': sorted(name for name, held in last.items() if held['growth'] > tolerance),
+    }
+
+
+def regressions(results, baseline, tolerance=TOLERANCE, path=()):
+    # Lists every timing that got more than `tolerance` slower (or, for
+    # throughput, slower by that much) than the baseline.
+    found = []
+    for key, value in results.items():
+        if key not in baseline:
+            continue
+        if isinstance(value, dict):
+            found.extend(regressions(value, baseline[key], tolerance, path + (key,)))
+        elif key == 'per_second' and value < baseline[key] * (1 - tolerance):
+            found.append(('.'.join(path + (key,)), baseline[key], value))
+        elif key in ('median', 'p95', 'min', 'seconds') and value > baseline[key] * (1 + tolerance):
+            found.append(('.'.join(path + (key,)), baseline[key], value))
+    return found
+
+
+@click.command()
+@click.option('--routes', type=int, default=100, help='Routes the fake service lists.')
+@click.option('--stops', type=int, default=50, help='Stops per route and direction.')
+@click.option('--departures', type=int, default=10, help='Departures per stop.')
+@click.option('--latency', type=float, default=0.0, help='Seconds the fake service waits per request.')
+@click.option('--runs', type=int, default=20, help='Samples per measurement.')
+@click.option('--queries', type=int, default=200, help='Queries in the batch throughput run.')
+@click.option('--concurrency', type=int, default=next_bus.CONCURRENCY)
+@click.option('--baseline', default=BASELINE_FILE, type=click.Path(dir_okay=False),
+              help='Baseline results to compare against.')
+@click.option('--save', is_flag=True, help='Record these results as the new baseline.')
+@click.option('--tolerance', type=float, default=TOLERANCE,
+              help='Allowed slowdown against the baseline, as a fraction.')
+@click.option('--profile-memory', 'profile_cycles', type=click.IntRange(1), metavar='N',
+              help='Instead of timing, trace memory over N uncached lookups.')
+@click.option('--warmup', type=int, default=PROFILE_WARMUP,
+              help='Lookups to run before --profile-memory starts measuring.')
+@click.option('--growth-tolerance', type=float, default=PROFILE_GROWTH,
+              help='Bytes per lookup a function may grow by under --profile-memory.')
+def bench(routes, stops, departures, latency, runs, queries, concurrency, baseline, save, tolerance,
+          profile_cycles, warmup, growth_tolerance):
+    """Benchmark next_bus against a local fake NexTrip service.
+
+    Prints the results as JSON. Exits with status 1 if any timing regressed
+    beyond the tolerance of the saved baseline.
+
+    With --profile-memory N, runs N lookups with tracemalloc instead and
+    prints the memory each lookup function holds and its growth per lookup.
+    Exits with status 1 if any function keeps growing.
+    """
+    server = FakeNexTrip(routes=routes, stops=stops, departures=departures, latency=latency).start()
+    if profile_cycles:
+        next_bus.use_cache(None)
+        next_bus.use_session(next_bus.PooledSession())
+        try:
+            results = {
+                'config': dict(routes=routes, stops=stops, departures=departures, latency=latency),
+                'memory': profile_memory(lambda: resolution_cycle(server.url), profile_cycles, warmup,
+                                         growth_tolerance),
+            }
+        finally:
+            server.shutdown()
+
+        print(json.dumps(results, indent=2, sort_keys=True))
+        for name in results['memory']['growing']:
+            click.echo('GROWING: {} {:.0f} bytes per lookup'.format(
+                name, results['memory']['functions'][name]['growth']), err=True)
+        if results['memory']['growing']:
+            sys.exit(1)
+        return
+
+    try:
+        results = {
+            'config': dict(routes=routes, stops=stops, departures=departures, latency=latency,
+                           runs=runs, queries=queries, concurrency=concurrency),
+            'cold_start': bench_cold_start(server, runs),
+            'lookups': bench_lookups(server, runs),
+            'batch': bench_batch(server, queries, concurrency),
+        }
+    finally:
+        server.shutdown()
+
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+    if save:
+        with open(baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        return
+
+    if os.path.exists(baseline):
+        with open(baseline) as f:
+            saved = json.load(f)
+        if saved.get('config') != results['config']:
+            click.echo('WARNING: Baseline was recorded with a different configuration', err=True)
+        found = regressions(results, saved, tolerance)
+        for name, before, after in found:
+            click.echo('REGRESSION: {} {:.4f} -> {:.4f}'.format(name, before, after), err=True)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    bench()
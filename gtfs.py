@@ -0,0 +1,701 @@
+import array
+import bisect
+import csv
+import heapq
+import io
+import json
+import logging
+import math
+import os
+import sys
+import threading
+import time
+import zipfile
+
+from next_bus import Direction, Route, Stop, get_session, match_first
+
+INDEX_VERSION=4
+INDEX_SUFFIX='.index'
+INDEX_ARRAYS=['stop_lats', 'stop_lons', 'service_days', 'service_starts', 'service_ends',
+              'trip_routes', 'trip_services', 'trip_directions', 'stop_offsets', 'stop_secs',
+              'stop_trips']
+WEEKDAYS=['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+DAY=24*60*60
+REALTIME_INTERVAL=30
+GRID_CELL=0.005  # degrees, about 550 m north-south
+EARTH_RADIUS=6371000
+WALK_SPEED=80  # metres per minute
+# GTFS-Realtime enum values: FeedHeader.incrementality and
+# StopTimeUpdate.schedule_relationship.
+FULL_DATASET=0
+SKIPPED=1
+
+
+class Schedule(object):
+    # Scheduled departures from a GTFS zip, packed into arrays so a
+    # (route, stop, direction) query is a couple of bisects.
+    #
+    # stop_times are grouped by stop and sorted by departure time; the
+    # departures for stop i live in stop_secs/stop_trips between
+    # stop_offsets[i] and stop_offsets[i + 1]. Trips are described by parallel
+    # arrays of route, service and direction label indexes. Stops are also
+    # bucketed by position in stop_grid, so nearby stops can be found without
+    # measuring the distance to each one.
+
+    @classmethod
+    def load(cls, path):
+        # Ingesting a large feed takes a while, so the packed tables are kept
+        # next to the zip and reused until the zip changes. Returns None when
+        # the feed can't be read.
+        index_path = path + INDEX_SUFFIX
+        try:
+            stamp = [INDEX_VERSION, os.path.getmtime(path), os.path.getsize(path)]
+        except OSError as e:
+            logging.error('ERROR: Could not read GTFS feed {}: {}'.format(path, e.strerror))
+            return None
+
+        try:
+            with open(index_path, 'rb') as f:
+                schedule = cls.decode_index(f.read(), stamp)
+            if schedule is not None:
+                return schedule
+        except Exception:
+            # A missing, corrupt or foreign index just means re-ingesting.
+            pass
+
+        try:
+            schedule = cls.ingest(path)
+        except (OSError, zipfile.BadZipFile, csv.Error, ValueError) as e:
+            logging.error('ERROR: Could not read GTFS feed {}: {}'.format(path, e))
+            return None
+        except KeyError as e:
+            logging.error('ERROR: GTFS feed {} has no {} column'.format(path, e))
+            return None
+
+        try:
+            with open(index_path, 'wb') as f:
+                f.write(schedule.encode_index(stamp))
+        except OSError:
+            logging.warning('WARNING: Could not save GTFS index to {}'.format(index_path))
+        return schedule
+
+    def encode_index(self, stamp):
+        # A JSON header line with the ids, names and lookup tables, then the
+        # packed arrays as little-endian bytes.
+        header = {
+            'stamp': stamp,
+            'routes': self.routes,
+            'stops': self.stops,
+            'services': list(self.service_ids),
+            'service_added': sorted(self.service_added),
+            'service_removed': sorted(self.service_removed),
+            'trips': list(self.trip_ids),
+            'direction_labels': self.direction_labels,
+            'route_directions': sorted(self.route_directions.items()),
+            'served_stops': [[route, direction, list(stops)]
+                             for (route, direction), stops in sorted(self.served_stops.items())],
+            'stop_routes': sorted(self.stop_routes.items()),
+            'arrays': [[name, getattr(self, name).typecode, len(getattr(self, name))]
+                       for name in INDEX_ARRAYS],
+        }
+        parts = [json.dumps(header, separators=(',', ':')).encode('utf-8') + b'\n']
+        for name in INDEX_ARRAYS:
+            column = getattr(self, name)
+            if sys.byteorder != 'little':
+                column = array.array(column.typecode, column)
+                column.byteswap()
+            parts.append(column.tobytes())
+        return b''.join(parts)
+
+    @classmethod
+    def decode_index(cls, data, stamp):
+        # The schedule saved by encode_index, or None if it was saved for
+        # another version of the feed. Raises ValueError if it's truncated.
+        end = data.index(b'\n')
+        header = json.loads(data[:end].decode('utf-8'))
+        if header['stamp'] != stamp:
+            return None
+
+        schedule = cls()
+        schedule.routes = [Route(*route) for route in header['routes']]
+        schedule.route_ids = {route.route: i for i, route in enumerate(schedule.routes)}
+        schedule.stops = [Stop(*stop) for stop in header['stops']]
+        schedule.stop_ids = {stop.value: i for i, stop in enumerate(schedule.stops)}
+        schedule.service_ids = {service: i for i, service in enumerate(header['services'])}
+        schedule.service_added = set(map(tuple, header['service_added']))
+        schedule.service_removed = set(map(tuple, header['service_removed']))
+        schedule.trip_ids = {trip: i for i, trip in enumerate(header['trips'])}
+        schedule.direction_labels = header['direction_labels']
+        schedule.route_directions = dict(header['route_directions'])
+        schedule.served_stops = {(route, direction): array.array('l', stops)
+                                 for route, direction, stops in header['served_stops']}
+        schedule.stop_routes = {stop: list(map(tuple, served)) for stop, served in header['stop_routes']}
+
+        if [name for name, _, _ in header['arrays']] != INDEX_ARRAYS:
+            raise ValueError('GTFS index has the wrong arrays')
+        pos = end + 1
+        for name, typecode, count in header['arrays']:
+            column = array.array(typecode)
+            size = count * column.itemsize
+            column.frombytes(data[pos:pos + size])
+            if len(column) != count:
+                raise ValueError('Truncated GTFS index')
+            if sys.byteorder != 'little':
+                column.byteswap()
+            setattr(schedule, name, column)
+            pos += size
+        if pos != len(data):
+            raise ValueError('Truncated GTFS index')
+        schedule.build_grid()
+        return schedule
+
+    @classmethod
+    def ingest(cls, path):
+        schedule = cls()
+        with zipfile.ZipFile(path) as feed:
+            schedule.read_routes(read_table(feed, 'routes.txt'))
+            schedule.read_stops(read_table(feed, 'stops.txt'))
+            schedule.read_calendar(read_table(feed, 'calendar.txt'),
+                                   read_table(feed, 'calendar_dates.txt', required=False))
+            schedule.read_trips(read_table(feed, 'trips.txt'))
+            schedule.read_stop_times(read_table(feed, 'stop_times.txt'))
+        schedule.build_grid()
+        return schedule
+
+    def read_routes(self, rows):
+        self.route_ids = {}
+        self.routes = []
+        for row in rows:
+            names = [row.get('route_short_name'), row.get('route_long_name')]
+            description = ' - '.join(name for name in names if name)
+            self.route_ids[row['route_id']] = len(self.routes)
+            self.routes.append(Route(description, row['route_id']))
+
+    def read_stops(self, rows):
+        self.stop_ids = {}
+        self.stops = []
+        self.stop_lats = array.array('d')
+        self.stop_lons = array.array('d')
+        for row in rows:
+            self.stop_ids[row['stop_id']] = len(self.stops)
+            self.stops.append(Stop(row['stop_name'], row['stop_id']))
+            self.stop_lats.append(float(row.get('stop_lat') or 0))
+            self.stop_lons.append(float(row.get('stop_lon') or 0))
+
+    def read_calendar(self, rows, exception_rows):
+        self.service_ids = {}
+        self.service_days = array.array('b')
+        self.service_starts = array.array('l')
+        self.service_ends = array.array('l')
+        for row in rows:
+            service = self.service(row['service_id'])
+            self.service_days[service] = sum(1 << day for day, name in enumerate(WEEKDAYS)
+                                             if row[name] == '1')
+            self.service_starts[service] = int(row['start_date'])
+            self.service_ends[service] = int(row['end_date'])
+
+        self.service_added = set()
+        self.service_removed = set()
+        for row in exception_rows:
+            exception = (self.service(row['service_id']), int(row['date']))
+            if row['exception_type'] == '1':
+                self.service_added.add(exception)
+            else:
+                self.service_removed.add(exception)
+
+    def service(self, service_id):
+        if service_id not in self.service_ids:
+            self.service_ids[service_id] = len(self.service_ids)
+            self.service_days.append(0)
+            self.service_starts.append(0)
+            self.service_ends.append(0)
+        return self.service_ids[service_id]
+
+    def read_trips(self, rows):
+        self.trip_ids = {}
+        self.trip_routes = array.array('l')
+        self.trip_services = array.array('l')
+        self.trip_directions = array.array('l')
+        self.direction_labels = []
+        labels = {}
+        for row in rows:
+            # Feeds that name their directions (e.g. "Southbound") get matched
+            # on that name, others on the headsign.
+            label = row.get('direction') or row.get('trip_headsign') or row.get('direction_id') or ''
+            if label not in labels:
+                labels[label] = len(self.direction_labels)
+                self.direction_labels.append(label)
+
+            route = self.route_ids.get(row['route_id'])
+            if route is None:
+                continue
+            self.trip_ids[row['trip_id']] = len(self.trip_routes)
+            self.trip_routes.append(route)
+            self.trip_services.append(self.service(row['service_id']))
+            self.trip_directions.append(labels[label])
+
+    def read_stop_times(self, rows):
+        # Each departure is packed as secs << 32 | trip so a stop's list
+        # sorts by time and costs 8 bytes per row.
+        by_stop = [array.array('q') for _ in self.stops]
+        served = {}
+        for row in rows:
+            departure = row.get('departure_time') or row.get('arrival_time')
+            if not departure:
+                continue
+            # Rows for trips or stops the feed doesn't describe are skipped.
+            trip = self.trip_ids.get(row['trip_id'])
+            stop = self.stop_ids.get(row['stop_id'])
+            if trip is None or stop is None:
+                continue
+            by_stop[stop].append(parse_seconds(departure) << 32 | trip)
+            key = (self.trip_routes[trip], self.trip_directions[trip])
+            served.setdefault(key, set()).add(stop)
+
+        self.stop_offsets = array.array('l', [0])
+        self.stop_secs = array.array('l')
+        self.stop_trips = array.array('l')
+        for departures in by_stop:
+            departures = sorted(departures)
+            self.stop_secs.extend(packed >> 32 for packed in departures)
+            self.stop_trips.extend(packed & 0xffffffff for packed in departures)
+            self.stop_offsets.append(len(self.stop_secs))
+
+        # Which directions each route runs, which stops each serves and
+        # which routes serve each stop.
+        self.route_directions = {}
+        self.served_stops = {}
+        self.stop_routes = {}
+        for (route, direction), stops in sorted(served.items()):
+            self.route_directions.setdefault(route, []).append(direction)
+            self.served_stops[(route, direction)] = array.array('l', sorted(stops))
+            for stop in stops:
+                self.stop_routes.setdefault(stop, []).append((route, direction))
+
+    def build_grid(self):
+        self.stop_grid = {}
+        for stop, (lat, lon) in enumerate(zip(self.stop_lats, self.stop_lons)):
+            if lat or lon:
+                self.stop_grid.setdefault(grid_cell(lat, lon), array.array('l')).append(stop)
+
+    def nearest_stops(self, lat, lon, radius, count=None):
+        # (metres, stop) for the `count` nearest stops within `radius`
+        # metres, nearest first. Only the grid cells the radius reaches are
+        # looked at.
+        reach_lat = math.degrees(radius / EARTH_RADIUS)
+        reach_lon = reach_lat / max(math.cos(math.radians(lat)), 0.01)
+        first_row, first_col = grid_cell(lat - reach_lat, lon - reach_lon)
+        last_row, last_col = grid_cell(lat + reach_lat, lon + reach_lon)
+
+        found = []
+        for row in range(first_row, last_row + 1):
+            for col in range(first_col, last_col + 1):
+                for stop in self.stop_grid.get((row, col), ()):
+                    metres = distance(lat, lon, self.stop_lats[stop], self.stop_lons[stop])
+                    if metres <= radius:
+                        found.append((metres, stop))
+        return heapq.nsmallest(count, found) if count is not None else sorted(found)
+
+    def nearby(self, lat, lon, radius, stops, date_time=None, first_departure=None):
+        # The next departure of every route and direction at the `stops`
+        # nearest stops that can still be caught on foot, soonest first, as
+        # (epoch, realtime, route, direction label, stop, metres).
+        first_departure = first_departure or self.first_departure
+        now = int(date_time) // 1000 if date_time else int(time.time())
+        found = []
+        for metres, stop in self.nearest_stops(lat, lon, radius, stops):
+            reachable = now + int(metres / WALK_SPEED * 60)
+            for route, direction in self.stop_routes.get(stop, ()):
+                departure = first_departure(route, direction, stop, reachable)
+                if departure is not None:
+                    found.append(departure + (self.routes[route], self.direction_labels[direction],
+                                              self.stops[stop], metres))
+        found.sort(key=lambda departure: (departure[0], departure[5]))
+        return found
+
+    def first_departure(self, route, direction, stop, after):
+        # (epoch, realtime) of the first departure at or after `after`.
+        epochs = self.departure_epochs(route, direction, stop, after)
+        return (epochs[0], False) if epochs else None
+
+    def lookup(self, route_pattern, stop_pattern, direction_pattern):
+        route = match_first('Route', self.routes, route_pattern, 'description')
+        if route is None:
+            return None
+        route = self.route_ids[route.route]
+
+        directions = [Direction(self.direction_labels[d], d)
+                      for d in sorted(self.route_directions.get(route, ()))]
+        direction = match_first('Direction', directions, direction_pattern, 'text')
+        if direction is None:
+            return None
+        direction = direction.value
+
+        stops = [self.stops[s] for s in self.served_stops[(route, direction)]]
+        stop = match_first('Stop', stops, stop_pattern, 'text')
+        if stop is None:
+            return None
+
+        return route, direction, self.stop_ids[stop.value]
+
+    def departures(self, route_pattern, stop_pattern, direction_pattern, date_time=None, count=1):
+        # Same shape as next_bus.lookup_departures: (text, realtime) pairs.
+        found = self.lookup(route_pattern, stop_pattern, direction_pattern)
+        if found is None:
+            return None
+
+        now = int(date_time) if date_time else int(time.time()) * 1000
+        return self.departures_at(found, now, count)
+
+    def departures_at(self, found, now, count=1):
+        epochs = self.departure_epochs(*found, now=now // 1000, count=count)
+        if not epochs:
+            logging.error('ERROR: No scheduled departures remain')
+            return None
+
+        return [('{} Min'.format((epoch * 1000 - now) // 60000), False) for epoch in epochs]
+
+    def departure_epochs(self, route, direction, stop, now, count=1):
+        start, end = self.stop_offsets[stop], self.stop_offsets[stop + 1]
+        found = []
+
+        # Trips after midnight belong to the previous service day, and the
+        # next few departures may not come until tomorrow.
+        for days in ((-1, 0) if count is None else (-1, 0, 1)):
+            midnight = service_midnight(now, days)
+            date = int(time.strftime('%Y%m%d', time.localtime(midnight + DAY // 2)))
+            weekday = time.localtime(midnight + DAY // 2).tm_wday
+
+            k = bisect.bisect_left(self.stop_secs, now - midnight, start, end)
+            matched = 0
+            while k < end and (count is None or matched < count):
+                trip = self.stop_trips[k]
+                if (self.trip_routes[trip] == route and self.trip_directions[trip] == direction and
+                        self.runs(self.trip_services[trip], date, weekday)):
+                    found.append(midnight + self.stop_secs[k])
+                    matched += 1
+                k += 1
+
+        found.sort()
+        return found[:count]
+
+    def runs(self, service, date, weekday):
+        if (service, date) in self.service_added:
+            return True
+        if (service, date) in self.service_removed:
+            return False
+        return (self.service_starts[service] <= date <= self.service_ends[service] and
+                bool(self.service_days[service] & (1 << weekday)))
+
+
+class Realtime(object):
+    # Predicted departures from a GTFS-Realtime TripUpdates feed (a URL or
+    # a file), indexed by stop. The feed is fetched at most once per
+    # `interval`, and each snapshot is applied as a delta: updates whose
+    # bytes didn't change are skipped, changed trips replace their stop
+    # entries, and trips missing from a full snapshot are dropped. A
+    # snapshot is parsed in full before the index changes, so a malformed
+    # one leaves the last good state. Route, stop and direction names come
+    # from the static `schedule`.
+
+    def __init__(self, schedule, source, interval=REALTIME_INTERVAL):
+        self.schedule = schedule
+        self.source = source
+        self.interval = interval
+        self.fetched = None
+        self.lock = threading.Lock()
+        # entity id -> (hash of its update, trip route, trip direction, [(stop id, epoch)])
+        self.trips = {}
+        # stop id -> sorted [(epoch, entity id, route, direction)]
+        self.stops = {}
+
+    def refresh(self):
+        with self.lock:
+            if self.fetched is not None and time.monotonic() - self.fetched < self.interval:
+                return
+            data = read_feed(self.source)
+            self.fetched = time.monotonic()
+            if data is None:
+                return
+            try:
+                self.apply(data)
+            except (ValueError, IndexError):
+                logging.error('ERROR: Realtime feed misbehaved')
+
+    def apply(self, data):
+        # Returns how many trips changed and how many were removed.
+        full = True
+        seen = set()
+        removals = []
+        additions = []
+        for number, _, value in read_fields(memoryview(data)):
+            if number == 1:
+                for field, _, header_value in read_fields(value):
+                    if field == 2:
+                        full = header_value == FULL_DATASET
+            elif number == 2:
+                entity_id, deleted, update = parse_entity(value)
+                seen.add(entity_id)
+                if deleted or update is None:
+                    removals.append(entity_id)
+                    continue
+                digest = hash(bytes(update))
+                if entity_id in self.trips and self.trips[entity_id][0] == digest:
+                    continue
+                additions.append((entity_id, digest, self.trip_entries(update)))
+
+        if full:
+            removals.extend(e for e in self.trips if e not in seen)
+        removed = sum(map(self.remove, removals))
+        for entity_id, digest, (route, direction, entries) in additions:
+            self.remove(entity_id)
+            self.add(entity_id, digest, route, direction, entries)
+        return len(additions), removed
+
+    def trip_entries(self, update):
+        # (route, direction, [(stop id, epoch)]) for a TripUpdate, with the
+        # epochs of stops that only have a delay worked out from the schedule.
+        trip_id, route_id, start_date, stop_times = parse_trip_update(update)
+        trip = self.schedule.trip_ids.get(trip_id)
+        if trip is not None:
+            route, direction = self.schedule.trip_routes[trip], self.schedule.trip_directions[trip]
+        else:
+            route = self.schedule.route_ids.get(route_id)
+            direction = self.infer_direction(route, [stop_id for stop_id, _, _ in stop_times])
+
+        midnight = None
+        if start_date:
+            noon = time.strptime(start_date + '12', '%Y%m%d%H')
+            midnight = int(time.mktime(noon)) - DAY // 2
+
+        entries = []
+        for stop_id, epoch, delay in stop_times:
+            if epoch is None and trip is not None and stop_id in self.schedule.stop_ids:
+                scheduled = self.scheduled_epoch(trip, self.schedule.stop_ids[stop_id], midnight)
+                if scheduled is not None:
+                    epoch = scheduled + delay
+            if epoch is not None:
+                entries.append((stop_id, epoch))
+        return route, direction, entries
+
+    def infer_direction(self, route, stop_ids):
+        # The one direction of `route` whose trips serve all these stops, or
+        # None when it can't be told.
+        stops = [self.schedule.stop_ids.get(stop_id) for stop_id in stop_ids]
+        if route is None or not stops or None in stops:
+            return None
+        directions = [direction for direction in self.schedule.route_directions.get(route, [])
+                      if all(stop in self.schedule.served_stops[(route, direction)] for stop in stops)]
+        return directions[0] if len(directions) == 1 else None
+
+    def add(self, entity_id, digest, route, direction, entries):
+        for stop_id, epoch in entries:
+            bisect.insort(self.stops.setdefault(stop_id, []), (epoch, entity_id, route, direction))
+        self.trips[entity_id] = (digest, route, direction, entries)
+
+    def remove(self, entity_id):
+        if entity_id not in self.trips:
+            return 0
+        _, route, direction, entries = self.trips.pop(entity_id)
+        for stop_id, epoch in entries:
+            departures = self.stops[stop_id]
+            del departures[bisect.bisect_left(departures, (epoch, entity_id, route, direction))]
+        return 1
+
+    def scheduled_epoch(self, trip, stop, midnight=None):
+        start, end = self.schedule.stop_offsets[stop], self.schedule.stop_offsets[stop + 1]
+        for k in range(start, end):
+            if self.schedule.stop_trips[k] == trip:
+                if midnight is None:
+                    midnight = service_midnight(int(time.time()))
+                return midnight + self.schedule.stop_secs[k]
+        return None
+
+    def departures(self, route_pattern, stop_pattern, direction_pattern, date_time=None, count=1):
+        # Same shape as next_bus.lookup_departures: (text, realtime) pairs.
+        found = self.schedule.lookup(route_pattern, stop_pattern, direction_pattern)
+        if found is None:
+            return None
+        route, direction, stop = found
+
+        self.refresh()
+        now = int(date_time) if date_time else int(time.time()) * 1000
+        epochs = []
+        with self.lock:
+            departures = self.stops.get(self.schedule.stops[stop].value, [])
+            for epoch, _, trip_route, trip_direction in departures[bisect.bisect_left(departures, (now // 1000,)):]:
+                if trip_route == route and trip_direction == direction:
+                    epochs.append(epoch)
+                    if count is not None and len(epochs) >= count:
+                        break
+
+        if not epochs:
+            logging.warning('WARNING: No predictions, answering from the GTFS schedule')
+            return self.schedule.departures_at(found, now, count)
+        return [('{} Min'.format((epoch * 1000 - now) // 60000), True) for epoch in epochs]
+
+    def nearby(self, lat, lon, radius, stops, date_time=None):
+        # Like Schedule.nearby, with predictions where the feed has them.
+        self.refresh()
+        return self.schedule.nearby(lat, lon, radius, stops, date_time, self.first_departure)
+
+    def first_departure(self, route, direction, stop, after):
+        with self.lock:
+            departures = self.stops.get(self.schedule.stops[stop].value, [])
+            for epoch, _, trip_route, trip_direction in departures[bisect.bisect_left(departures, (after,)):]:
+                if trip_route == route and trip_direction == direction:
+                    return epoch, True
+        return self.schedule.first_departure(route, direction, stop, after)
+
+
+def read_feed(source):
+    if not source.startswith(('http://', 'https://')):
+        try:
+            with open(source, 'rb') as f:
+                return f.read()
+        except OSError:
+            logging.error('ERROR: Realtime feed unreachable')
+            return None
+
+    import requests
+    try:
+        r = get_session().get(source, headers={'Accept': 'application/x-protobuf'})
+    except requests.RequestException:
+        logging.error('ERROR: Realtime feed unreachable')
+        return None
+    if r.status_code != 200:
+        logging.error('ERROR: Realtime feed misbehaved')
+        return None
+    return r.content
+
+
+def parse_entity(data):
+    # FeedEntity: (id, is_deleted, TripUpdate bytes or None).
+    entity_id, deleted, update = '', False, None
+    for number, _, value in read_fields(data):
+        if number == 1:
+            entity_id = str(value, 'utf-8')
+        elif number == 2:
+            deleted = bool(value)
+        elif number == 3:
+            update = value
+    return entity_id, deleted, update
+
+
+def parse_trip_update(data):
+    # TripUpdate: (trip id, route id, start date, [(stop id, epoch, delay)]).
+    # The epoch is None when a stop only has a delay; skipped stops are left
+    # out.
+    trip_id = route_id = start_date = ''
+    stop_times = []
+    for number, _, value in read_fields(data):
+        if number == 1:
+            for field, _, trip_value in read_fields(value):
+                if field == 1:
+                    trip_id = str(trip_value, 'utf-8')
+                elif field == 3:
+                    start_date = str(trip_value, 'utf-8')
+                elif field == 5:
+                    route_id = str(trip_value, 'utf-8')
+        elif number == 2:
+            stop_time = parse_stop_time_update(value)
+            if stop_time is not None:
+                stop_times.append(stop_time)
+    return trip_id, route_id, start_date, stop_times
+
+
+def parse_stop_time_update(data):
+    stop_id = None
+    events = {}
+    skipped = False
+    for number, _, value in read_fields(data):
+        if number in (2, 3):
+            events[number] = dict((field, signed(event_value)) for field, _, event_value
+                                  in read_fields(value))
+        elif number == 4:
+            stop_id = str(value, 'utf-8')
+        elif number == 5:
+            skipped = value == SKIPPED
+
+    # Prefer the departure over the arrival, and a time over a delay.
+    event = events.get(3) or events.get(2)
+    if skipped or stop_id is None or event is None:
+        return None
+    return stop_id, event.get(2), event.get(1, 0)
+
+
+def read_fields(data, pos=0):
+    # Yields (field number, wire type, value) for each field of the protobuf
+    # message in `data`, a memoryview. Varints come back as ints, everything
+    # else as memoryview slices.
+    end = len(data)
+    while pos < end:
+        key, pos = read_varint(data, pos)
+        wire_type = key & 7
+        if wire_type == 0:
+            value, pos = read_varint(data, pos)
+        elif wire_type == 2:
+            length, pos = read_varint(data, pos)
+            value, pos = data[pos:pos + length], pos + length
+        elif wire_type == 1:
+            value, pos = data[pos:pos + 8], pos + 8
+        elif wire_type == 5:
+            value, pos = data[pos:pos + 4], pos + 4
+        else:
+            raise ValueError('Unsupported wire type {}'.format(wire_type))
+        if pos > end:
+            raise ValueError('Truncated message')
+        yield key >> 3, wire_type, value
+
+
+def read_varint(data, pos):
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def signed(value):
+    # int32 and int64 varints are two's complement over 64 bits.
+    return value - (1 << 64) if isinstance(value, int) and value >= 1 << 63 else value
+
+
+def read_table(feed, name, required=True):
+    # Rows are read one at a time; stop_times.txt runs to millions of them.
+    try:
+        info = feed.getinfo(name)
+    except KeyError:
+        if required:
+            raise ValueError('{} is missing'.format(name))
+        return
+    with feed.open(info) as f:
+        for row in csv.DictReader(io.TextIOWrapper(f, encoding='utf-8-sig')):
+            yield row
+
+
+def grid_cell(lat, lon):
+    return int(math.floor(lat / GRID_CELL)), int(math.floor(lon / GRID_CELL))
+
+
+def distance(lat1, lon1, lat2, lon2):
+    # Metres between two points, flat-earth approximation; plenty for
+    # walking distances.
+    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return EARTH_RADIUS * math.hypot(x, y)
+
+
+def parse_seconds(value):
+    hours, minutes, seconds = value.strip().split(':')
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+def service_midnight(now, days=0):
+    # GTFS measures times from "noon minus 12h", which is midnight except on
+    # daylight saving changes.
+    noon = time.localtime(now + days * DAY)
+    return int(time.mktime((noon.tm_year, noon.tm_mon, noon.tm_mday, 12, 0, 0, 0, 0, -1))) - DAY // 2
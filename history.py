@@ -0,0 +1,234 @@
+import array
+import bisect
+import collections
+import datetime
+import itertools
+import json
+import operator
+import os
+import struct
+import sys
+import threading
+import time
+import urllib.parse
+import zlib
+
+from next_bus import HISTORY_FLUSH
+
+PARTITION_SUFFIX='.nbh'
+BLOCK_MAGIC=b'NBH1'
+BLOCK_HEADER=struct.Struct('<4sII')
+PART_HEADER=struct.Struct('<I')
+BLOCK_ROWS=4096
+COLUMNS=[('polled', 'q'), ('key', 'I'), ('block', 'i'), ('offset', 'q'), ('actual', 'b')]
+SERVICE_PREFIX='/NexTrip/'
+TRIP_GAP=2*60*1000
+HEADWAY_MAX=2*60*60*1000
+ERROR_PERCENTILE=0.9
+STATS_FIELDS=['stop', 'departures', 'predictions', 'mean_error', 'mean_abs_error', 'p90_abs_error',
+              'mean_headway', 'mean_wait']
+
+
+class HistoryStore(object):
+    # Every departure polled from the service, kept in a directory with a
+    # file per UTC day. A file is a run of blocks of up to `block_rows`
+    # rows, stored as separately zlib-compressed columns: when it was polled
+    # (ms, delta-encoded), the stop (an index into the block's
+    # route/direction/stop keys), the block number (-1 if unknown), the
+    # departure time (ms after polling) and whether it was a realtime
+    # prediction. Rows are buffered for up to `flush_interval` seconds, then
+    # each block goes out in a single write to a file opened for appending,
+    # so several processes can share a store.
+
+    def __init__(self, path, flush_interval=HISTORY_FLUSH, block_rows=BLOCK_ROWS):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.block_rows = block_rows
+        self.lock = threading.Lock()
+        self.pending = collections.defaultdict(list)
+        self.rows = 0
+        self.flushed = time.monotonic()
+        os.makedirs(path, exist_ok=True)
+
+    def add(self, url, times, polled=None):
+        polled = int(time.time() * 1000) if polled is None else polled
+        key = stop_key(url)
+        with self.lock:
+            self.pending[partition_name(polled)].extend(
+                (polled, key, -1 if t.block is None else t.block, t.time - polled, t.actual) for t in times)
+            self.rows += len(times)
+            due = self.rows >= self.block_rows or time.monotonic() - self.flushed >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, collections.defaultdict(list)
+            self.rows = 0
+            self.flushed = time.monotonic()
+
+        for name, rows in pending.items():
+            fd = os.open(os.path.join(self.path, name), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                for start in range(0, len(rows), self.block_rows):
+                    os.write(fd, encode_block(rows[start:start + self.block_rows]))
+            finally:
+                os.close(fd)
+
+    def close(self):
+        self.flush()
+
+    def partitions(self, since=None, until=None):
+        # The day files that can hold rows polled in [since, until) (ms).
+        first = since and partition_name(since)
+        last = until and partition_name(until - 1)
+        return [os.path.join(self.path, name) for name in sorted(os.listdir(self.path))
+                if name.endswith(PARTITION_SUFFIX) and
+                (first is None or name >= first) and (last is None or name <= last)]
+
+    def read(self, since=None, until=None, stop=None):
+        # Returns (keys, columns) for the rows polled in [since, until) at
+        # stops whose key starts with `stop`. columns maps polled, key,
+        # block, time (ms since the epoch) and actual to arrays, and keys
+        # holds the stop key for each key id. Only the day files in range
+        # are read, and rows are filtered a column at a time.
+        key_ids = {}
+        columns = {'polled': array.array('q'), 'key': array.array('I'), 'block': array.array('i'),
+                   'time': array.array('q'), 'actual': array.array('b')}
+
+        for path in self.partitions(since, until):
+            with open(path, 'rb') as f:
+                data = f.read()
+            for keys, block in decode_blocks(data):
+                polled = block['polled']
+                start = 0 if since is None else bisect.bisect_left(polled, since)
+                end = len(polled) if until is None else bisect.bisect_left(polled, until)
+                block = {name: column[start:end] for name, column in block.items()}
+
+                if stop is not None:
+                    wanted = set(i for i, key in enumerate(keys) if key.startswith(stop))
+                    mask = list(map(wanted.__contains__, block['key']))
+                    block = {name: array.array(column.typecode, itertools.compress(column, mask))
+                             for name, column in block.items()}
+
+                ids = [key_ids.setdefault(key, len(key_ids)) for key in keys]
+                block['key'] = array.array('I', map(ids.__getitem__, block['key']))
+                block['time'] = array.array('q', map(operator.add, block['polled'], block.pop('offset')))
+                for name, column in columns.items():
+                    column.extend(block[name])
+
+        return sorted(key_ids, key=key_ids.get), columns
+
+
+def stop_key(url):
+    # 'route/direction/stop' from a departures URL.
+    path = urllib.parse.unquote(urllib.parse.urlsplit(url).path)
+    return path[path.find(SERVICE_PREFIX) + len(SERVICE_PREFIX):]
+
+
+def partition_name(epoch_ms):
+    return datetime.datetime.utcfromtimestamp(epoch_ms / 1000).strftime('%Y-%m-%d') + PARTITION_SUFFIX
+
+
+def encode_block(rows):
+    # rows are (polled, key, block, offset, actual) tuples.
+    rows = sorted(rows, key=operator.itemgetter(0))
+    keys = sorted(set(row[1] for row in rows))
+    key_ids = {key: i for i, key in enumerate(keys)}
+
+    polled = [row[0] for row in rows]
+    columns = [
+        array.array('q', [polled[0]] + list(map(operator.sub, polled[1:], polled))),
+        array.array('I', (key_ids[row[1]] for row in rows)),
+        array.array('i', (row[2] for row in rows)),
+        array.array('q', (row[3] for row in rows)),
+        array.array('b', (row[4] for row in rows)),
+    ]
+
+    parts = [json.dumps(keys).encode('utf-8')]
+    for column in columns:
+        if sys.byteorder != 'little':
+            column.byteswap()
+        parts.append(column.tobytes())
+
+    payload = b''.join(PART_HEADER.pack(len(part)) + part for part in map(zlib.compress, parts))
+    return BLOCK_HEADER.pack(BLOCK_MAGIC, len(rows), len(payload)) + payload
+
+
+def decode_blocks(data):
+    # Yields (keys, {column name: array}) for each block in a day file,
+    # with polling times decoded. A block still being written is skipped.
+    pos = 0
+    while pos + BLOCK_HEADER.size <= len(data):
+        magic, rows, length = BLOCK_HEADER.unpack_from(data, pos)
+        if magic != BLOCK_MAGIC:
+            raise ValueError('Not a history block at offset {}'.format(pos))
+        pos += BLOCK_HEADER.size
+        if pos + length > len(data):
+            return
+
+        parts = []
+        end = pos + length
+        while pos < end:
+            size, = PART_HEADER.unpack_from(data, pos)
+            pos += PART_HEADER.size
+            parts.append(zlib.decompress(data[pos:pos + size]))
+            pos += size
+
+        keys = json.loads(parts[0].decode('utf-8'))
+        block = {}
+        for (name, code), part in zip(COLUMNS, parts[1:]):
+            column = array.array(code, part)
+            if sys.byteorder != 'little':
+                column.byteswap()
+            block[name] = column
+        block['polled'] = array.array('q', itertools.accumulate(block['polled']))
+        yield keys, block
+
+
+def stop_stats(keys, columns):
+    # Per stop: how far realtime predictions were from the departure they
+    # ended up predicting, and the headways between departures with the
+    # average wait they make for someone turning up at random. A trip is a
+    # block's next departure from the stop, followed from poll to poll
+    # until it leaves; its last polled time is taken as when it left.
+    rows = sorted(zip(columns['key'], columns['block'], columns['polled'], columns['time'],
+                      columns['actual']))
+    errors = collections.defaultdict(list)
+    departures = collections.defaultdict(list)
+
+    def finish(key, trip):
+        left = trip[-1][3]
+        departures[key].append(left)
+        errors[key].extend((row[3] - left) / 1000 for row in trip[:-1] if row[4])
+
+    for (key, block), polls in itertools.groupby(rows, operator.itemgetter(0, 1)):
+        if block < 0:
+            continue
+        trip = []
+        for _, first in itertools.groupby(polls, operator.itemgetter(2)):
+            row = next(first)  # the block's soonest departure in this poll
+            if trip and row[2] > trip[-1][3] + TRIP_GAP:
+                finish(key, trip)
+                trip = []
+            trip.append(row)
+        finish(key, trip)
+
+    stats = []
+    for key in sorted(departures, key=keys.__getitem__):
+        key_errors = errors[key]
+        absolute = sorted(map(abs, key_errors))
+        left = sorted(set(departures[key]))
+        headways = [h for h in map(operator.sub, left[1:], left) if h <= HEADWAY_MAX]
+        stats.append({
+            'stop': keys[key],
+            'departures': len(left),
+            'predictions': len(key_errors),
+            'mean_error': round(sum(key_errors) / len(key_errors), 1) if key_errors else None,
+            'mean_abs_error': round(sum(absolute) / len(absolute), 1) if absolute else None,
+            'p90_abs_error': round(absolute[int(ERROR_PERCENTILE * (len(absolute) - 1))], 1) if absolute else None,
+            'mean_headway': round(sum(headways) / len(headways) / 60000, 1) if headways else None,
+            'mean_wait': (round(sum(h * h for h in headways) / (2 * sum(headways)) / 60000, 1)
+                          if headways else None),
+        })
+    return stats
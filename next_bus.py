@@ -1,11 +1,25 @@
 #!/usr/bin/env python
+import bisect
+import codecs
+import collections
+import functools
+import itertools
+import json
 import logging
-import math
+import os
+import random
+import re
+import stat
 import sys
+import threading
 import time
 
 import click
-import requests
+
+if __name__ == '__main__':
+    # Helper modules import next_bus; run as a script, this module is the
+    # one they should share configuration with, not a second copy.
+    sys.modules.setdefault('next_bus', sys.modules[__name__])
 
 DEFAULT_HOST='http://svc.metrotransit.org'
 ROUTE_PATH='/NexTrip/Routes'
@@ -13,83 +27,1571 @@ DIR_PATH='/NexTrip/Directions/{route}'
 STOP_PATH='/NexTrip/Stops/{route}/{direction}'
 TIME_PATH='/NexTrip/{route}/{direction}/{stop}'
 
+CACHE_FILE=os.path.join(os.path.expanduser('~'), '.cache', 'next_bus', 'metadata.sqlite3')
+CACHE_TTL=7*24*60*60
+CACHE_MAX_ENTRIES=1024
+CACHE_VERSION=2
+CACHE_LOCK_TIMEOUT=1
+CATALOG_FILE=os.path.join(os.path.expanduser('~'), '.cache', 'next_bus', 'catalog.tsv')
+CATALOG_VERSION=1
+WARM_RATE=20
+RATE_FILE=os.path.join(os.path.expanduser('~'), '.cache', 'next_bus', 'rate.json')
+RATE_ALL='*'
+DEPARTURE_TTL=15
+
+REQUEST_TIMEOUT=10
+REQUEST_RETRIES=2
+RETRY_BACKOFF=0.25
+POOL_SIZE=10
+CONCURRENCY=8
+BREAKER_WINDOW=20
+BREAKER_MIN_CALLS=5
+BREAKER_ERROR_RATE=0.5
+BREAKER_SLOW=5.0
+BREAKER_COOLDOWN=30
+STALE_DEPARTURES=30*60
+BAD_GATEWAY=502
+UNAVAILABLE=503
+MATCH_INDEXES=64
+SUGGESTIONS=5
+SUGGESTION_CUTOFF=0.6
+TOKEN_PATTERN=re.compile(r'[a-z0-9]+')
+
+DATE_PATTERN=re.compile(r'Date\((\d+)')
+CHUNK_SIZE=8*1024
+SEPARATOR_PATTERN=re.compile(r'[\s,]*')
+DECODE_ERRORS=(ValueError, KeyError, TypeError, AttributeError)
+
+WATCH_NEAR=5*60
+WATCH_BACKOFF=4
+
+SERVE_BIND='127.0.0.1'
+SERVE_PORT=8642
+REPLAY_PORT=8643
+
+NEAR_RADIUS=800
+NEAR_STOPS=5
+
+OUTPUT_FORMATS=['text', 'json', 'ndjson', 'csv', 'msgpack']
+
+HISTORY_FLUSH=60
+
+ARCHIVE_MAX_AGE=5*60
+BATCH_CHUNK=10000
+
+metadata_cache = None
+metadata_catalog = None
+departure_cache = None
+response_recorder = None
+request_limiter = None
+departure_history = None
+http_session = None
+breakers = {}
+lookup_deadline = None
+session_state = threading.local()
+match_indexes = collections.OrderedDict()
+trace_hooks = []
+trace_state = threading.local()
+
 logging.basicConfig(format='%(message)s')
 
-@click.command()
+def service_options(command):
+    options = [
+        click.option('--date-time', '-d'),
+        click.option('--host', '-h', default=DEFAULT_HOST),
+        click.option('--cache-file', envvar='NEXT_BUS_CACHE', default=CACHE_FILE,
+                     help='Where to keep cached routes, directions and stops.'),
+        click.option('--catalog', 'catalog_file', envvar='NEXT_BUS_CATALOG', default=CATALOG_FILE,
+                     help='Routes, directions and stops saved by `warm`.'),
+        click.option('--cache-ttl', type=int, default=CACHE_TTL,
+                     help='Seconds before a cached entry is fetched again.'),
+        click.option('--refresh-cache', is_flag=True,
+                     help='Ignore cached entries and store fresh ones.'),
+        click.option('--no-cache', is_flag=True,
+                     help='Neither read nor write the metadata cache.'),
+        click.option('--departure-ttl', type=float, default=DEPARTURE_TTL,
+                     help='Seconds to reuse a departures response for the same stop.'),
+        click.option('--timeout', type=float, default=REQUEST_TIMEOUT,
+                     help='Seconds to wait on each request before giving up.'),
+        click.option('--retries', type=int, default=REQUEST_RETRIES,
+                     help='Times to retry a request that failed with a server error.'),
+        click.option('--timings', is_flag=True,
+                     help='Print how long each lookup stage took to stderr.'),
+        click.option('--trace', type=click.File('a'),
+                     help='Append a JSON line per lookup stage to this file.'),
+        click.option('--record', 'record_dir', type=click.Path(file_okay=False),
+                     help='Append every upstream response to the archive in this directory.'),
+        click.option('--history', 'history_dir', envvar='NEXT_BUS_HISTORY', type=click.Path(file_okay=False),
+                     help='Keep every departure polled in the history store in this directory.'),
+        click.option('--rate-limit', 'rate_limits', envvar='NEXT_BUS_RATE_LIMIT', multiple=True,
+                     metavar='[ENDPOINT=]RATE',
+                     help='Most requests per second from all next_bus processes on this host, '
+                          'in all or to one endpoint (Route, Direction, Stop or Time). Repeatable.'),
+        click.option('--rate-file', envvar='NEXT_BUS_RATE_FILE', default=RATE_FILE,
+                     help='Where processes keep the shared --rate-limit budget.'),
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
+def positive(ctx, param, value):
+    # Click 7's FloatRange can't exclude its minimum.
+    if value is not None and value <= 0:
+        raise click.BadParameter('{} is not a positive number.'.format(value))
+    return value
+
+
+def format_option(command):
+    return click.option('--format', 'output_format', type=click.Choice(OUTPUT_FORMATS), default='text',
+                        help='Print departures as text, or as records with full ids and epoch times.')(command)
+
+
+def record_writer(output_format, fields=None):
+    from output import DEPARTURE_FIELDS, RecordWriter
+    sys.stdout.flush()
+    return RecordWriter(sys.stdout.buffer, output_format, fields or DEPARTURE_FIELDS)
+
+
+def configure_service(cache_file, catalog_file, cache_ttl, refresh_cache, no_cache, departure_ttl,
+                      timeout, retries, timings, trace, record_dir, history_dir, rate_limits, rate_file,
+                      pool_size=POOL_SIZE):
+    try:
+        rates = parse_rate_limits(rate_limits)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--rate-limit')
+
+    if timings:
+        add_trace_hook(TimingsPrinter(sys.stderr))
+    if trace:
+        add_trace_hook(TraceWriter(trace))
+    if not no_cache:
+        use_cache(MetadataCache(cache_file, ttl=cache_ttl, refresh=refresh_cache))
+        if os.path.exists(catalog_file):
+            use_catalog(Catalog(catalog_file, refresh=refresh_cache, ttl=cache_ttl))
+    use_session(PooledSession(timeout=timeout, retries=retries, pool_size=pool_size))
+    use_departure_cache(DepartureCache(ttl=departure_ttl))
+    if record_dir:
+        from archive import Recorder
+        use_recorder(Recorder(record_dir))
+    if history_dir:
+        import atexit
+        from history import HistoryStore
+        use_history(HistoryStore(history_dir))
+        atexit.register(departure_history.close)
+    use_rate_limiter(SharedRateLimiter(rate_file, rates) if rates else None)
+
+
+def parse_rate_limits(specs):
+    # ['10', 'Time=5'] -> {'*': 10.0, 'Time': 5.0}
+    rates = {}
+    for spec in specs:
+        endpoint, _, rate = spec.rpartition('=')
+        endpoint = endpoint or RATE_ALL
+        if endpoint != RATE_ALL and endpoint not in RECORDS:
+            raise ValueError('Unknown endpoint "{}", expected one of {}'.format(endpoint, ', '.join(RECORDS)))
+        try:
+            rates[endpoint] = float(rate)
+        except ValueError:
+            raise ValueError('Expected [ENDPOINT=]RATE, got "{}"'.format(spec))
+        if rates[endpoint] <= 0:
+            raise ValueError('Rate must be positive, got "{}"'.format(spec))
+    return rates
+
+
+@click.command(epilog='Other commands: batch, board, history, near, replay, serve, warm (run `next_bus.py COMMAND --help`).')
 @click.argument('route')
 @click.argument('stop')
 @click.argument('direction')
-@click.option('--date-time', '-d')
-@click.option('--host', '-h', default=DEFAULT_HOST)
-def next_bus(route, stop, direction, date_time, host):
+@click.option('--watch', '-w', type=float, metavar='INTERVAL', callback=positive,
+              help='Keep polling every INTERVAL seconds, printing each change.')
+@click.option('--polls', type=click.IntRange(min=1), help='Stop watching after this many polls.')
+@click.option('--count', '-n', type=click.IntRange(min=1), default=1,
+              help='Show this many upcoming departures.')
+@click.option('--all', '-a', 'show_all', is_flag=True, help='Show every upcoming departure.')
+@click.option('--source', type=click.Choice(['nextrip', 'gtfs', 'gtfs-rt']), default='nextrip',
+              help='Ask the live NexTrip service, the GTFS schedule or a GTFS-Realtime feed.')
+@click.option('--gtfs', 'gtfs_path', envvar='NEXT_BUS_GTFS', type=click.Path(exists=True, dir_okay=False),
+              help='GTFS zip for --source gtfs and gtfs-rt, also used when the live service fails.')
+@click.option('--gtfs-rt', 'realtime_feed', envvar='NEXT_BUS_GTFS_RT', metavar='URL',
+              help='GTFS-Realtime TripUpdates URL or file for --source gtfs-rt.')
+@click.option('--latency-budget', type=float,
+              help='Seconds to wait on the live service before using the GTFS schedule.')
+@click.option('--deadline', type=float,
+              help='Seconds to spend on the service in all; after that, answer from stale cached data.')
+@click.option('--provider', '-P', 'provider_specs', multiple=True, metavar='NAME=URL',
+              help='Ask this NexTrip-style host (or NAME=gtfs:PATH schedule, or NAME=gtfs-rt:URL '
+                   'feed with --gtfs) instead of --host. Repeat to ask several agencies at once.')
+@format_option
+@service_options
+def next_bus(route, stop, direction, watch, polls, count, show_all, source, gtfs_path,
+             realtime_feed, latency_budget, deadline, provider_specs, output_format, date_time, host,
+             **service):
+    if watch and (show_all or count != 1):
+        raise click.UsageError('--watch follows only the next departure')
+    if watch and provider_specs:
+        raise click.UsageError('--watch follows a single --host')
+    if watch and source != 'nextrip':
+        raise click.UsageError('--watch follows the NexTrip service')
+    if watch and latency_budget is not None:
+        raise click.UsageError('--latency-budget applies to a single lookup, not --watch')
+    if source in ('gtfs', 'gtfs-rt') and not gtfs_path:
+        raise click.UsageError('--source {} needs --gtfs PATH'.format(source))
+    if source == 'gtfs-rt' and not realtime_feed:
+        raise click.UsageError('--source gtfs-rt needs --gtfs-rt URL')
+    if output_format != 'text' and (provider_specs or source != 'nextrip'):
+        raise click.UsageError('--format {} needs the NexTrip service and a single --host'.format(output_format))
+
+    configure_service(**service)
+    start_deadline(deadline)
+    limit = None if show_all else count
+
+    if provider_specs:
+        from providers import departures_from_all, parse_provider
+        try:
+            providers = [parse_provider(spec, gtfs_path=gtfs_path, timeout=service['timeout'],
+                                        retries=service['retries'])
+                         for spec in provider_specs]
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint='--provider')
+
+        answers = departures_from_all(providers, route, stop, direction, date_time, limit)
+        for name, departures in answers:
+            if departures is None:
+                print('{}\t-'.format(name))
+            elif show_all or count != 1:
+                for next_time, realtime in departures:
+                    print('{}\t{}\t{}'.format(name, next_time, 'realtime' if realtime else 'scheduled'))
+            else:
+                print('{}\t{}'.format(name, departures[0][0]))
+
+        if any(departures is None for _, departures in answers):
+            sys.exit(1)
+        return
+
+    if source == 'gtfs':
+        departures = schedule_departures(gtfs_path, route, stop, direction, date_time, limit)
+    elif source == 'gtfs-rt':
+        departures = realtime_departures(gtfs_path, realtime_feed, route, stop, direction, date_time, limit)
+    elif watch:
+        details = resolve_query(route, stop, direction, host)
+        if details is None:
+            sys.exit(1)
+
+        if output_format != 'text':
+            with record_writer(output_format) as writer:
+                for _, times, stale in watch_next_time(date_time, *details, time_url=host + TIME_PATH,
+                                                       interval=watch, polls=polls, detailed=True,
+                                                       deadline=deadline):
+                    writer.write_records(departure_records(details, times, date_time, stale))
+                    writer.flush()
+            return
+
+        for next_time in watch_next_time(date_time, *details, time_url=host + TIME_PATH,
+                                         interval=watch, polls=polls, deadline=deadline):
+            print(next_time, flush=True)
+        return
+    elif output_format != 'text':
+        records = within_budget(latency_budget, live_records, route, stop, direction,
+                                date_time, host, limit)
+        if records is None and gtfs_path:
+            logging.warning('WARNING: Answering from the GTFS schedule')
+            departures = schedule_departures(gtfs_path, route, stop, direction, date_time, limit)
+            records = departures and query_records((route, stop, direction), departures)
+        if records is None:
+            sys.exit(1)
+
+        with record_writer(output_format) as writer:
+            writer.write_records(records)
+        return
+    else:
+        departures = within_budget(latency_budget, live_departures, route, stop, direction,
+                                   date_time, host, limit)
+        if departures is None and gtfs_path:
+            logging.warning('WARNING: Answering from the GTFS schedule')
+            departures = schedule_departures(gtfs_path, route, stop, direction, date_time, limit)
+
+    if departures is None:
+        sys.exit(1)
+
+    if show_all or count != 1:
+        for next_time, realtime in departures:
+            print('{}\t{}'.format(next_time, 'realtime' if realtime else 'scheduled'))
+    else:
+        print(departures[0][0])
+
+
+def resolve_query(route, stop, direction, host):
     route_details = lookup_route(route, host + ROUTE_PATH)
 
     if route_details is None:
-        sys.exit(1)
+        return None
 
     direction_details = lookup_direction(direction, route_details, host + DIR_PATH)
 
     if direction_details is None:
-        sys.exit(1)
+        return None
 
     stop_details = lookup_stop(stop, route_details, direction_details, host + STOP_PATH)
 
     if stop_details is None:
+        return None
+
+    return route_details, direction_details, stop_details
+
+
+def live_departures(route, stop, direction, date_time, host, count=1):
+    details = resolve_query(route, stop, direction, host)
+    if details is None:
+        return None
+
+    return lookup_departures(date_time, *details, time_url=host + TIME_PATH, count=count)
+
+
+def live_records(route, stop, direction, date_time, host, count=1):
+    # Like live_departures, but as records for --format.
+    details = resolve_query(route, stop, direction, host)
+    if details is None:
+        return None
+
+    route_details, direction_details, stop_details = details
+    times, stale = fetch_aged_departures(host + TIME_PATH.format(route=route_details.route,
+                                                                 direction=direction_details.value,
+                                                                 stop=stop_details.value),
+                                         date_time, limit=count)
+    return departure_records(details, times, date_time, stale)
+
+
+def schedule_departures(gtfs_path, route, stop, direction, date_time, count=1):
+    import gtfs
+    schedule = gtfs.Schedule.load(gtfs_path)
+    if schedule is None:
+        return None
+    return schedule.departures(route, stop, direction, date_time, count)
+
+
+def realtime_departures(gtfs_path, feed, route, stop, direction, date_time, count=1):
+    import gtfs
+    schedule = gtfs.Schedule.load(gtfs_path)
+    if schedule is None:
+        return None
+    realtime = gtfs.Realtime(schedule, feed)
+    return realtime.departures(route, stop, direction, date_time, count)
+
+
+def within_budget(budget, fn, *args):
+    # Gives up on fn after `budget` seconds. The worker is a daemon thread so
+    # a stuck request can't keep the process alive once we've answered.
+    if budget is None:
+        return fn(*args)
+
+    result = []
+    worker = threading.Thread(target=lambda: result.append(fn(*args)), daemon=True)
+    worker.start()
+    worker.join(budget)
+    if worker.is_alive():
+        logging.error('ERROR: No answer within {} seconds'.format(budget))
+        return None
+
+    return result[0]
+
+
+@click.command()
+@click.argument('queries', type=click.File('r'), default='-')
+@click.option('--concurrency', '-c', type=int, default=CONCURRENCY,
+              help='Most requests to have in flight at once.')
+@format_option
+@service_options
+def board(queries, concurrency, output_format, date_time, host, **service):
+    """Look up many departures at once.
+
+    Reads one ROUTE,STOP,DIRECTION query per line of QUERIES (or stdin) and
+    prints each query followed by its next departure.
+    """
+    import csv
+    configure_service(pool_size=concurrency, **service)
+
+    parsed = [tuple(row) for row in csv.reader(queries)
+              if row and not row[0].startswith('#')]
+    if any(len(query) != 3 for query in parsed):
+        logging.error('ERROR: Queries must be ROUTE,STOP,DIRECTION')
+        sys.exit(1)
+
+    import asyncio
+    results = asyncio.run(next_bus_many(parsed, date_time=date_time, host=host,
+                                        concurrency=concurrency, detailed=output_format != 'text'))
+
+    if output_format != 'text':
+        with record_writer(output_format) as writer:
+            for query, records in zip(parsed, results):
+                writer.write_records(records or query_records(query, [(None, None)]))
+    else:
+        for query, next_time in zip(parsed, results):
+            print('\t'.join(query + (next_time or '-',)))
+
+    if None in results:
+        sys.exit(1)
+
+
+@click.command(context_settings={'ignore_unknown_options': True})
+@click.argument('lat', type=float)
+@click.argument('lon', type=float)
+@click.option('--radius', '-r', type=float, default=NEAR_RADIUS, help='Metres to look for stops within.')
+@click.option('--stops', '-k', 'stop_count', type=int, default=NEAR_STOPS,
+              help='How many of the nearest stops to ask about.')
+@click.option('--gtfs', 'gtfs_path', envvar='NEXT_BUS_GTFS', required=True,
+              type=click.Path(exists=True, dir_okay=False), help='GTFS zip with the stop positions.')
+@click.option('--gtfs-rt', 'realtime_feed', envvar='NEXT_BUS_GTFS_RT', metavar='URL',
+              help='GTFS-Realtime TripUpdates URL or file for predicted departures.')
+@click.option('--date-time', '-d')
+def near(lat, lon, radius, stop_count, gtfs_path, realtime_feed, date_time):
+    """List departures from the stops nearest LAT LON.
+
+    Prints the next departure of every route and direction at the nearest
+    stops, soonest first, leaving out buses that will be gone before you can
+    walk to the stop.
+    """
+    import gtfs
+    schedule = gtfs.Schedule.load(gtfs_path)
+    if schedule is None:
+        sys.exit(1)
+    if realtime_feed:
+        departures = gtfs.Realtime(schedule, realtime_feed).nearby(lat, lon, radius, stop_count, date_time)
+    else:
+        departures = schedule.nearby(lat, lon, radius, stop_count, date_time)
+
+    if not departures:
+        logging.error('ERROR: No departures within {:g} m'.format(radius))
+        sys.exit(1)
+
+    now = int(date_time) if date_time else int(time.time()) * 1000
+    for epoch, realtime, route, direction, stop, metres in departures:
+        print('\t'.join((minutes_to_departure([epoch * 1000], now)[0], route.description, direction,
+                         stop.text, '{:.0f} m'.format(metres))))
+
+
+@click.command()
+@click.option('--bind', '-b', default=SERVE_BIND, help='Address to listen on.')
+@click.option('--port', '-p', type=int, default=SERVE_PORT, help='Port to listen on.')
+@click.option('--socket', '-s', 'socket_path', type=click.Path(),
+              help='Listen on this Unix socket instead of a TCP port.')
+@click.option('--gtfs', 'gtfs_path', envvar='NEXT_BUS_GTFS', type=click.Path(exists=True, dir_okay=False),
+              help='GTFS zip with the route and stop names for --gtfs-rt.')
+@click.option('--gtfs-rt', 'realtime_feed', envvar='NEXT_BUS_GTFS_RT', metavar='URL',
+              help='Answer from this GTFS-Realtime TripUpdates URL or file instead of --host.')
+@service_options
+def serve(bind, port, socket_path, gtfs_path, realtime_feed, date_time, host, **service):
+    """Answer departure queries over HTTP.
+
+    Keeps resolved routes, directions and stops plus upstream connections
+    warm between queries. Ask with
+    GET /next?route=ROUTE&stop=STOP&direction=DIRECTION, adding format=json
+    (or an Accept: application/json header) for a JSON answer.
+    """
+    from server import DepartureService, DepartureServer, NextBusHandler, UnixDepartureServer
+
+    if realtime_feed and not gtfs_path:
+        raise click.UsageError('--gtfs-rt needs --gtfs PATH')
+
+    configure_service(**service)
+    provider = None
+    if realtime_feed:
+        from providers import RealtimeProvider
+        provider = RealtimeProvider('gtfs-rt', realtime_feed, gtfs_path)
+    service = DepartureService(host, date_time=date_time, ttl=service['cache_ttl'], provider=provider)
+
+    if socket_path:
+        if os.path.exists(socket_path):
+            if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+                raise click.UsageError('{} exists and is not a socket'.format(socket_path))
+            os.remove(socket_path)
+        server = UnixDepartureServer(socket_path, NextBusHandler)
+        click.echo('Listening on {}'.format(socket_path), err=True)
+    else:
+        server = DepartureServer((bind, port), NextBusHandler)
+        click.echo('Listening on http://{}:{}'.format(*server.server_address[:2]), err=True)
+    server.service = service
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+@click.command()
+@click.option('--concurrency', '-c', type=int, default=CONCURRENCY, help='Requests to run at once.')
+@click.option('--rate', type=float, default=WARM_RATE, help='Most requests to start per second.')
+@click.option('--full', is_flag=True,
+              help='Fetch every stop list again, not only those of changed routes.')
+@service_options
+def warm(concurrency, rate, full, date_time, host, **service):
+    """Save every route, direction and stop to the catalog.
+
+    Later lookups resolve routes, directions and stops from the catalog
+    without any requests. Running warm again revalidates the saved
+    responses and only fetches the stop lists of routes whose directions
+    changed.
+    """
+    configure_service(pool_size=concurrency, **service)
+
+    stats = warm_catalog(Catalog(service['catalog_file']), host, concurrency=concurrency,
+                         rate=rate, full=full)
+    if stats is None:
+        sys.exit(1)
+
+    click.echo('Catalog: {routes} routes, {stops} stops ({requests} requests, {changed} changed, '
+               '{failed} failed)'.format(**stats), err=True)
+    if stats['failed']:
         sys.exit(1)
 
-    next_time = lookup_next_time(date_time, route_details, direction_details, stop_details, host + TIME_PATH)
 
-    if next_time is None:
+@click.command()
+@click.argument('archive_path', metavar='ARCHIVE', type=click.Path(exists=True, file_okay=False))
+@click.argument('queries', type=click.File('r'), default='-')
+@click.option('--output', '-o', type=click.File('w'), default='-', help='Where to write the results.')
+@click.option('--processes', '-j', type=int, help='Worker processes (default: one per core).')
+@click.option('--chunk-size', type=int, default=BATCH_CHUNK, help='Queries handed to a worker at once.')
+@click.option('--max-age', type=float, default=ARCHIVE_MAX_AGE,
+              help='Seconds an archived departures response answers for.')
+@click.option('--host', '-h', default=DEFAULT_HOST, help='Host the archive was recorded from.')
+def batch(archive_path, queries, output, processes, chunk_size, max_age, host):
+    """Answer logged queries from a response archive.
+
+    Reads one ROUTE,STOP,DIRECTION,DATE_TIME query per line of QUERIES (or
+    stdin), with DATE_TIME in milliseconds since the epoch, and writes each
+    query with the next departure the archived responses gave at that time,
+    or - when they can't say.
+    """
+    import csv
+    from archive import run_batch
+
+    rows = (row for row in csv.reader(queries) if row and not row[0].startswith('#'))
+    total, answered = run_batch(archive_path, rows, output, host, processes=processes,
+                                chunk_size=chunk_size, max_age=max_age)
+    click.echo('{} queries, {} answered'.format(total, answered), err=True)
+
+
+@click.command()
+@click.argument('history_dir', metavar='HISTORY', type=click.Path(exists=True, file_okay=False))
+@click.option('--since', type=click.DateTime(['%Y-%m-%d']), help='First day (UTC) to include.')
+@click.option('--until', type=click.DateTime(['%Y-%m-%d']), help='Day (UTC) to stop before.')
+@click.option('--stop', 'stop_prefix', metavar='ROUTE/DIRECTION/STOP',
+              help='Only stops whose key starts with this, such as 5/1/ or 5/1/BCTC.')
+@format_option
+def history(history_dir, since, until, stop_prefix, output_format):
+    """Report prediction accuracy and headways from a history store.
+
+    For every stop polled with --history, prints how many departures were
+    seen, the mean, mean absolute and 90th percentile error (seconds) of
+    realtime predictions against when the bus left, and the mean headway
+    and wait (minutes) for someone turning up at random.
+    """
+    import calendar
+    from history import STATS_FIELDS, HistoryStore, stop_stats
+    since, until = [day and calendar.timegm(day.timetuple()) * 1000 for day in (since, until)]
+
+    stats = stop_stats(*HistoryStore(history_dir).read(since, until, stop_prefix))
+    if not stats:
+        logging.error('ERROR: No departures in the history')
         sys.exit(1)
 
-    print(next_time)
+    if output_format != 'text':
+        with record_writer(output_format, STATS_FIELDS) as writer:
+            writer.write_records(stats)
+        return
+
+    print('\t'.join(STATS_FIELDS))
+    for row in stats:
+        print('\t'.join('-' if row[field] is None else str(row[field]) for field in STATS_FIELDS))
+
+
+@click.command()
+@click.argument('archive_path', metavar='ARCHIVE', type=click.Path(exists=True, file_okay=False))
+@click.option('--bind', '-b', default=SERVE_BIND, help='Address to listen on.')
+@click.option('--port', '-p', type=int, default=REPLAY_PORT, help='Port to listen on.')
+@click.option('--latency-scale', type=float, default=1.0,
+              help='Multiply recorded response times by this (0 answers at once).')
+def replay(archive_path, bind, port, latency_scale):
+    """Serve responses saved with --record.
+
+    Stands in for the upstream service: each path is answered with the
+    responses recorded for it, in turn, taking as long as they originally
+    took (scaled by --latency-scale). Point other commands at it with -h.
+    """
+    from archive import ResponseLog
+    from server import ReplayServer
+
+    responses = ResponseLog(archive_path)
+    server = ReplayServer((bind, port), responses, latency_scale)
+    click.echo('Replaying {} responses on http://{}:{}'.format(len(responses), *server.server_address[:2]),
+               err=True)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+class MetadataCache(object):
+    # Routes, directions and stops change a few times a year, so their
+    # responses are kept on disk between invocations. Entries are keyed by
+    # the full request URL (host and path), expire after `ttl` seconds and
+    # the least recently used ones are evicted beyond `max_entries`. Hits
+    # are only noted in memory and written with the next put, so processes
+    # reading the cache don't queue for its write lock. The cache is only
+    # an optimisation: if the file can't be used (unwritable, corrupt,
+    # locked for too long), a warning is logged and lookups go uncached.
+
+    def __init__(self, path, ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES, refresh=False):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        self.decoded = {}
+        self.used = {}
+        self.db = None
+
+        # sqlite3 is only imported where the cache is used, like the other
+        # modules that would slow down `--help`.
+        import sqlite3
+        try:
+            if path != ':memory:' and os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.db = sqlite3.connect(path, timeout=CACHE_LOCK_TIMEOUT, check_same_thread=False)
+            with self.db:
+                # Entries are stored as record rows; older layouts are dropped.
+                if self.db.execute('PRAGMA user_version').fetchone()[0] != CACHE_VERSION:
+                    self.db.execute('DROP TABLE IF EXISTS entries')
+                    self.db.execute('PRAGMA user_version = {}'.format(CACHE_VERSION))
+                self.db.execute('CREATE TABLE IF NOT EXISTS entries ('
+                                'url TEXT PRIMARY KEY, body TEXT, stored REAL, used REAL)')
+        except (sqlite3.Error, OSError) as e:
+            self.disable(e)
+
+    def disable(self, error):
+        logging.warning('WARNING: Not using the metadata cache: {}'.format(error))
+        if self.db is not None:
+            self.db.close()
+        self.db = None
+
+    def get(self, url, record=None):
+        if self.refresh or self.db is None:
+            return None
+
+        import sqlite3
+        now = time.time()
+        with self.lock:
+            try:
+                row = self.db.execute('SELECT body, stored FROM entries WHERE url = ?',
+                                      (url,)).fetchone()
+            except sqlite3.Error as e:
+                self.disable(e)
+                return None
+            if row is None or now - row[1] > self.ttl:
+                return None
+            self.used[url] = now
+
+            # Hand back the same decoded object while the entry is unchanged,
+            # so indexes built over it can be reused.
+            decoded = self.decoded.get(url)
+            if decoded is None or decoded[0] != row[1]:
+                decoded = self.decoded[url] = (row[1], decode_rows(row[0], record))
+
+        return decoded[1]
+
+    def stale(self, url, record=None):
+        # The entry however old it is, and its age in seconds, for when the
+        # service can't be asked.
+        if self.db is None:
+            return None
+        import sqlite3
+        with self.lock:
+            try:
+                row = self.db.execute('SELECT body, stored FROM entries WHERE url = ?',
+                                      (url,)).fetchone()
+            except sqlite3.Error as e:
+                self.disable(e)
+                return None
+        if row is None:
+            return None
+        return decode_rows(row[0], record), time.time() - row[1]
+
+    def put(self, url, value):
+        if self.db is None:
+            return
+        import sqlite3
+        now = time.time()
+        with self.lock:
+            self.decoded.pop(url, None)
+            used, self.used = self.used, {}
+            try:
+                with self.db:
+                    self.db.executemany('UPDATE entries SET used = ? WHERE url = ?',
+                                        [(when, key) for key, when in used.items()])
+                    self.db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                                    (url, json.dumps(value), now, now))
+                    self.db.execute('DELETE FROM entries WHERE url NOT IN '
+                                    '(SELECT url FROM entries ORDER BY used DESC LIMIT ?)',
+                                    (self.max_entries,))
+            except sqlite3.Error as e:
+                self.disable(e)
+
+
+class Catalog(object):
+    # Every route, direction and stop list saved by `warm`, in one file: a
+    # version header, then a `url, etag, last modified, rows` line per
+    # response. Lookups answer from it without any requests, until it is
+    # `ttl` seconds old. Rows are only decoded when asked for.
+
+    def __init__(self, path, refresh=False, ttl=None):
+        self.path = path
+        self.refresh = refresh
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.loaded = None
+        self.saved = 0
+        self.decoded = {}
+
+    def entries(self):
+        with self.lock:
+            if self.loaded is None:
+                self.loaded = self.load()
+            return self.loaded
+
+    def load(self):
+        entries = {}
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                header = json.loads(f.readline())
+                if header.get('version') != CATALOG_VERSION:
+                    return {}
+                self.saved = header.get('saved', 0)
+                for line in f:
+                    url, etag, modified, body = line.rstrip('\n').split('\t')
+                    entries[url] = (etag, modified, body)
+        except (OSError, ValueError):
+            return {}
+        return entries
+
+    def get(self, url, record=None):
+        if self.refresh:
+            return None
+
+        entry = self.entries().get(url)
+        if entry is None:
+            return None
+        # A stale catalog is a miss, so the TTL'd cache and service answer.
+        if self.ttl is not None and time.time() - self.saved > self.ttl:
+            return None
+        with self.lock:
+            if url not in self.decoded:
+                self.decoded[url] = decode_rows(entry[2], record)
+            return self.decoded[url]
+
+    def save(self, entries):
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        partial = self.path + '.partial'
+        with open(partial, 'w', encoding='utf-8') as f:
+            saved = time.time()
+            f.write(json.dumps({'version': CATALOG_VERSION, 'saved': saved}) + '\n')
+            for url in sorted(entries):
+                f.write('\t'.join((url,) + tuple(entries[url])) + '\n')
+        os.replace(partial, self.path)
+
+        with self.lock:
+            self.loaded = entries
+            self.saved = saved
+            self.decoded = {}
+
+    def append(self, url, entry):
+        # Adds one entry in a single write to the end of the file, which is
+        # started if need be; a later line for a URL replaces earlier ones.
+        # Several processes can append to one catalog.
+        line = '\t'.join((url,) + tuple(entry)) + '\n'
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        try:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_EXCL, 0o644)
+            line = json.dumps({'version': CATALOG_VERSION, 'saved': time.time()}) + '\n' + line
+        except FileExistsError:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        try:
+            os.write(fd, line.encode('utf-8'))
+        finally:
+            os.close(fd)
+
+        with self.lock:
+            if self.loaded is not None:
+                self.loaded[url] = entry
+            self.decoded.pop(url, None)
+
+
+def decode_rows(body, record=None):
+    rows = json.loads(body)
+    if record is not None:
+        rows = [record(*fields) for fields in rows]
+    return rows
+
+
+def use_catalog(catalog):
+    global metadata_catalog
+    metadata_catalog = catalog
+
+
+def use_recorder(recorder):
+    global response_recorder
+    response_recorder = recorder
+
+
+def use_history(store):
+    global departure_history
+    departure_history = store
+
+
+def use_cache(cache):
+    global metadata_cache
+    metadata_cache = cache
+
+
+class PooledSession(object):
+    # One keep-alive connection pool shared by every request, so the lookups
+    # in a query reuse a single TCP/TLS connection. Server errors and
+    # connection failures are retried with jittered exponential backoff.
+
+    def __init__(self, timeout=REQUEST_TIMEOUT, retries=REQUEST_RETRIES,
+                 backoff=RETRY_BACKOFF, pool_size=POOL_SIZE):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+        import requests
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, url, **kwargs):
+        # Near the lookup deadline, timeouts shrink to the time left and
+        # failed requests aren't retried.
+        import requests
+        attempt = 0
+        while True:
+            left = time_left()
+            timeout = self.timeout if left is None else max(min(self.timeout, left), 0.001)
+            try:
+                r = self.session.get(url, timeout=timeout, **kwargs)
+                if r.status_code < 500 or not self.may_retry(attempt):
+                    return r
+                r.close()
+            except requests.Timeout:
+                raise
+            except requests.ConnectionError:
+                if not self.may_retry(attempt):
+                    raise
+            delay = random.uniform(0, self.backoff * 2 ** attempt)
+            left = time_left()
+            time.sleep(delay if left is None else max(min(delay, left), 0))
+            attempt += 1
+            annotate(retries=attempt)
+
+    def may_retry(self, attempt):
+        left = time_left()
+        return attempt < self.retries and (left is None or left > 0)
+
+
+class CircuitBreaker(object):
+    # Watches the last `window` calls to one endpoint. Once `error_rate` of
+    # them failed (couldn't connect, timed out, server error) or took more
+    # than `slow` seconds, the breaker trips: calls are refused straight
+    # away for `cooldown` seconds rather than piling more timeouts onto a
+    # struggling service. Then a single trial call is let through, and its
+    # outcome closes the breaker or trips it again.
+
+    def __init__(self, window=BREAKER_WINDOW, min_calls=BREAKER_MIN_CALLS, error_rate=BREAKER_ERROR_RATE,
+                 slow=BREAKER_SLOW, cooldown=BREAKER_COOLDOWN):
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow = slow
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.calls = collections.deque(maxlen=window)
+        self.opened = None
+        self.trial = False
+
+    @property
+    def state(self):
+        if self.opened is None:
+            return 'closed'
+        return 'half-open' if self.trial else 'open'
+
+    def allow(self):
+        with self.lock:
+            if self.opened is None:
+                return True
+            if self.trial or time.monotonic() - self.opened < self.cooldown:
+                return False
+            self.trial = True
+            return True
+
+    def record(self, ok, seconds):
+        failed = not ok or seconds > self.slow
+        with self.lock:
+            if self.trial:
+                self.trial = False
+                if failed:
+                    self.opened = time.monotonic()
+                    return
+                self.opened = None
+                self.calls.clear()
+
+            self.calls.append(failed)
+            if (self.opened is None and len(self.calls) >= self.min_calls and
+                    sum(self.calls) >= self.error_rate * len(self.calls)):
+                self.opened = time.monotonic()
+
+
+def get_breaker(url, endpoint_name):
+    # One breaker per endpoint of each host.
+    key = (url.partition('//')[2].partition('/')[0], endpoint_name)
+    breaker = breakers.get(key)
+    if breaker is None:
+        breaker = breakers.setdefault(key, CircuitBreaker())
+    return breaker
+
+
+def start_deadline(seconds):
+    # Requests made from now on give up `seconds` from now; None lifts the
+    # deadline.
+    global lookup_deadline
+    lookup_deadline = None if seconds is None else time.monotonic() + seconds
+
+
+def time_left():
+    if lookup_deadline is None:
+        return None
+    return lookup_deadline - time.monotonic()
+
+
+class RateLimiter(object):
+    # Spaces out calls from any number of threads so that at most `rate`
+    # start per second.
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next = 0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next)
+            self.next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class SharedRateLimiter(object):
+    # Token buckets kept in a file, so that every process on the host using
+    # the same `path` draws on one budget. `rates` maps endpoint names, and
+    # RATE_ALL for every request, to requests per second; each bucket holds
+    # up to a second's worth. A caller takes its tokens under an exclusive
+    # flock, letting buckets go into debt, then sleeps until its tokens are
+    # due, so callers queue in turn rather than failing.
 
+    def __init__(self, path, rates):
+        self.path = path
+        self.rates = rates
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
 
-def make_request(url, endpoint_name):
-    r = requests.get(url,
-                     headers={'Accept': 'application/json'})
+    def acquire(self, endpoint_name, max_wait=None):
+        # Returns the seconds waited, or None without taking any tokens when
+        # they wouldn't be due within `max_wait` seconds.
+        keys = [key for key in (RATE_ALL, endpoint_name) if key in self.rates]
+        if not keys:
+            return 0
 
-    if r.status_code != 200:
-        logging.error('ERROR: {} endpoint misbehaved'.format(endpoint_name))
+        import fcntl
+        with os.fdopen(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644), 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                buckets = json.loads(f.read() or '{}')
+            except ValueError:
+                buckets = {}
+
+            now = time.time()
+            wait = 0
+            for key in keys:
+                rate = self.rates[key]
+                tokens, updated = buckets.get(key, (max(rate, 1), now))
+                tokens = min(tokens + (now - updated) * rate, max(rate, 1)) - 1
+                buckets[key] = (tokens, now)
+                wait = max(wait, -tokens / rate)
+
+            if max_wait is not None and wait > max_wait:
+                return None
+
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(buckets))
+            # Closing the file releases the lock.
+
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+def use_rate_limiter(limiter):
+    global request_limiter
+    request_limiter = limiter
+
+
+def use_session(session):
+    global http_session
+    http_session = session
+
+
+def get_session():
+    session = getattr(session_state, 'session', None)
+    if session is not None:
+        return session
+    if http_session is None:
+        use_session(PooledSession())
+    return http_session
+
+
+def call_with_session(session, fn, *args):
+    # Sends the requests fn makes on this thread through `session` instead
+    # of the shared one.
+    previous = getattr(session_state, 'session', None)
+    session_state.session = session
+    try:
+        return fn(*args)
+    finally:
+        session_state.session = previous
+
+
+def add_trace_hook(hook):
+    trace_hooks.append(hook)
+
+
+def remove_trace_hook(hook):
+    trace_hooks.remove(hook)
+
+
+def traced(stage):
+    # Reports each call of the decorated function to every trace hook as a
+    # dict with its stage, name, wall time and whatever the call annotated.
+    # Costs nothing beyond a list check while no hooks are registered.
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not trace_hooks:
+                return fn(*args, **kwargs)
+
+            event = {'stage': stage}
+            parent = getattr(trace_state, 'event', None)
+            trace_state.event = event
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                event['seconds'] = time.perf_counter() - start
+                event['time'] = time.time()
+                trace_state.event = parent
+                for hook in list(trace_hooks):
+                    hook(event)
+        return wrapper
+    return decorate
+
+
+def annotate(**fields):
+    event = getattr(trace_state, 'event', None)
+    if event is not None:
+        event.update(fields)
+
+
+class TimingsPrinter(object):
+
+    def __init__(self, out):
+        self.out = out
+        self.lock = threading.Lock()
+
+    def __call__(self, event):
+        details = ' '.join('{}={}'.format(key, event[key])
+                           for key in ('status', 'bytes', 'cache', 'retries') if key in event)
+        line = '{:<18} {:<10} {:8.1f} ms  {}'.format(event['stage'], event.get('name', ''),
+                                                    event['seconds'] * 1000, details)
+        with self.lock:
+            print(line.rstrip(), file=self.out, flush=True)
+
+
+class TraceWriter(object):
+
+    def __init__(self, out):
+        self.out = out
+        self.lock = threading.Lock()
+
+    def __call__(self, event):
+        line = json.dumps(event, sort_keys=True)
+        with self.lock:
+            self.out.write(line + '\n')
+            self.out.flush()
+
+
+class Route(collections.namedtuple('Route', 'description route')):
+    # Endpoint items are kept as small tuples of the fields next_bus uses
+    # instead of the decoded JSON objects.
+    __slots__ = ()
+
+    @classmethod
+    def from_json(cls, item):
+        return cls(item['Description'], item['Route'])
+
+    def to_json(self):
+        return {'Description': self.description, 'Route': self.route}
+
+
+class Direction(collections.namedtuple('Direction', 'text value')):
+    __slots__ = ()
+
+    @classmethod
+    def from_json(cls, item):
+        return cls(item['Text'], item['Value'])
+
+    def to_json(self):
+        return {'Text': self.text, 'Value': self.value}
+
+
+class Stop(collections.namedtuple('Stop', 'text value')):
+    __slots__ = ()
+
+    @classmethod
+    def from_json(cls, item):
+        return cls(item['Text'], item['Value'])
+
+    def to_json(self):
+        return {'Text': self.text, 'Value': self.value}
+
+
+class Departure(collections.namedtuple('Departure', 'text actual time block')):
+    # `time` is the departure time in milliseconds since the epoch, parsed
+    # once from the /Date(...)/ string. `block` is the vehicle block
+    # running the trip, when known.
+    __slots__ = ()
+
+    def __new__(cls, text, actual, time, block=None):
+        return super(Departure, cls).__new__(cls, text, actual, time, block)
+
+    @classmethod
+    def from_json(cls, item):
+        return cls(item['DepartureText'], item['Actual'], int(extract_date_time(item['DepartureTime'])),
+                   item.get('BlockNumber'))
+
+
+RECORDS={
+    'Route': Route,
+    'Direction': Direction,
+    'Stop': Stop,
+    'Time': Departure,
+}
+
+
+@traced('make_request')
+def make_request(url, endpoint_name, cache=None, limit=None):
+    # Returns the endpoint's items as RECORDS. With a `limit`, decoding
+    # stops after that many items.
+    annotate(name=endpoint_name, url=url)
+    record = RECORDS.get(endpoint_name)
+    if metadata_catalog is not None:
+        cataloged = metadata_catalog.get(url, record)
+        if cataloged is not None:
+            annotate(cache='catalog')
+            if response_recorder is not None:
+                response_recorder.record_records(url, endpoint_name, cataloged)
+            return cataloged
+
+    if cache is not None:
+        cached = cache.get(url, record)
+        annotate(cache='miss' if cached is None else 'hit')
+        if cached is not None:
+            if response_recorder is not None:
+                response_recorder.record_records(url, endpoint_name, cached)
+            return cached
+
+    left = time_left()
+    if left is not None and left <= 0:
+        logging.error('ERROR: Out of time before asking the {} endpoint'.format(endpoint_name))
+        return stale_response(url, endpoint_name, cache, UNAVAILABLE)
+
+    if request_limiter is not None:
+        waited = request_limiter.acquire(endpoint_name, left)
+        if waited is None:
+            logging.error('ERROR: Out of time waiting to ask the {} endpoint'.format(endpoint_name))
+            return stale_response(url, endpoint_name, cache, UNAVAILABLE)
+        if waited:
+            annotate(rate_wait=round(waited, 3))
+
+    breaker = get_breaker(url, endpoint_name)
+    if not breaker.allow():
+        annotate(breaker=breaker.state)
+        logging.error('ERROR: {} endpoint is failing, not asking it for now'.format(endpoint_name))
+        return stale_response(url, endpoint_name, cache, UNAVAILABLE)
+
+    # Modules that are slow to import (requests, asyncio, difflib, the HTTP
+    # server) are imported where they are used, so that --help and cached
+    # answers don't pay for them.
+    import requests
+    start = time.perf_counter()
+    try:
+        r = get_session().get(url, stream=True,
+                              headers={'Accept': 'application/json'})
+    except requests.RequestException:
+        breaker.record(False, time.perf_counter() - start)
+        logging.error('ERROR: {} endpoint unreachable'.format(endpoint_name))
+        return stale_response(url, endpoint_name, cache)
+    breaker.record(r.status_code < 500, time.perf_counter() - start)
+
+    recorder = response_recorder
+    body = [] if recorder is not None else None
+    # The history keeps every departure, not just the ones asked for.
+    history_store = departure_history if endpoint_name == 'Time' else None
+    with r:
+        annotate(status=r.status_code, server_seconds=r.elapsed.total_seconds())
+        if r.status_code != 200:
+            if recorder is not None:
+                recorder.record(url, endpoint_name, r.status_code, r.elapsed.total_seconds(), r.content)
+            logging.error('ERROR: {} endpoint misbehaved'.format(endpoint_name))
+            if r.status_code < 500:
+                session_state.upstream_failure = BAD_GATEWAY
+                return None
+            return stale_response(url, endpoint_name, cache)
+
+        start = time.perf_counter()
+        try:
+            result, received = read_records(r, record, None if history_store is not None else limit, body)
+        except DECODE_ERRORS + (requests.RequestException,):
+            logging.error('ERROR: {} endpoint misbehaved'.format(endpoint_name))
+            return stale_response(url, endpoint_name, cache)
+        finally:
+            if recorder is not None:
+                recorder.record(url, endpoint_name, r.status_code, r.elapsed.total_seconds(), b''.join(body))
+        annotate(decode_seconds=time.perf_counter() - start, bytes=received)
+
+    if history_store is not None:
+        history_store.add(url, result)
+        result = result[:limit]
+
+    if cache is not None and limit is None:
+        cache.put(url, result)
+
+    return result
+
+
+def stale_response(url, endpoint_name, cache, failure=BAD_GATEWAY):
+    # An expired cached response, when there is one, in place of a fresh
+    # one. Answers built from it are flagged on stderr. The `failure` is
+    # what upstream_failure() reports if nothing better comes along.
+    session_state.upstream_failure = failure
+    stale = cache.stale(url, RECORDS.get(endpoint_name)) if cache is not None else None
+    if stale is None:
         return None
 
-    return r.json()
+    result, age = stale
+    annotate(stale=round(age))
+    logging.warning('WARNING: Using stale {} data from {} seconds ago'.format(endpoint_name, int(age)))
+    return result
+
+
+def clear_upstream_failure():
+    session_state.upstream_failure = None
+
+
+def upstream_failure():
+    # The HTTP status that best describes why the service last failed this
+    # thread since clear_upstream_failure(): UNAVAILABLE when it couldn't
+    # be asked (open breaker, out of time), BAD_GATEWAY when it answered
+    # badly or not at all. None if it hasn't failed.
+    return getattr(session_state, 'upstream_failure', None)
+
 
+def read_records(r, record=None, limit=None, body=None):
+    # Decodes the JSON array of a streamed response into `record`s,
+    # returning them and the number of bytes received. The raw chunks are
+    # also appended to `body`, if given.
+    received = 0
+    decoder = codecs.getincrementaldecoder(r.encoding or 'utf-8')()
 
+    def raw():
+        for chunk in r.iter_content(CHUNK_SIZE):
+            if body is not None:
+                body.append(chunk)
+            yield chunk
+
+    raw_chunks = raw()
+
+    def chunks():
+        nonlocal received
+        for chunk in raw_chunks:
+            received += len(chunk)
+            yield decoder.decode(chunk)
+
+    items = iter_json_array(chunks())
+    if record is not None:
+        items = map(record.from_json, items)
+    result = list(itertools.islice(items, limit))
+
+    # Skip over the rest of a cut short response, so the connection can go
+    # back to the pool.
+    for _ in raw_chunks:
+        pass
+
+    return result, received
+
+
+def iter_json_array(chunks):
+    # Yields the elements of a JSON array as its text arrives in `chunks`,
+    # so only one element is held in memory at a time.
+    decoder = json.JSONDecoder()
+    text = ''
+    pos = 0
+    opened = False
+
+    for chunk in chunks:
+        text = text[pos:] + chunk
+        pos = 0
+        while True:
+            pos = SEPARATOR_PATTERN.match(text, pos).end()
+            if pos == len(text):
+                break
+            if not opened:
+                if text[pos] != '[':
+                    raise ValueError('Expected a JSON array')
+                opened = True
+                pos += 1
+                continue
+            if text[pos] == ']':
+                return
+            try:
+                item, end = decoder.raw_decode(text, pos)
+            except ValueError:
+                # The element continues in the next chunk.
+                break
+            yield item
+            pos = end
+
+    raise ValueError('Unterminated JSON array')
+
+
+@traced('fetch_first')
 def fetch_first(resource, resource_url, match_pattern, match_field, **kwargs):
-    result = make_request(resource_url.format(**kwargs), resource)
+    annotate(name=resource)
+    result = make_request(resource_url.format(**kwargs), resource, cache=metadata_cache)
+
+    start = time.perf_counter()
+    match = match_first(resource, result, match_pattern, match_field)
+    annotate(match_seconds=time.perf_counter() - start)
+    return match
+
+
+def match_first(resource, result, match_pattern, match_field):
     if result is None:
         return result
 
-    items = [item for item in result if match_pattern.lower() in item[match_field].lower()]
+    index = match_index(result, match_field)
+    items = index.resolve(match_pattern)
 
     if len(items) == 1:
-        return items[0]
+        return index.items[items[0]]
 
     if len(items) == 0:
         logging.error('ERROR: {} not found'.format(resource))
+        suggestions = index.suggest(match_pattern)
+        if suggestions:
+            logging.error('Did you mean {}?'.format(' or '.join(
+                '"{}"'.format(suggestion) for suggestion in suggestions)))
     else:
         logging.error("ERROR: More than one {0} found. Please refine {0}".format(resource))
+        logging.error('Candidates: {}'.format(', '.join(
+            '"{}"'.format(candidate) for candidate in index.suggest(match_pattern, items))))
 
     return None
 
 
+def match_index(result, match_field):
+    # Indexes are built once per response object; the metadata cache hands
+    # out the same object for as long as its entry is unchanged.
+    key = (id(result), match_field)
+    entry = match_indexes.get(key)
+    if entry is None or entry[0] is not result:
+        entry = match_indexes[key] = (result, MatchIndex(result, match_field))
+        while len(match_indexes) > MATCH_INDEXES:
+            match_indexes.popitem(last=False)
+    return entry[1]
+
+
+class MatchIndex(object):
+    # Answers the case-insensitive substring matches fetch_first has always
+    # made without scanning every item. Each item's text is split into
+    # trigrams, and a query only checks the items that contain all of its
+    # trigrams. A sorted token list also answers token-prefix queries, which
+    # narrow ambiguous matches and catch words typed out of order.
+
+    def __init__(self, items, field):
+        self.items = items
+        self.texts = [getattr(item, field) for item in items]
+        self.lowered = [text.lower() for text in self.texts]
+        self.trigrams = collections.defaultdict(set)
+        self.tokens = []
+
+        for i, text in enumerate(self.lowered):
+            for j in range(len(text) - 2):
+                self.trigrams[text[j:j + 3]].add(i)
+            self.tokens.extend((token, i) for token in set(TOKEN_PATTERN.findall(text)))
+        self.tokens.sort()
+
+    def search(self, pattern):
+        pattern = pattern.lower()
+        if len(pattern) < 3:
+            candidates = range(len(self.items))
+        else:
+            postings = sorted((self.trigrams.get(pattern[j:j + 3], ()) for j in range(len(pattern) - 2)),
+                              key=len)
+            candidates = set(postings[0]).intersection(*postings[1:])
+        return sorted(i for i in candidates if pattern in self.lowered[i])
+
+    def prefix(self, pattern, whole=False):
+        matches = None
+        for word in TOKEN_PATTERN.findall(pattern.lower()):
+            found = set()
+            k = bisect.bisect_left(self.tokens, (word,))
+            while k < len(self.tokens) and self.tokens[k][0].startswith(word):
+                if not whole or self.tokens[k][0] == word:
+                    found.add(self.tokens[k][1])
+                k += 1
+            matches = found if matches is None else matches & found
+        return sorted(matches or ())
+
+    def resolve(self, pattern):
+        items = self.search(pattern)
+        if len(items) == 0:
+            return self.prefix(pattern)
+
+        if len(items) > 1:
+            # Prefer an exact match, then whole words, then word prefixes.
+            narrowed = [[i for i in items if self.lowered[i] == pattern.lower().strip()],
+                        [i for i in self.prefix(pattern, whole=True) if i in items],
+                        [i for i in self.prefix(pattern) if i in items]]
+            for candidates in narrowed:
+                if len(candidates) == 1:
+                    return candidates
+
+        return items
+
+    def suggest(self, pattern, candidates=None, limit=SUGGESTIONS):
+        pattern = pattern.lower()
+        if candidates is None:
+            # Only items sharing a trigram with the pattern are worth scoring.
+            shared = collections.Counter()
+            for j in range(len(pattern) - 2):
+                shared.update(self.trigrams.get(pattern[j:j + 3], ()))
+            candidates = [i for i, _ in shared.most_common(limit * 4)]
+            cutoff = SUGGESTION_CUTOFF
+        else:
+            cutoff = 0
+
+        scored = sorted(((self.score(pattern, i), i) for i in candidates), key=lambda s: -s[0])
+        return [self.texts[i] for score, i in scored[:limit] if score >= cutoff]
+
+    def score(self, pattern, i):
+        import difflib
+        words = TOKEN_PATTERN.findall(pattern)
+        tokens = TOKEN_PATTERN.findall(self.lowered[i])
+        if not words or not tokens:
+            return 0
+        return sum(max(max(difflib.SequenceMatcher(None, word, token).ratio(),
+                           difflib.SequenceMatcher(None, word, token[:len(word)]).ratio())
+                       for token in tokens)
+                   for word in words) / len(words)
+
+
 def lookup_route(route_pattern, route_url):
-    return fetch_first('Route', route_url, route_pattern, 'Description')
+    return fetch_first('Route', route_url, route_pattern, 'description')
 
 
 def lookup_direction(direction_pattern, route, dir_url):
-    return fetch_first('Direction', dir_url, direction_pattern, 'Text',
-            route=route['Route'])
+    return fetch_first('Direction', dir_url, direction_pattern, 'text',
+            route=route.route)
 
 
 def lookup_stop(stop_pattern, route, direction, stop_url):
-    return fetch_first('Stop', stop_url, stop_pattern, 'Text',
-            route=route['Route'],direction=direction['Value'])
+    return fetch_first('Stop', stop_url, stop_pattern, 'text',
+            route=route.route,direction=direction.value)
 
 
+@traced('lookup_next_time')
 def lookup_next_time(date_time, route, direction, stop, time_url):
-    times = make_request(time_url.format(route=route['Route'],direction=direction['Value'],stop=stop['Value']), 'Time')
+    annotate(name='Time')
+    times = fetch_departures(time_url.format(route=route.route,direction=direction.value,stop=stop.value),
+                             date_time, limit=1)
+    return next_time_from(times, date_time)
+
+
+def next_time_from(times, date_time):
+    departures = departures_from(times, date_time, count=1)
+    if departures is None:
+        return departures
+
+    return departures[0][0]
+
+
+@traced('lookup_departures')
+def lookup_departures(date_time, route, direction, stop, time_url, count=None):
+    annotate(name='Time')
+    times = fetch_departures(time_url.format(route=route.route,direction=direction.value,stop=stop.value),
+                             date_time, limit=count)
+    return departures_from(times, date_time, count)
+
+
+def fetch_departures(url, date_time, limit=None):
+    return fetch_aged_departures(url, date_time, limit)[0]
+
+
+def fetch_aged_departures(url, date_time, limit=None):
+    # Returns the departures and, when they stand in for a response that
+    # couldn't be had, how many seconds old they are (else None).
+    cache = get_departure_cache()
+    times, age = cache.fetch(url, limit)
+    stale = None
+    if age:
+        annotate(cache='hit', age=round(age, 3))
+        if age > cache.ttl:
+            stale = round(age)
+            now = int(date_time) if date_time else time.time() * 1000
+            times = [t for t in times if t.time >= now]
+        times = recompute_realtime(times, date_time)
+    return times, stale
+
+
+def recompute_realtime(times, date_time):
+    # The service's own "16 Min" text for realtime departures goes stale
+    # while the response is cached, so it is worked out again from the
+    # departure time.
+    return [t._replace(text=minutes_to_departure([t.time], date_time)[0])
+            if t.actual and t.text.endswith(' Min') else t for t in times]
+
+
+def departures_from(times, date_time, count=None):
+    # Returns (departure text, realtime?) for the first `count` departures,
+    # or all of them. Realtime departures carry the service's own text,
+    # scheduled ones are converted to minutes from now.
     if times is None:
         return times
 
@@ -97,22 +1599,388 @@ def lookup_next_time(date_time, route, direction, stop, time_url):
         logging.error('ERROR: No scheduled departures remain')
         return None
 
-    if times[0]['Actual']:
-        return times[0]['DepartureText']
-    else:
-        return compute_time_to_departure(times[0]['DepartureTime'], date_time)
+    times = times[:count]
+    scheduled = [t.time for t in times if not t.actual]
+    minutes = iter(minutes_to_departure(scheduled, date_time) if scheduled else ())
+    return [(t.text, True) if t.actual else (next(minutes), False) for t in times]
+
+
+def departure_records(details, times, date_time, stale=None):
+    # The departures as dicts for --format: the ids and names of the
+    # resolved route, direction and stop, the departure text, its time in
+    # ms since the epoch, whether it is realtime and how stale it is.
+    departures = departures_from(times, date_time)
+    if departures is None:
+        return None
+
+    route, direction, stop = details
+    return [{'route': route.route, 'route_name': route.description,
+             'direction': direction.value, 'direction_name': direction.text,
+             'stop': stop.value, 'stop_name': stop.text,
+             'departure': text, 'time': t.time, 'realtime': realtime, 'stale': stale}
+            for t, (text, realtime) in zip(times, departures)]
+
+
+def query_records(query, departures):
+    # Records for departures that came without ids, such as from the GTFS
+    # schedule, named by the (route, stop, direction) query instead.
+    route, stop, direction = query
+    return [{'route': None, 'route_name': route, 'direction': None, 'direction_name': direction,
+             'stop': None, 'stop_name': stop, 'departure': text, 'time': None, 'realtime': realtime,
+             'stale': None}
+            for text, realtime in departures]
+
+
+def watch_next_time(date_time, route, direction, stop, time_url, interval, polls=None,
+                    sleep=time.sleep, detailed=False, deadline=None):
+    # Polls only the departures endpoint for an already resolved stop and
+    # yields the next departure each time it changes (with the departures
+    # and their staleness when `detailed`). Polling slows down, up to
+    # WATCH_BACKOFF times the interval, while the bus is far away. Each
+    # poll gets `deadline` seconds of its own.
+    url = time_url.format(route=route.route, direction=direction.value, stop=stop.value)
+    last = None
+    count = 0
+
+    while True:
+        if deadline is not None:
+            start_deadline(deadline)
+        times, stale = fetch_aged_departures(url, date_time, limit=1)
+        count += 1
+
+        next_time = next_time_from(times, date_time)
+        if next_time is not None and next_time != last:
+            yield (next_time, times, stale) if detailed else next_time
+        last = next_time
+
+        if polls is not None and count >= polls:
+            return
+
+        sleep(watch_delay(times, date_time, interval))
+
+
+def watch_delay(times, date_time, interval):
+    if not times:
+        return interval
+
+    departure = times[0].time
+    now = int(date_time) if date_time else time.time() * 1000
+    seconds = (departure - now) / 1000
+    return interval * min(max(seconds / WATCH_NEAR, 1), WATCH_BACKOFF)
+
+
+async def next_bus_many(queries, date_time=None, host=DEFAULT_HOST, concurrency=CONCURRENCY,
+                        detailed=False):
+    # Answers many (route, stop, direction) queries at once, with the next
+    # departure's text or, when `detailed`, its departure_records. Every
+    # distinct URL is requested only once, so all queries share the routes
+    # list and each route's directions, and the requests run on a bounded
+    # pool.
+    import asyncio
+    import concurrent.futures
+    loop = asyncio.get_event_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+    requests_by_url = {}
+
+    def request(fn, url, *args):
+        if url not in requests_by_url:
+            requests_by_url[url] = loop.run_in_executor(executor, fn, url, *args)
+        return requests_by_url[url]
+
+    async def resolve(route, stop, direction):
+        routes = await request(make_request, host + ROUTE_PATH, 'Route', metadata_cache)
+        route = match_first('Route', routes, route, 'description')
+        if route is None:
+            return None
+
+        directions = await request(make_request, host + DIR_PATH.format(route=route.route),
+                                   'Direction', metadata_cache)
+        direction = match_first('Direction', directions, direction, 'text')
+        if direction is None:
+            return None
+
+        stops = await request(make_request, host + STOP_PATH.format(route=route.route, direction=direction.value),
+                              'Stop', metadata_cache)
+        stop = match_first('Stop', stops, stop, 'text')
+        if stop is None:
+            return None
+
+        times, stale = await request(fetch_aged_departures, host + TIME_PATH.format(
+            route=route.route, direction=direction.value, stop=stop.value), date_time, 1)
+        if detailed:
+            return departure_records((route, direction, stop), times, date_time, stale)
+        return next_time_from(times, date_time)
+
+    try:
+        return await asyncio.gather(*[resolve(*query) for query in queries])
+    finally:
+        executor.shutdown(wait=False)
+
+
+def warm_catalog(catalog, host=DEFAULT_HOST, concurrency=CONCURRENCY, rate=WARM_RATE, full=False):
+    # Fetches the routes list, every route's directions and the stops of
+    # each direction into `catalog`, `concurrency` requests at a time and at
+    # most `rate` a second. Responses already in the catalog are
+    # revalidated, and a route's stop lists are only fetched again when its
+    # directions changed (or with `full`). Returns what was done, or None if
+    # the routes list couldn't be fetched.
+    import concurrent.futures
+    previous = catalog.entries()
+    limiter = RateLimiter(rate)
+    entries = {}
+    stats = collections.Counter(requests=0, changed=0, failed=0)
+
+    def fetch(url, endpoint_name):
+        limiter.wait()
+        return fetch_entry(url, endpoint_name, None if full else previous.get(url))
+
+    def record(url, result):
+        entry, changed = result
+        stats['requests'] += 1
+        if entry is None:
+            stats['failed'] += 1
+            entry = previous.get(url)
+        stats['changed'] += changed
+        if entry is not None:
+            entries[url] = entry
+        return entry
+
+    routes_url = host + ROUTE_PATH
+    if record(routes_url, fetch(routes_url, 'Route')) is None:
+        return None
+    routes = decode_rows(entries[routes_url][2], Route)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        dir_urls = [host + DIR_PATH.format(route=route.route) for route in routes]
+        stop_urls = []
+        kept_urls = []
+        for route, url, result in zip(routes, dir_urls,
+                                      executor.map(fetch, dir_urls, ['Direction'] * len(dir_urls))):
+            entry = record(url, result)
+            if entry is None:
+                continue
+            for direction in decode_rows(entry[2], Direction):
+                stop_url = host + STOP_PATH.format(route=route.route, direction=direction.value)
+                if result[1] or stop_url not in previous:
+                    stop_urls.append(stop_url)
+                else:
+                    entries[stop_url] = previous[stop_url]
+                    kept_urls.append(stop_url)
+
+        for url, result in zip(stop_urls, executor.map(fetch, stop_urls, ['Stop'] * len(stop_urls))):
+            record(url, result)
+
+    catalog.save(entries)
+    stats['routes'] = len(routes)
+    stats['stops'] = sum(len(json.loads(entries[url][2])) for url in stop_urls + kept_urls
+                         if url in entries)
+    return stats
+
+
+@traced('fetch_entry')
+def fetch_entry(url, endpoint_name, previous=None):
+    # Fetches a catalog entry, (etag, last modified, rows), and whether it
+    # differs from `previous`. Unchanged responses (304) aren't downloaded
+    # again. Returns (None, False) if the request failed. Like make_request,
+    # it waits its turn under --rate-limit, respects the endpoint's breaker
+    # and records the response.
+    annotate(name=endpoint_name, url=url)
+    if request_limiter is not None:
+        waited = request_limiter.acquire(endpoint_name)
+        if waited:
+            annotate(rate_wait=round(waited, 3))
+
+    breaker = get_breaker(url, endpoint_name)
+    if not breaker.allow():
+        annotate(breaker=breaker.state)
+        logging.error('ERROR: {} endpoint is failing, not asking it for now'.format(endpoint_name))
+        return None, False
+
+    import requests
+    headers = {'Accept': 'application/json'}
+    if previous is not None:
+        if previous[0]:
+            headers['If-None-Match'] = previous[0]
+        if previous[1]:
+            headers['If-Modified-Since'] = previous[1]
+
+    recorder = response_recorder
+    body = [] if recorder is not None else None
+    start = time.perf_counter()
+    try:
+        r = get_session().get(url, stream=True, headers=headers)
+    except requests.RequestException:
+        breaker.record(False, time.perf_counter() - start)
+        logging.error('ERROR: {} endpoint unreachable'.format(endpoint_name))
+        return None, False
+    breaker.record(r.status_code < 500, time.perf_counter() - start)
+
+    with r:
+        annotate(status=r.status_code, server_seconds=r.elapsed.total_seconds())
+        if r.status_code == 304 and previous is not None:
+            return previous, False
+        if r.status_code != 200:
+            if recorder is not None:
+                recorder.record(url, endpoint_name, r.status_code, r.elapsed.total_seconds(), r.content)
+            logging.error('ERROR: {} endpoint misbehaved'.format(endpoint_name))
+            return None, False
+        try:
+            records, received = read_records(r, RECORDS[endpoint_name], None, body)
+        except DECODE_ERRORS + (requests.RequestException,):
+            logging.error('ERROR: {} endpoint misbehaved'.format(endpoint_name))
+            return None, False
+        finally:
+            if recorder is not None:
+                recorder.record(url, endpoint_name, r.status_code, r.elapsed.total_seconds(), b''.join(body))
+        annotate(bytes=received)
+
+    body = json.dumps(records, separators=(',', ':'))
+    entry = (r.headers.get('ETag', ''), r.headers.get('Last-Modified', ''), body)
+    return entry, previous is None or previous[2] != body
+
+
+class SingleFlight(object):
+    # Lets concurrent callers asking for the same key share one call: the
+    # first caller runs it and everyone who arrives meanwhile gets its result.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn, *args):
+        import concurrent.futures
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = concurrent.futures.Future()
+
+        if not leader:
+            return call.result()
+
+        try:
+            call.set_result(fn(*args))
+        except Exception as e:
+            call.set_exception(e)
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+        return call.result()
+
+
+class DepartureCache(object):
+    # Departure responses kept for `ttl` seconds, so a burst of queries for
+    # one stop costs a single upstream request whatever the fan-in.
+    # Identical requests that are in flight together are shared as well.
+    # Responses up to `stale_age` seconds old stand in when a fresh one
+    # can't be had. At most `max_entries` stops are kept, dropping the
+    # least recently used.
+
+    def __init__(self, ttl=DEPARTURE_TTL, max_entries=CACHE_MAX_ENTRIES, stale_age=STALE_DEPARTURES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stale_age = stale_age
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.flight = SingleFlight()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, url, limit=None, max_age=None):
+        # Returns the departures and how many seconds old they are, or None.
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is not None:
+                self.entries.move_to_end(url)
+        if entry is None:
+            return None
+
+        stored, stored_limit, times = entry
+        age = time.time() - stored
+        if age > (self.ttl if max_age is None else max_age):
+            return None
+        if stored_limit is not None and (limit is None or limit > stored_limit):
+            return None
+        return times[:limit], age
+
+    def fetch(self, url, limit=None):
+        cached = self.get(url, limit)
+        if cached is not None:
+            return cached
+
+        times = self.flight.do((url, limit), make_request, url, 'Time', None, limit)
+        if times is None:
+            stale = self.get(url, limit, max_age=self.stale_age)
+            if stale is not None:
+                annotate(stale=round(stale[1]))
+                logging.warning('WARNING: Using stale departures from {} seconds ago'.format(int(stale[1])))
+                return stale
+            # The request may have been made, and failed, on another thread.
+            if upstream_failure() is None:
+                session_state.upstream_failure = BAD_GATEWAY
+            return None, 0
+
+        if self.ttl > 0:
+            now = time.time()
+            with self.lock:
+                self.entries[url] = (now, limit, times)
+                self.entries.move_to_end(url)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        return times, 0
+
+
+def use_departure_cache(cache):
+    global departure_cache
+    departure_cache = cache
+
+
+def get_departure_cache():
+    # Without a configured TTL, identical requests are still shared.
+    if departure_cache is None:
+        use_departure_cache(DepartureCache(ttl=0))
+    return departure_cache
 
 
 def compute_time_to_departure(departure_time, date_time):
-    departure_time_only = extract_date_time(departure_time)
+    return compute_times_to_departure([departure_time], date_time)[0]
+
+
+def compute_times_to_departure(departure_times, date_time):
+    # Pulls every epoch out of the /Date(...)/ strings in one regex pass.
+    return minutes_to_departure(map(int, DATE_PATTERN.findall('\n'.join(departure_times))), date_time)
+
+
+def minutes_to_departure(epochs, date_time):
     if date_time is None:
         date_time = str(int(time.time())*1000)
-    return str(math.floor((int(departure_time_only)-int(date_time))/1000/60)) + ' Min'
+    now = int(date_time)
+    return [str((epoch - now) // 60000) + ' Min' for epoch in epochs]
 
 
 def extract_date_time(departure_time):
-    return departure_time.split('(')[1].split('-')[0]
+    return DATE_PATTERN.search(departure_time).group(1)
+
+
+SUBCOMMANDS = {
+    'batch': batch,
+    'board': board,
+    'history': history,
+    'near': near,
+    'replay': replay,
+    'serve': serve,
+    'warm': warm,
+}
+
+
+def main(args):
+    if args and args[0] in SUBCOMMANDS:
+        SUBCOMMANDS[args[0]](args[1:], prog_name='next_bus.py ' + args[0])
+    else:
+        next_bus(args)
 
 
 if __name__ == '__main__':
-    next_bus()
+    main(sys.argv[1:])
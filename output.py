@@ -0,0 +1,135 @@
+import csv
+import json
+import struct
+
+BUFFER_SIZE=64*1024
+DEPARTURE_FIELDS=['route', 'route_name', 'direction', 'direction_name', 'stop', 'stop_name',
+                  'departure', 'time', 'realtime', 'stale']
+
+
+class RecordWriter(object):
+    # Streams dict records to a binary file as json (one array), ndjson,
+    # csv (with a header) or msgpack (one map per record, back to back).
+    # Records are encoded straight into one buffer, which is handed to the
+    # file whenever it passes BUFFER_SIZE bytes, so any number of records
+    # costs a few large writes and no more memory than the buffer.
+
+    def __init__(self, out, output_format, fields=DEPARTURE_FIELDS, buffer_size=BUFFER_SIZE):
+        self.out = out
+        self.format = output_format
+        self.fields = fields
+        self.buffer_size = buffer_size
+        self.buffer = bytearray()
+        self.count = 0
+        if output_format == 'csv':
+            self.csv = csv.writer(self, lineterminator='\n')
+            self.csv.writerow(fields)
+        elif output_format not in ('json', 'ndjson', 'msgpack'):
+            raise ValueError('Unknown output format "{}"'.format(output_format))
+
+    def write(self, text):
+        # For csv.writer, which writes its rows here.
+        self.buffer += text.encode('utf-8')
+
+    def write_record(self, record):
+        if self.format == 'json':
+            self.buffer += b',\n' if self.count else b'[\n'
+            self.buffer += json.dumps(record).encode('utf-8')
+        elif self.format == 'ndjson':
+            self.buffer += json.dumps(record).encode('utf-8') + b'\n'
+        elif self.format == 'csv':
+            self.csv.writerow(['' if record.get(field) is None else record[field] for field in self.fields])
+        else:
+            pack(record, self.buffer)
+        self.count += 1
+
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def write_records(self, records):
+        for record in records:
+            self.write_record(record)
+
+    def flush(self):
+        if self.buffer:
+            self.out.write(memoryview(self.buffer))
+            self.buffer.clear()
+        self.out.flush()
+
+    def close(self):
+        if self.format == 'json':
+            self.buffer += b'\n]\n' if self.count else b'[]\n'
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def pack(value, buffer):
+    # Appends the MessagePack encoding of `value` (None, bools, ints,
+    # floats, str, bytes, lists, tuples and dicts) to `buffer`.
+    if value is None:
+        buffer.append(0xc0)
+    elif value is True:
+        buffer.append(0xc3)
+    elif value is False:
+        buffer.append(0xc2)
+    elif isinstance(value, int):
+        pack_int(value, buffer)
+    elif isinstance(value, float):
+        buffer += struct.pack('>Bd', 0xcb, value)
+    elif isinstance(value, str):
+        encoded = value.encode('utf-8')
+        pack_length(len(encoded), buffer, 0xa0, 31, 0xd9, 0xda, 0xdb)
+        buffer += encoded
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        pack_length(len(value), buffer, None, -1, 0xc4, 0xc5, 0xc6)
+        buffer += value
+    elif isinstance(value, (list, tuple)):
+        pack_length(len(value), buffer, 0x90, 15, None, 0xdc, 0xdd)
+        for item in value:
+            pack(item, buffer)
+    elif isinstance(value, dict):
+        pack_length(len(value), buffer, 0x80, 15, None, 0xde, 0xdf)
+        for key, item in value.items():
+            pack(key, buffer)
+            pack(item, buffer)
+    else:
+        raise TypeError('Cannot pack {}'.format(type(value).__name__))
+
+
+def pack_int(value, buffer):
+    if 0 <= value < 0x80:
+        buffer.append(value)
+    elif -32 <= value < 0:
+        buffer += struct.pack('>b', value)
+    elif value >= 0:
+        for marker, code, limit in ((0xcc, 'B', 1 << 8), (0xcd, 'H', 1 << 16), (0xce, 'I', 1 << 32),
+                                    (0xcf, 'Q', 1 << 64)):
+            if value < limit:
+                buffer += struct.pack('>B' + code, marker, value)
+                return
+        raise OverflowError('Integer too large to pack')
+    else:
+        for marker, code, limit in ((0xd0, 'b', 1 << 7), (0xd1, 'h', 1 << 15), (0xd2, 'i', 1 << 31),
+                                    (0xd3, 'q', 1 << 63)):
+            if value >= -limit:
+                buffer += struct.pack('>B' + code, marker, value)
+                return
+        raise OverflowError('Integer too large to pack')
+
+
+def pack_length(length, buffer, fixed, fixed_max, marker8, marker16, marker32):
+    # The header of a str, bin, array or map: a fixed form for short
+    # lengths where the type has one, then 8-, 16- and 32-bit lengths.
+    if length <= fixed_max:
+        buffer.append(fixed | length)
+    elif marker8 is not None and length < 1 << 8:
+        buffer += struct.pack('>BB', marker8, length)
+    elif length < 1 << 16:
+        buffer += struct.pack('>BH', marker16, length)
+    else:
+        buffer += struct.pack('>BI', marker32, length)
@@ -0,0 +1,126 @@
+import concurrent.futures
+import logging
+import os
+import threading
+
+from next_bus import (CONCURRENCY, DEFAULT_HOST, POOL_SIZE, REQUEST_RETRIES, REQUEST_TIMEOUT,
+                      PooledSession, call_with_session, live_departures)
+
+GTFS_PREFIX='gtfs:'
+REALTIME_PREFIX='gtfs-rt:'
+
+
+class Provider(object):
+    # Somewhere departures come from, such as one agency's real-time
+    # service. departures() answers like next_bus.lookup_departures, with
+    # (text, realtime) pairs or None, and at most `concurrency` queries run
+    # against a provider at once.
+
+    def __init__(self, name, concurrency=CONCURRENCY):
+        self.name = name
+        self.slots = threading.BoundedSemaphore(concurrency)
+
+    def departures(self, route, stop, direction, date_time=None, count=1):
+        with self.slots:
+            return self.lookup(route, stop, direction, date_time, count)
+
+    def lookup(self, route, stop, direction, date_time, count):
+        raise NotImplementedError
+
+
+class NexTripProvider(Provider):
+    # A NexTrip-style service at `host`. Its requests go through its own
+    # connection pool. Cached metadata is keyed by full URL, so every host
+    # keeps its own entries in the cache and catalog.
+
+    def __init__(self, name, host=DEFAULT_HOST, concurrency=CONCURRENCY, pool_size=POOL_SIZE,
+                 timeout=REQUEST_TIMEOUT, retries=REQUEST_RETRIES):
+        Provider.__init__(self, name, concurrency)
+        self.host = host
+        self.session = PooledSession(timeout=timeout, retries=retries, pool_size=pool_size)
+
+    def lookup(self, route, stop, direction, date_time, count):
+        return call_with_session(self.session, live_departures, route, stop, direction,
+                                 date_time, self.host, count)
+
+
+class ScheduleProvider(Provider):
+    # Scheduled departures from a GTFS zip, loaded on first use.
+
+    def __init__(self, name, gtfs_path, concurrency=CONCURRENCY):
+        Provider.__init__(self, name, concurrency)
+        self.gtfs_path = gtfs_path
+        self.schedule = None
+        self.lock = threading.Lock()
+
+    def lookup(self, route, stop, direction, date_time, count):
+        with self.lock:
+            if self.schedule is None:
+                import gtfs
+                self.schedule = gtfs.Schedule.load(self.gtfs_path)
+        if self.schedule is None:
+            return None
+        return self.schedule.departures(route, stop, direction, date_time, count)
+
+
+class RealtimeProvider(ScheduleProvider):
+    # Predictions from a GTFS-Realtime TripUpdates feed, fetched at most once
+    # per `interval` however many queries arrive. Names come from the GTFS
+    # zip, which also answers stops without predictions.
+
+    def __init__(self, name, feed, gtfs_path, concurrency=CONCURRENCY, interval=None):
+        ScheduleProvider.__init__(self, name, gtfs_path, concurrency)
+        self.feed = feed
+        self.interval = interval
+        self.realtime = None
+
+    def lookup(self, route, stop, direction, date_time, count):
+        with self.lock:
+            if self.realtime is None:
+                import gtfs
+                schedule = gtfs.Schedule.load(self.gtfs_path)
+                if schedule is None:
+                    return None
+                interval = gtfs.REALTIME_INTERVAL if self.interval is None else self.interval
+                self.realtime = gtfs.Realtime(schedule, self.feed, interval)
+        return self.realtime.departures(route, stop, direction, date_time, count)
+
+
+def parse_provider(spec, gtfs_path=None, **options):
+    # NAME=URL for a NexTrip-style host, NAME=gtfs:PATH for a GTFS schedule,
+    # NAME=gtfs-rt:URL for a GTFS-Realtime feed over the `gtfs_path` zip.
+    # `options` configure NexTrip providers.
+    name, _, target = spec.partition('=')
+    if not name or not target:
+        raise ValueError('Expected NAME=URL, NAME=gtfs:PATH or NAME=gtfs-rt:URL, got "{}"'.format(spec))
+
+    if target.startswith(REALTIME_PREFIX):
+        if not gtfs_path:
+            raise ValueError('{} needs --gtfs PATH for route and stop names'.format(spec))
+        return RealtimeProvider(name, target[len(REALTIME_PREFIX):], gtfs_path,
+                                concurrency=options.get('concurrency', CONCURRENCY))
+
+    if target.startswith(GTFS_PREFIX):
+        path = target[len(GTFS_PREFIX):]
+        if not os.path.isfile(path):
+            raise ValueError('GTFS feed "{}" does not exist'.format(path))
+        return ScheduleProvider(name, path, concurrency=options.get('concurrency', CONCURRENCY))
+    return NexTripProvider(name, target, **options)
+
+
+def departures_from_all(providers, route, stop, direction, date_time=None, count=1):
+    # Asks every provider at once. Returns (provider name, departures)
+    # pairs in the order the providers were given. A provider that fails
+    # answers None, leaving the others' answers be.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(providers)) as executor:
+        futures = [executor.submit(provider.departures, route, stop, direction, date_time, count)
+                   for provider in providers]
+        answers = []
+        for provider, future in zip(providers, futures):
+            try:
+                departures = future.result()
+            except Exception as e:
+                logging.error('ERROR: Provider {} failed: {}'.format(provider.name, e))
+                departures = None
+            answers.append((provider.name, departures))
+        return answers
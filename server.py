@@ -0,0 +1,172 @@
+import collections
+import http.server
+import json
+import logging
+import socketserver
+import threading
+import time
+import urllib.parse
+
+from archive import request_key
+from next_bus import (CACHE_TTL, DEFAULT_HOST, TIME_PATH, UNAVAILABLE, clear_upstream_failure,
+                      fetch_departures, next_time_from, resolve_query, upstream_failure)
+
+
+class DepartureService(object):
+    # Long-lived lookups for the server: resolved (route, stop, direction)
+    # details stay in memory for `ttl` seconds. Departures go through the
+    # shared departure cache, so identical requests reach the upstream once.
+    # Given a `provider` (such as a providers.RealtimeProvider), it answers
+    # instead of the host.
+
+    def __init__(self, host=DEFAULT_HOST, date_time=None, ttl=CACHE_TTL, provider=None):
+        self.host = host
+        self.date_time = date_time
+        self.ttl = ttl
+        self.provider = provider
+        self.resolved = {}
+
+    def resolve(self, route, stop, direction):
+        key = (route.lower(), stop.lower(), direction.lower())
+        entry = self.resolved.get(key)
+        if entry is not None and time.time() - entry[0] < self.ttl:
+            return entry[1]
+
+        details = resolve_query(route, stop, direction, self.host)
+        if details is None:
+            return None
+
+        self.resolved[key] = (time.time(), details)
+        return details
+
+    def next_time(self, route, stop, direction, date_time=None):
+        if self.provider is not None:
+            departures = self.provider.departures(route, stop, direction, date_time or self.date_time)
+            return departures[0][0] if departures else None
+
+        details = self.resolve(route, stop, direction)
+        if details is None:
+            return None
+
+        route_details, direction_details, stop_details = details
+        url = self.host + TIME_PATH.format(route=route_details.route,
+                                           direction=direction_details.value,
+                                           stop=stop_details.value)
+        date_time = date_time or self.date_time
+        return next_time_from(fetch_departures(url, date_time, limit=1), date_time)
+
+
+class NextBusHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        self.params = params = {key: values[0] for key, values
+                                in urllib.parse.parse_qs(url.query).items()}
+        if url.path != '/next':
+            return self.reply(404, error='Unknown path {}'.format(url.path))
+
+        missing = [key for key in ('route', 'stop', 'direction') if key not in params]
+        if missing:
+            return self.reply(400, error='Missing {}'.format(', '.join(missing)))
+        if not params.get('date_time', '0').isdigit():
+            return self.reply(400, error='date_time must be milliseconds since the epoch')
+
+        clear_upstream_failure()
+        try:
+            next_time = self.server.service.next_time(params['route'], params['stop'],
+                                                      params['direction'], params.get('date_time'))
+        except Exception:
+            logging.exception('ERROR: Lookup failed')
+            return self.reply(500, error='Lookup failed')
+        if next_time is None:
+            # Unknown routes and stops are the client's; the rest is upstream.
+            failure = upstream_failure()
+            if failure == UNAVAILABLE:
+                return self.reply(failure, error='Service unavailable')
+            if failure is not None:
+                return self.reply(failure, error='Service failed')
+            return self.reply(404, error='No departure found')
+
+        self.reply(200, departure=next_time, route=params['route'],
+                   stop=params['stop'], direction=params['direction'])
+
+    def reply(self, status, **body):
+        wants_json = (self.params.get('format') == 'json' or
+                      'application/json' in self.headers.get('Accept', ''))
+
+        if wants_json:
+            content_type, payload = 'application/json', json.dumps(body)
+        else:
+            content_type, payload = 'text/plain', body.get('departure') or 'ERROR: ' + body['error']
+
+        payload = (payload + '\n').encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def address_string(self):
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        logging.info(format % args)
+
+
+class DepartureServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class UnixDepartureServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ReplayHandler(http.server.BaseHTTPRequestHandler):
+    # Answers each path with the responses recorded for it, in turn, after
+    # the recorded response time times the server's latency_scale.
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        entry = self.server.next_response(self.path)
+        if entry is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        status, seconds, start, end = entry
+        if self.server.latency_scale:
+            time.sleep(seconds * self.server.latency_scale)
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(end - start))
+        self.end_headers()
+        self.wfile.write(self.server.responses.body(entry))
+
+    def log_message(self, format, *args):
+        logging.info(format % args)
+
+
+class ReplayServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    # Stands in for the upstream service, serving a recorded ResponseLog.
+    daemon_threads = True
+
+    def __init__(self, address, responses, latency_scale=1.0):
+        http.server.HTTPServer.__init__(self, address, ReplayHandler)
+        self.responses = responses
+        self.latency_scale = latency_scale
+        self.served = collections.Counter()
+        self.lock = threading.Lock()
+
+    def next_response(self, path):
+        key = request_key(path)
+        entries = self.responses.responses.get(key)
+        if not entries:
+            return None
+
+        with self.lock:
+            turn = self.served[key]
+            self.served[key] += 1
+        return entries[turn % len(entries)]
@@ -0,0 +1,161 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from grappa import should
+
+from archive import *
+from next_bus import ARCHIVE_MAX_AGE, DIR_PATH, ROUTE_PATH, STOP_PATH, TIME_PATH, Catalog, Departure
+from test_units import DIR_RECORDS, ROUTE_RECORDS, STOP_RECORDS
+
+HOST='http://archive.fake'
+FETCHED=1538989200000
+MINUTE=60000
+
+
+def make_archive(path):
+    # Route 5 southbound, with departures from BCTC recorded twice, ten
+    # minutes apart.
+    Catalog(os.path.join(path, METADATA_FILE)).save({
+        HOST+ROUTE_PATH: ('', '', json.dumps(ROUTE_RECORDS)),
+        HOST+DIR_PATH.format(route='5'): ('', '', json.dumps(DIR_RECORDS)),
+        HOST+STOP_PATH.format(route='5', direction='1'): ('', '', json.dumps(STOP_RECORDS)),
+    })
+    archive = Archive(path)
+    url = HOST+TIME_PATH.format(route='5', direction='1', stop='BCTC')
+    archive.append(url, FETCHED, [Departure('5 Min', True, FETCHED + 5*MINUTE),
+                                  Departure('8:30', False, FETCHED + 30*MINUTE)])
+    archive.append(url, FETCHED + 10*MINUTE, [Departure('12 Min', True, FETCHED + 22*MINUTE)])
+    return archive
+
+
+class TestArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        make_archive(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def next_departure(self, date_time, stop='Brooklyn Center', max_age=ARCHIVE_MAX_AGE):
+        return Archive(self.path, max_age).next_departure(HOST, 'Brklyn', stop, 'south', str(date_time))
+
+    def test_answers_from_the_latest_earlier_response(self):
+        self.next_departure(FETCHED + MINUTE) | should.equal('4 Min')
+        self.next_departure(FETCHED + 11*MINUTE) | should.equal('11 Min')
+
+    def test_skips_departures_that_already_left(self):
+        self.next_departure(FETCHED + 6*MINUTE, max_age=600) | should.equal('24 Min')
+
+    def test_returns_None_before_first_response(self):
+        self.next_departure(FETCHED - MINUTE) | should.be.none
+
+    def test_returns_None_when_responses_are_too_old(self):
+        self.next_departure(FETCHED + 20*MINUTE) | should.be.none
+
+    def test_returns_None_for_unknown_stop(self):
+        self.next_departure(FETCHED, stop='junk') | should.be.none
+
+    def test_index_is_extended_as_the_log_grows(self):
+        Archive(self.path).load_index()
+        url = HOST+TIME_PATH.format(route='5', direction='1', stop='47OS')
+        Archive(self.path).append(url, FETCHED, [Departure('Due', True, FETCHED)])
+
+        times, offsets = Archive(self.path).load_index()[url]
+        list(times) | should.equal([FETCHED])
+        self.next_departure(FETCHED, stop='Osseo') | should.equal('Due')
+
+    def test_index_round_trips(self):
+        urls = Archive(self.path).load_index()
+        with open(os.path.join(self.path, INDEX_FILE), 'rb') as f:
+            indexed, loaded = decode_index(f.read())
+        indexed | should.equal(os.path.getsize(os.path.join(self.path, DEPARTURES_FILE)))
+        loaded | should.equal(urls)
+
+    def test_unreadable_index_is_rebuilt(self):
+        index_path = os.path.join(self.path, INDEX_FILE)
+        Archive(self.path).load_index()
+        with open(index_path, 'rb') as f:
+            data = f.read()
+        for junk in [b'\x80\x04K\x01.', b'{"version": 2}\n', b'[]\n', data[:-4], data + b'x']:
+            with open(index_path, 'wb') as f:
+                f.write(junk)
+            self.next_departure(FETCHED + MINUTE) | should.equal('4 Min')
+            with open(index_path, 'rb') as f:
+                f.read() | should.equal(data)
+
+
+class TestRunBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        make_archive(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_writes_every_query_in_order(self):
+        rows = [('Brklyn', 'Brooklyn Center', 'south', str(FETCHED + i*MINUTE)) for i in range(25)]
+        out = io.StringIO()
+
+        queries, answered = run_batch(self.path, rows, out, HOST, processes=2, chunk_size=3)
+
+        (queries, answered) | should.equal((25, 12))
+        lines = out.getvalue().splitlines()
+        [line.split(',')[3] for line in lines] | should.equal([row[3] for row in rows])
+        lines[0] | should.equal('Brklyn,Brooklyn Center,south,{},5 Min'.format(FETCHED))
+        lines[24] | should.end_with(',-')
+
+    def test_malformed_rows_go_unanswered(self):
+        out = io.StringIO()
+        run_batch(self.path, [('Brklyn', 'Brooklyn Center', 'south', 'soon'), ('Brklyn',)], out, HOST,
+                  processes=1) | should.equal((2, 0))
+        out.getvalue().splitlines() | should.equal(['Brklyn,Brooklyn Center,south,soon,-', 'Brklyn,-'])
+
+
+class TestRecorder(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_log_returns_recorded_responses(self):
+        recorder = Recorder(self.path)
+        recorder.record(HOST+ROUTE_PATH, 'Route', 200, 0.25, b'[\n{"Route": "5"}\n]')
+        recorder.record(HOST+ROUTE_PATH, 'Route', 503, 0.5, b'')
+        recorder.close()
+
+        log = ResponseLog(self.path)
+        len(log) | should.equal(2)
+        entries = log.responses[ROUTE_PATH]
+        [(status, seconds) for status, seconds, _, _ in entries] | should.equal([(200, 0.25), (503, 0.5)])
+        bytes(log.body(entries[0])) | should.equal(b'[\n{"Route": "5"}\n]')
+
+    def test_recorder_fills_metadata_for_batch(self):
+        recorder = Recorder(self.path)
+        recorder.record(HOST+ROUTE_PATH, 'Route', 200, 0.25,
+                        json.dumps([route.to_json() for route in ROUTE_RECORDS]).encode('utf-8'))
+        recorder.record_records(HOST+DIR_PATH.format(route='5'), 'Direction', DIR_RECORDS)
+        recorder.record_records(HOST+STOP_PATH.format(route='5', direction='1'), 'Stop', STOP_RECORDS)
+        recorder.record_records(HOST+ROUTE_PATH, 'Route', ROUTE_RECORDS)
+        url = HOST+TIME_PATH.format(route='5', direction='1', stop='BCTC')
+        recorder.record(url, 'Time', 200, 0.1, json.dumps([
+            {'DepartureText': '5 Min', 'Actual': True, 'DepartureTime': '/Date({}-0500)/'.format(FETCHED + 5*MINUTE)},
+        ]).encode('utf-8'), fetched=FETCHED)
+        recorder.close()
+
+        len(ResponseLog(self.path)) | should.equal(4)
+        Archive(self.path).next_departure(HOST, 'Brklyn', 'Brooklyn Center', 'south',
+                                          str(FETCHED + MINUTE)) | should.equal('4 Min')
+
+    def test_request_key_matches_quoted_paths(self):
+        request_key(HOST+'/NexTrip/5/1/44 FM') | should.equal(request_key('/NexTrip/5/1/44%20FM'))
+
+    def test_request_key_drops_host_path_prefix(self):
+        request_key(HOST+'/mockhttp/1/NexTrip/Routes') | should.equal(ROUTE_PATH)
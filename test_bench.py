@@ -0,0 +1,76 @@
+import json
+import subprocess
+
+from grappa import should
+
+import next_bus
+from bench import FakeNexTrip, profile_memory, regressions
+from next_bus import ROUTE_PATH
+
+BASELINE={
+    'lookups': {'lookup_route': {'median': 0.010, 'p95': 0.020, 'min': 0.005}},
+    'batch': {'queries': 200, 'seconds': 1.0, 'per_second': 200.0},
+}
+
+
+def test_regressions_ignores_small_changes():
+    results = {
+        'lookups': {'lookup_route': {'median': 0.012, 'p95': 0.018, 'min': 0.005}},
+        'batch': {'queries': 200, 'seconds': 1.1, 'per_second': 180.0},
+    }
+    regressions(results, BASELINE) | should.equal([])
+
+def test_regressions_reports_slower_timings():
+    results = {
+        'lookups': {'lookup_route': {'median': 0.020, 'p95': 0.020, 'min': 0.005}},
+        'batch': {'queries': 200, 'seconds': 1.0, 'per_second': 200.0},
+    }
+    regressions(results, BASELINE) | should.equal([('lookups.lookup_route.median', 0.010, 0.020)])
+
+def test_regressions_reports_lower_throughput():
+    results = {'batch': {'queries': 200, 'seconds': 2.0, 'per_second': 100.0}}
+    regressions(results, BASELINE) | should.equal([('batch.seconds', 1.0, 2.0),
+                                                   ('batch.per_second', 200.0, 100.0)])
+
+def test_regressions_skips_stages_missing_from_baseline():
+    results = {'cold_start': {'help': {'median': 1.0}}}
+    regressions(results, BASELINE) | should.equal([])
+
+def test_bench_records_baseline(tmpdir):
+    baseline = tmpdir.join('baseline.json')
+    result = subprocess.run(['./bench.py', '--runs', '2', '--queries', '10', '--routes', '20',
+                             '--baseline', str(baseline), '--save'],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    result.returncode | should.equal(0)
+    saved = json.loads(baseline.read())
+    saved | should.have.keys('config', 'cold_start', 'lookups', 'batch')
+    sorted(saved['lookups']) | should.equal(['lookup_direction', 'lookup_next_time',
+                                             'lookup_route', 'lookup_stop'])
+    saved['batch']['failed'] | should.equal(0)
+    json.loads(result.stdout.decode('ASCII')) | should.equal(saved)
+
+def test_profile_memory_flags_growth():
+    server = FakeNexTrip(routes=20).start()
+    next_bus.use_session(next_bus.PooledSession())
+    kept = []
+    try:
+        profile = profile_memory(lambda: kept.append(next_bus.make_request(server.url + ROUTE_PATH, 'Route')),
+                                 10, warmup=1, functions=['make_request', 'lookup_stop'])
+    finally:
+        next_bus.use_session(None)
+        server.shutdown()
+
+    profile['growing'] | should.equal(['make_request'])
+    profile['functions']['lookup_stop']['bytes'] | should.equal(0)
+
+def test_bench_profiles_memory():
+    result = subprocess.run(['./bench.py', '--profile-memory', '5', '--routes', '20'],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    result.returncode | should.equal(0)
+    memory = json.loads(result.stdout.decode('ASCII'))['memory']
+    memory['cycles'] | should.equal(5)
+    memory['growing'] | should.equal([])
+    memory['functions']['make_request']['bytes'] | should.be.above(0)
+    memory['functions']['lookup_stop'] | should.have.keys('blocks', 'bytes', 'growth')
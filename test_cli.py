@@ -1,11 +1,17 @@
+import json
+import os
+import socket
 import subprocess
+import zipfile
 
 import pytest
+import requests
 from grappa_http import should
 from pretenders.client.http import HTTPMock
 from pretenders.common.constants import FOREVER
 
 from next_bus import ROUTE_PATH, DIR_PATH, STOP_PATH, TIME_PATH
+from test_gtfs import FEED, feed, local_millis, local_seconds, trip_update
 
 SCRIPT_NAME='./next_bus.py'
 
@@ -126,11 +132,14 @@ def setup_times_actual_false_happy_path(live_mock, route, direction, stop):
 mock = HTTPMock('localhost', 55555)
 
 @pytest.fixture
-def cli_runner():
+def cli_runner(tmpdir):
+    env = dict(os.environ, NEXT_BUS_CACHE=str(tmpdir.join('cache.sqlite3')),
+               NEXT_BUS_CATALOG=str(tmpdir.join('catalog.tsv')))
     def runner(command, *arguments):
         p = subprocess.Popen([command] + list(arguments),
                              stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
+                             stderr=subprocess.PIPE,
+                             env=env)
         stdout, stderr = p.communicate()
         return dict(returncode=p.returncode,
                     stdout=stdout.decode('ASCII'),
@@ -168,7 +177,8 @@ def test_bad_route(cli_runner):
 
     result | should.have.key('returncode').that.should.equal(1)
     result | should.have.key('stderr')
-    result['stderr'] | should.equal('ERROR: Route not found\n')
+    result['stderr'] | should.equal('ERROR: Route not found\n'
+                                    'Did you mean "5 - Brklyn Center - Fremont - 26th Av - Chicago - MOA"?\n')
 
 def test_bad_direction(cli_runner):
     mock.reset()
@@ -204,7 +214,8 @@ def test_multiple_directions(cli_runner):
 
     result | should.have.key('returncode').that.should.equal(1)
     result | should.have.key('stderr')
-    result['stderr'] | should.equal('ERROR: More than one Direction found. Please refine Direction\n')
+    result['stderr'] | should.equal('ERROR: More than one Direction found. Please refine Direction\n'
+                                    'Candidates: "NORTHBOUND", "SOUTHBOUND"\n')
 
 def test_stop_endpoint_returns_non_200(cli_runner):
     mock.reset()
@@ -278,4 +289,578 @@ def test_successful_lookup_later_stop(cli_runner):
     result | should.have.key('stdout')
     result['stdout'] | should.equal('22 Min\n')
 
+def test_successful_lookup_uses_cached_metadata(cli_runner):
+    mock.reset()
+    setup_routes_happy_path(mock)
+    setup_directions_happy_path(mock, '5')
+    setup_stops_happy_path(mock, '5', '1')
+    setup_times_actual_true_happy_path(mock, '5', '1', 'BCTC')
+
+    cli_runner(SCRIPT_NAME, '-d 20181007234100-05:00', '-h ' + mock.pretend_url,
+               '5 - Brklyn Center', 'Brooklyn Center', 'south')
+
+    mock.reset()
+    setup_times_actual_true_happy_path(mock, '5', '1', 'BCTC')
+
+    result = cli_runner(SCRIPT_NAME, '-d 20181007234100-05:00', '-h ' + mock.pretend_url,
+                        '5 - Brklyn Center', 'Brooklyn Center', 'south')
+
+    result | should.have.key('returncode').that.should.equal(0)
+    result | should.have.key('stdout')
+    result['stdout'] | should.equal('16 Min\n')
+
+def test_no_cache_always_hits_endpoints(cli_runner):
+    mock.reset()
+    setup_routes_happy_path(mock)
+    setup_directions_happy_path(mock, '5')
+    setup_stops_happy_path(mock, '5', '1')
+    setup_times_actual_true_happy_path(mock, '5', '1', 'BCTC')
+
+    cli_runner(SCRIPT_NAME, '-d 20181007234100-05:00', '-h ' + mock.pretend_url,
+               '5 - Brklyn Center', 'Brooklyn Center', 'south')
+
+    mock.reset()
+    mock.when('GET ' + ROUTE_PATH).reply(status=404, times=FOREVER)
+
+    result = cli_runner(SCRIPT_NAME, '--no-cache', '-d 20181007234100-05:00', '-h ' + mock.pretend_url,
+                        '5 - Brklyn Center', 'Brooklyn Center', 'south')
+
+    result | should.have.key('returncode').that.should.equal(1)
+    result['stderr'] | should.equal('ERROR: Route endpoint misbehaved\n')
+
+def test_warm_catalog_answers_later_queries(cli_runner):
+    mock.reset()
+    setup_routes_happy_path(mock)
+    for route in ('901', '902', '5'):
+        setup_directions_happy_path(mock, route)
+        for direction in ('4', '1'):
+            setup_stops_happy_path(mock, route, direction)
+
+    result = cli_runner(SCRIPT_NAME, 'warm', '-h ' + mock.pretend_url, '--rate', '0')
+
+    result | should.have.key('returncode').that.should.equal(0)
+    result['stderr'] | should.contain('Catalog: 3 routes, 18 stops (10 requests, 10 changed, 0 failed)')
+
+    mock.reset()
+    setup_times_actual_true_happy_path(mock, '5', '1', 'BCTC')
+
+    result = cli_runner(SCRIPT_NAME, '--no-cache', '-d 20181007234100-05:00', '-h ' + mock.pretend_url,
+                        '5 - Brklyn Center', 'Brooklyn Center', 'south')
+
+    result | should.have.key('returncode').that.should.equal(1)
+
+    result = cli_runner(SCRIPT_NAME, '-d 20181007234100-05:00', '-h ' + mock.pretend_url,
+                        '5 - Brklyn Center', 'Brooklyn Center', 'south')
+
+    result | should.have.key('returncode').that.should.equal(0)
+    result['stdout'] | should.equal('16 Min\n')
+
+def test_trace_writes_json_lines(cli_runner, tmpdir):
+    mock.reset()
+    setup_routes_happy_path(mock)
+    setup_directions_happy_path(mock, '5')
+    setup_stops_happy_path(mock, '5', '1')
+    setup_times_actual_true_happy_path(mock, '5', '1', 'BCTC')
+    trace = tmpdir.join('trace.jsonl')
+
+    result = cli_runner(SCRIPT_NAME, '--trace', str(trace), '-h ' + mock.pretend_url,
+                        '5 - Brklyn Center', 'Brooklyn Center', 'south')
+
+    result | should.have.key('returncode').that.should.equal(0)
+    events = [json.loads(line) for line in trace.readlines()]
+    [(event['stage'], event['name']) for event in events] | should.equal([
+        ('make_request', 'Route'), ('fetch_first', 'Route'),
+        ('make_request', 'Direction'), ('fetch_first', 'Direction'),
+        ('make_request', 'Stop'), ('fetch_first', 'Stop'),
+        ('make_request', 'Time'), ('lookup_departures', 'Time')])
+
+def test_timings_go_to_stderr(cli_runner):
+    mock.reset()
+    setup_routes_happy_path(mock)
+    setup_directions_happy_path(mock, '5')
+    setup_stops_happy_path(mock, '5', '1')
+    setup_times_actual_true_happy_path(mock, '5', '1', 'BCTC')
+
+    result = cli_runner(SCRIPT_NAME, '--timings', '-h ' + mock.pretend_url,
+                        '5 - Brklyn Center', 'Brooklyn Center', 'south')
+
+    result['stdout'] | should.equal('16 Min\n')
+    result['stderr'].splitlines() | should.have.length.of(8)
+    result['stderr'] | should.contain('cache=miss')
+
+def test_all_departures(cli_runner):
+    mock.reset()
+    setup_routes_happy_path(mock)
+    setup_directions_happy_path(mock, '5')
+    setup_stops_happy_path(mock, '5', '1')
+    setup_times_actual_true_happy_path(mock, '5', '1', 'BCTC')
+
+    result = cli_runner(SCRIPT_NAME, '--all', '-d 1538969940000', '-h ' + mock.pretend_url,
+                        '5 - Brklyn Center', 'Brooklyn Center', 'south')
+
+    result | should.have.key('returncode').that.should.equal(0)
+    result['stdout'] | should.equal('16 Min\trealtime\n65 Min\tscheduled\n')
+
+def test_all_departures_as_ndjson(cli_runner):
+    mock.reset()
+    setup_routes_happy_path(mock)
+    setup_directions_happy_path(mock, '5')
+    setup_stops_happy_path(mock, '5', '1')
+    setup_times_actual_true_happy_path(mock, '5', '1', 'BCTC')
+
+    result = cli_runner(SCRIPT_NAME, '--all', '--format', 'ndjson', '-d 1538969940000',
+                        '-h ' + mock.pretend_url, '5 - Brklyn Center', 'Brooklyn Center', 'south')
+
+    result | should.have.key('returncode').that.should.equal(0)
+    records = [json.loads(line) for line in result['stdout'].splitlines()]
+    records | should.equal([
+        {'route': '5', 'route_name': '5 - Brklyn Center - Fremont - 26th Av - Chicago - MOA',
+         'direction': '1', 'direction_name': 'SOUTHBOUND',
+         'stop': 'BCTC', 'stop_name': 'Brooklyn Center Transit Center',
+         'departure': '16 Min', 'time': 1538971260000, 'realtime': True, 'stale': None},
+        {'route': '5', 'route_name': '5 - Brklyn Center - Fremont - 26th Av - Chicago - MOA',
+         'direction': '1', 'direction_name': 'SOUTHBOUND',
+         'stop': 'BCTC', 'stop_name': 'Brooklyn Center Transit Center',
+         'departure': '65 Min', 'time': 1538973840000, 'realtime': False, 'stale': None},
+    ])
+
+def test_format_needs_the_nextrip_source(cli_runner, gtfs_feed):
+    result = cli_runner(SCRIPT_NAME, '--source', 'gtfs', '--gtfs', gtfs_feed, '--format', 'json',
+                        'Route 5', 'Brooklyn Center', 'south')
+
+    result | should.have.key('returncode').that.should.equal(2)
+
+def test_watch_prints_each_change(cli_runner):
+    mock.reset()
+    setup_routes_happy_path(mock)
+    setup_directions_happy_path(mock, '5')
+    setup_stops_happy_path(mock, '5', '1')
+    setup_times_actual_true_happy_path(mock, '5', '1', 'BCTC')
+    setup_times_actual_true_happy_path(mock, '5', '1', 'BCTC')
+    setup_times_actual_false_happy_path(mock, '5', '1', 'BCTC')
+
+    result = cli_runner(SCRIPT_NAME, '--watch', '0.01', '--polls', '3', '-d 1538969940000',
+                        '-h ' + mock.pretend_url, '5 - Brklyn Center', 'Brooklyn Center', 'south')
+
+    result | should.have.key('returncode').that.should.equal(0)
+    result['stdout'] | should.equal('16 Min\n22 Min\n')
+
+def test_watch_gives_each_poll_the_deadline(cli_runner):
+    mock.reset()
+    setup_routes_happy_path(mock)
+    setup_directions_happy_path(mock, '5')
+    setup_stops_happy_path(mock, '5', '1')
+    setup_times_actual_true_happy_path(mock, '5', '1', 'BCTC')
+    setup_times_actual_false_happy_path(mock, '5', '1', 'BCTC')
+
+    # Polls are over a second apart, so the second is past a deadline
+    # counted from the start.
+    result = cli_runner(SCRIPT_NAME, '--watch', '0.4', '--polls', '2', '--deadline', '1', '--departure-ttl', '0',
+                        '-d 1538969940000', '-h ' + mock.pretend_url, '5 - Brklyn Center', 'Brooklyn Center', 'south')
+
+    result | should.have.key('returncode').that.should.equal(0)
+    result['stdout'] | should.equal('16 Min\n22 Min\n')
+    result['stderr'] | should.do_not.contain('Out of time')
+
+@pytest.mark.parametrize('count', ['0', '-1'])
+def test_count_must_be_positive(cli_runner, count):
+    result = cli_runner(SCRIPT_NAME, '--count', count, '5 - Brklyn Center', 'Brooklyn Center', 'south')
+
+    result | should.have.key('returncode').that.should.equal(2)
+    result['stderr'] | should.contain('Invalid value for "--count"')
+
+@pytest.mark.parametrize('option', [('--watch', '-1'), ('--watch', '0'), ('--watch', '1', '--polls', '0')])
+def test_watch_rejects_nonpositive_values(cli_runner, option):
+    result = cli_runner(SCRIPT_NAME, *(option + ('5 - Brklyn Center', 'Brooklyn Center', 'south')))
+
+    result | should.have.key('returncode').that.should.equal(2)
+    result['stderr'] | should.contain('Invalid value')
+
+@pytest.fixture
+def gtfs_feed(tmpdir):
+    path = str(tmpdir.join('gtfs.zip'))
+    with zipfile.ZipFile(path, 'w') as feed:
+        for name, contents in FEED.items():
+            feed.writestr(name, contents)
+    return path
+
+def test_provider_rejects_missing_gtfs_feed(cli_runner):
+    result = cli_runner(SCRIPT_NAME, '-P', 'metro=gtfs:/nonexistent.zip', 'Route 5', 'Brooklyn Center', 'south')
+
+    result | should.have.key('returncode').that.should.equal(2)
+    result['stderr'] | should.contain('does not exist')
+
+def test_gtfs_source_reports_malformed_feed(cli_runner, tmpdir):
+    path = tmpdir.join('gtfs.zip')
+    path.write('not a zip')
+
+    result = cli_runner(SCRIPT_NAME, '--source', 'gtfs', '--gtfs', str(path),
+                        'Route 5', 'Brooklyn Center', 'south')
+
+    result | should.have.key('returncode').that.should.equal(1)
+    result['stderr'] | should.contain('ERROR: Could not read GTFS feed')
+    result['stderr'] | should.do_not.contain('Traceback')
+
+def test_near_lists_departures_from_nearby_stops(cli_runner, gtfs_feed):
+    result = cli_runner(SCRIPT_NAME, 'near', '45.05', '-93.295', '--radius', '2000', '--gtfs', gtfs_feed,
+                        '-d', local_millis(2018, 10, 8, 8, 0))
+
+    result | should.have.key('returncode').that.should.equal(0)
+    result['stdout'].splitlines() | should.equal([
+        '20 Min\t5 - Brklyn Center - Fremont - 26th Av - Chicago - MOA\tSouthbound\t44th Ave  and Fremont Ave \t1179 m',
+        '40 Min\t5 - Brklyn Center - Fremont - 26th Av - Chicago - MOA\tSouthbound\tBrooklyn Center Transit Center\t1179 m',
+        '55 Min\t5 - Brklyn Center - Fremont - 26th Av - Chicago - MOA\tNorthbound\tBrooklyn Center Transit Center\t1179 m',
+    ])
+
+def test_near_fails_without_stops_in_range(cli_runner, gtfs_feed):
+    result = cli_runner(SCRIPT_NAME, 'near', '44.0', '-93.0', '--gtfs', gtfs_feed)
+
+    result | should.have.key('returncode').that.should.equal(1)
+    result['stderr'] | should.equal('ERROR: No departures within 800 m\n')
+
+def test_gtfs_source(cli_runner, gtfs_feed):
+    result = cli_runner(SCRIPT_NAME, '--source', 'gtfs', '--gtfs', gtfs_feed,
+                        '-d', local_millis(2018, 10, 8, 8, 0),
+                        '5 - Brklyn Center', 'Brooklyn Center', 'south')
+
+    result | should.have.key('returncode').that.should.equal(0)
+    result['stdout'] | should.equal('10 Min\n')
+
+def test_watch_needs_the_nextrip_source(cli_runner, gtfs_feed):
+    result = cli_runner(SCRIPT_NAME, '--source', 'gtfs', '--gtfs', gtfs_feed, '--watch', '1',
+                        '5 - Brklyn Center', 'Brooklyn Center', 'south')
+
+    result | should.have.key('returncode').that.should.equal(2)
+    result['stderr'] | should.contain('--watch follows the NexTrip service')
+
+def test_watch_rejects_latency_budget(cli_runner):
+    result = cli_runner(SCRIPT_NAME, '--watch', '1', '--latency-budget', '0.5',
+                        '5 - Brklyn Center', 'Brooklyn Center', 'south')
+
+    result | should.have.key('returncode').that.should.equal(2)
+    result['stderr'] | should.contain('--latency-budget')
+
+def test_gtfs_source_requires_feed(cli_runner):
+    result = cli_runner(SCRIPT_NAME, '--source', 'gtfs', '5 - Brklyn Center', 'Brooklyn Center', 'south')
+
+    result | should.have.key('returncode').that.should.equal(2)
+    result['stderr'] | should.contain('--source gtfs needs --gtfs PATH')
+
+def test_gtfs_realtime_source(cli_runner, gtfs_feed, tmpdir):
+    trip_updates = tmpdir.join('trip-updates.pb')
+    trip_updates.write_binary(feed(trip_update('e1', 'south-1', [('BCTC', local_seconds(2018, 10, 8, 8, 12))])))
+
+    result = cli_runner(SCRIPT_NAME, '--source', 'gtfs-rt', '--gtfs', gtfs_feed, '--gtfs-rt', str(trip_updates),
+                        '-d', local_millis(2018, 10, 8, 8, 0), '--all',
+                        '5 - Brklyn Center', 'Brooklyn Center', 'south')
+
+    result | should.have.key('returncode').that.should.equal(0)
+    result['stdout'] | should.equal('12 Min\trealtime\n')
+
+def test_gtfs_realtime_provider(cli_runner, gtfs_feed, tmpdir):
+    trip_updates = tmpdir.join('trip-updates.pb')
+    trip_updates.write_binary(feed(trip_update('e1', 'south-1', [('BCTC', local_seconds(2018, 10, 8, 8, 12))])))
+
+    result = cli_runner(SCRIPT_NAME, '-P', 'metro=gtfs-rt:' + str(trip_updates), '--gtfs', gtfs_feed,
+                        '-d', local_millis(2018, 10, 8, 8, 0), '5 - Brklyn Center', 'Brooklyn Center', 'south')
+
+    result | should.have.key('returncode').that.should.equal(0)
+    result['stdout'] | should.equal('metro\t12 Min\n')
+
+def test_serve_answers_from_gtfs_realtime_feed(gtfs_feed, tmpdir):
+    trip_updates = tmpdir.join('trip-updates.pb')
+    trip_updates.write_binary(feed(trip_update('e1', 'south-1', [('BCTC', local_seconds(2018, 10, 8, 8, 12))])))
+    p, url = start_server(tmpdir, '--gtfs', gtfs_feed, '--gtfs-rt', str(trip_updates),
+                          '-d', local_millis(2018, 10, 8, 8, 0))
+    try:
+        result = requests.get(url + '/next', params=dict(route='5 - Brklyn Center',
+                                                      stop='Brooklyn Center', direction='south'))
+    finally:
+        p.terminate()
+        p.wait()
+
+    result.status_code | should.equal(200)
+    result.text | should.equal('12 Min\n')
+
+def test_gtfs_fallback_when_live_service_fails(cli_runner, gtfs_feed):
+    mock.reset()
+    mock.when('GET ' + ROUTE_PATH).reply(status=404, times=FOREVER)
+
+    result = cli_runner(SCRIPT_NAME, '--gtfs', gtfs_feed, '-d', local_millis(2018, 10, 8, 8, 0),
+                        '-h ' + mock.pretend_url, '5 - Brklyn Center', 'Brooklyn Center', 'south')
+
+    result | should.have.key('returncode').that.should.equal(0)
+    result['stdout'] | should.equal('10 Min\n')
+    result['stderr'] | should.equal('ERROR: Route endpoint misbehaved\n'
+                                    'WARNING: Answering from the GTFS schedule\n')
+
+def test_board_looks_up_every_query(cli_runner, tmpdir):
+    mock.reset()
+    setup_routes_happy_path(mock)
+    setup_directions_happy_path(mock, '5')
+    setup_stops_happy_path(mock, '5', '1')
+    setup_times_actual_true_happy_path(mock, '5', '1', 'BCTC')
+    setup_times_actual_false_happy_path(mock, '5', '1', '44FM')
+    queries = tmpdir.join('queries.csv')
+    queries.write('5 - Brklyn Center,Brooklyn Center,south\n'
+                  '# comment lines are skipped\n'
+                  '5 - Brklyn Center,44th,south\n')
+
+    result = cli_runner(SCRIPT_NAME, 'board', '-d 1538969940000', '-h ' + mock.pretend_url,
+                        str(queries))
+
+    result | should.have.key('returncode').that.should.equal(0)
+    result['stdout'] | should.equal('5 - Brklyn Center\tBrooklyn Center\tsouth\t16 Min\n'
+                                    '5 - Brklyn Center\t44th\tsouth\t22 Min\n')
+
+def test_board_fails_if_any_query_fails(cli_runner, tmpdir):
+    mock.reset()
+    setup_routes_happy_path(mock)
+    queries = tmpdir.join('queries.csv')
+    queries.write('junk,Brooklyn Center,south\n')
+
+    result = cli_runner(SCRIPT_NAME, 'board', '-h ' + mock.pretend_url, str(queries))
+
+    result | should.have.key('returncode').that.should.equal(1)
+    result['stdout'] | should.equal('junk\tBrooklyn Center\tsouth\t-\n')
+    result['stderr'] | should.equal('ERROR: Route not found\n')
+
+def test_board_writes_csv_records(cli_runner, tmpdir):
+    mock.reset()
+    setup_routes_happy_path(mock)
+    setup_directions_happy_path(mock, '5')
+    setup_stops_happy_path(mock, '5', '1')
+    setup_times_actual_true_happy_path(mock, '5', '1', 'BCTC')
+    queries = tmpdir.join('queries.csv')
+    queries.write('5 - Brklyn Center,Brooklyn Center,south\n'
+                  '5 - Brklyn Center,Brooklyn Center,west\n')
+
+    result = cli_runner(SCRIPT_NAME, 'board', '--format', 'csv', '-d 1538969940000',
+                        '-h ' + mock.pretend_url, str(queries))
+
+    result | should.have.key('returncode').that.should.equal(1)
+    result['stdout'].splitlines() | should.equal([
+        'route,route_name,direction,direction_name,stop,stop_name,departure,time,realtime,stale',
+        '5,5 - Brklyn Center - Fremont - 26th Av - Chicago - MOA,1,SOUTHBOUND,BCTC,'
+        'Brooklyn Center Transit Center,16 Min,1538971260000,True,',
+        ',5 - Brklyn Center,,west,,Brooklyn Center,,,,',
+    ])
+
+def test_deadline_answers_from_stale_cache(cli_runner):
+    mock.reset()
+    setup_routes_happy_path(mock)
+    setup_directions_happy_path(mock, '5')
+    setup_stops_happy_path(mock, '5', '1')
+    setup_times_actual_true_happy_path(mock, '5', '1', 'BCTC')
+    query = ['-d 1538969940000', '-h ' + mock.pretend_url, '5 - Brklyn Center', 'Brooklyn Center', 'south']
+    cli_runner(SCRIPT_NAME, *query)
+
+    result = cli_runner(SCRIPT_NAME, '--cache-ttl', '0', '--deadline', '0', *query)
+
+    result | should.have.key('returncode').that.should.equal(1)
+    result['stderr'] | should.contain('WARNING: Using stale Route data')
+    result['stderr'] | should.contain('WARNING: Using stale Stop data')
+    result['stderr'] | should.contain('ERROR: Out of time before asking the Time endpoint')
+
+def test_history_reports_polled_departures(cli_runner, tmpdir):
+    mock.reset()
+    setup_routes_happy_path(mock)
+    setup_directions_happy_path(mock, '5')
+    setup_stops_happy_path(mock, '5', '1')
+    setup_times_actual_true_happy_path(mock, '5', '1', 'BCTC')
+    history = str(tmpdir.join('history'))
+
+    result = cli_runner(SCRIPT_NAME, '--history', history, '-d 1538969940000', '-h ' + mock.pretend_url,
+                        '5 - Brklyn Center', 'Brooklyn Center', 'south')
+    result | should.have.key('returncode').that.should.equal(0)
+
+    result = cli_runner(SCRIPT_NAME, 'history', history)
+    result | should.have.key('returncode').that.should.equal(0)
+    result['stdout'] | should.equal('stop\tdepartures\tpredictions\tmean_error\tmean_abs_error\t'
+                                    'p90_abs_error\tmean_headway\tmean_wait\n'
+                                    '5/1/BCTC\t2\t0\t-\t-\t-\t43.0\t21.5\n')
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def start_server(tmpdir, *arguments):
+    port = free_port()
+    env = dict(os.environ, NEXT_BUS_CACHE=str(tmpdir.join('cache.sqlite3')),
+               NEXT_BUS_CATALOG=str(tmpdir.join('catalog.tsv')))
+    p = subprocess.Popen([SCRIPT_NAME, 'serve', '--port', str(port)] + list(arguments),
+                         stderr=subprocess.PIPE, env=env)
+    p.stderr.readline()
+    return p, 'http://127.0.0.1:{}'.format(port)
+
+@pytest.fixture
+def server(tmpdir):
+    p, url = start_server(tmpdir, '-d 1538969940000', '-h ' + mock.pretend_url)
+    yield url
+    p.terminate()
+    p.wait()
+
+def test_serve_answers_next_departure(server):
+    mock.reset()
+    setup_routes_happy_path(mock)
+    setup_directions_happy_path(mock, '5')
+    setup_stops_happy_path(mock, '5', '1')
+    setup_times_actual_false_happy_path(mock, '5', '1', '44FM')
+
+    result = requests.get(server + '/next', params=dict(route='5 - Brklyn Center',
+                                                         stop='44th', direction='south'))
+
+    result.status_code | should.equal(200)
+    result.text | should.equal('22 Min\n')
+
+def test_serve_answers_json(server):
+    mock.reset()
+    setup_routes_happy_path(mock)
+    setup_directions_happy_path(mock, '5')
+    setup_stops_happy_path(mock, '5', '1')
+    setup_times_actual_true_happy_path(mock, '5', '1', 'BCTC')
+
+    result = requests.get(server + '/next', params=dict(route='5 - Brklyn Center', format='json',
+                                                         stop='Brooklyn Center', direction='south'))
+
+    result.status_code | should.equal(200)
+    result.json() | should.equal(dict(route='5 - Brklyn Center', stop='Brooklyn Center',
+                                      direction='south', departure='16 Min'))
+
+def test_serve_rejects_incomplete_queries(server):
+    result = requests.get(server + '/next', params=dict(route='5 - Brklyn Center'))
+
+    result.status_code | should.equal(400)
+    result.text | should.equal('ERROR: Missing stop, direction\n')
+
+def test_serve_rejects_bad_date_time(server):
+    result = requests.get(server + '/next', params=dict(route='5 - Brklyn Center', stop='44th',
+                                                         direction='south', date_time='abc'))
+
+    result.status_code | should.equal(400)
+    result.text | should.equal('ERROR: date_time must be milliseconds since the epoch\n')
+
+def test_serve_reports_upstream_failure(server):
+    mock.reset()
+    setup_routes_happy_path(mock)
+    setup_directions_happy_path(mock, '5')
+    setup_stops_happy_path(mock, '5', '1')
+    mock.when('GET ' + TIME_PATH.format(route='5', direction='1', stop='44FM')).reply(status=404, times=FOREVER)
+
+    result = requests.get(server + '/next', params=dict(route='5 - Brklyn Center',
+                                                         stop='44th', direction='south'))
+    result.status_code | should.equal(502)
+
+    result = requests.get(server + '/next', params=dict(route='5 - Brklyn Center',
+                                                         stop='junk', direction='south'))
+    result.status_code | should.equal(404)
+
+def test_serve_keeps_files_that_are_not_sockets(cli_runner, tmpdir):
+    path = tmpdir.join('precious.txt')
+    path.write('keep me')
+
+    result = cli_runner(SCRIPT_NAME, 'serve', '--socket', str(path))
+
+    result | should.have.key('returncode').that.should.equal(2)
+    result['stderr'] | should.contain('is not a socket')
+    path.read() | should.equal('keep me')
+
+def test_batch_answers_queries_from_archive(cli_runner, tmpdir):
+    from test_archive import FETCHED, HOST, MINUTE, make_archive
+    make_archive(str(tmpdir.join('archive')))
+    queries = tmpdir.join('queries.csv')
+    queries.write('Brklyn,Brooklyn Center,south,{}\n'
+                  'Brklyn,junk,south,{}\n'.format(FETCHED + MINUTE, FETCHED))
+
+    result = cli_runner(SCRIPT_NAME, 'batch', '-h', HOST, '-j', '2', str(tmpdir.join('archive')), str(queries))
+
+    result | should.have.key('returncode').that.should.equal(0)
+    result['stdout'] | should.equal('Brklyn,Brooklyn Center,south,{},4 Min\n'
+                                    'Brklyn,junk,south,{},-\n'.format(FETCHED + MINUTE, FETCHED))
+    result['stderr'] | should.equal('2 queries, 1 answered\n')
+
+def test_replay_stands_in_for_recorded_service(cli_runner, tmpdir):
+    mock.reset()
+    setup_routes_happy_path(mock)
+    setup_directions_happy_path(mock, '5')
+    setup_stops_happy_path(mock, '5', '1')
+    setup_times_actual_true_happy_path(mock, '5', '1', 'BCTC')
+    archive = str(tmpdir.join('archive'))
+    query = ['--no-cache', '-d 1538969940000', '5 - Brklyn Center', 'Brooklyn Center', 'south']
+
+    result = cli_runner(SCRIPT_NAME, '--record', archive, '-h', mock.pretend_url, *query)
+
+    result['stdout'] | should.equal('16 Min\n')
+    mock.reset()
+    port = free_port()
+    p = subprocess.Popen([SCRIPT_NAME, 'replay', '--port', str(port), '--latency-scale', '0', archive],
+                         stderr=subprocess.PIPE)
+    try:
+        p.stderr.readline().decode('ASCII') | should.contain('Replaying 4 responses')
+
+        result = cli_runner(SCRIPT_NAME, '-h', 'http://127.0.0.1:{}'.format(port), *query)
+
+        result | should.have.key('returncode').that.should.equal(0)
+        result['stdout'] | should.equal('16 Min\n')
+    finally:
+        p.terminate()
+        p.wait()
+
+def test_recorded_archive_answers_batch_and_replay(cli_runner, tmpdir):
+    mock.reset()
+    setup_routes_happy_path(mock)
+    setup_directions_happy_path(mock, '5')
+    setup_stops_happy_path(mock, '5', '1')
+    mock.when('GET ' + TIME_PATH.format(route='5', direction='1', stop='BCTC')).reply(json.dumps([{
+        "Actual": False, "BlockNumber": 1010, "DepartureText": "11:44",
+        "DepartureTime": "\\/Date(4102444800000-0500)\\/", "Description": "Brklyn Ctr Tc",
+    }]), headers={'Content-Type': 'application/json'}, status=200, times=FOREVER)
+    archive = tmpdir.join('archive')
+    query = ['-h', mock.pretend_url, '5 - Brklyn Center', 'Brooklyn Center', 'south']
+
+    # The second lookup resolves from the cache, and still records what it used.
+    cli_runner(SCRIPT_NAME, *query) | should.have.key('returncode').that.should.equal(0)
+    cli_runner(SCRIPT_NAME, '--record', str(archive), *query) | should.have.key('returncode').that.should.equal(0)
+
+    fetched = int(archive.join('departures.tsv').read().split('\t')[0])
+    queries = tmpdir.join('queries.csv')
+    queries.write('Brklyn,Brooklyn Center,south,{}\n'.format(fetched + 60000))
+    result = cli_runner(SCRIPT_NAME, 'batch', '-h', mock.pretend_url, '-j', '1', str(archive), str(queries))
+
+    result['stderr'] | should.equal('1 queries, 1 answered\n')
+
+    port = free_port()
+    p = subprocess.Popen([SCRIPT_NAME, 'replay', '--port', str(port), '--latency-scale', '0', str(archive)],
+                         stderr=subprocess.PIPE)
+    try:
+        p.stderr.readline().decode('ASCII') | should.contain('Replaying 4 responses')
+        result = cli_runner(SCRIPT_NAME, '--no-cache', '-h', 'http://127.0.0.1:{}'.format(port), *query[2:])
+        result | should.have.key('returncode').that.should.equal(0)
+    finally:
+        p.terminate()
+        p.wait()
+
 # TODO Error on direction that doesn't make sense based on stop?
+
+def test_providers_are_asked_together(cli_runner, gtfs_feed):
+    mock.reset()
+    setup_routes_happy_path(mock)
+    setup_directions_happy_path(mock, '5')
+    setup_stops_happy_path(mock, '5', '1')
+    setup_times_actual_true_happy_path(mock, '5', '1', 'BCTC')
+
+    result = cli_runner(SCRIPT_NAME, '-P', 'metro=' + mock.pretend_url, '-P', 'schedule=gtfs:' + gtfs_feed,
+                        '-d', local_millis(2018, 10, 8, 8, 0),
+                        '5 - Brklyn Center', 'Brooklyn Center', 'south')
+
+    result | should.have.key('returncode').that.should.equal(0)
+    result['stdout'] | should.equal('metro\t16 Min\nschedule\t10 Min\n')
+
+def test_provider_needs_a_name(cli_runner):
+    result = cli_runner(SCRIPT_NAME, '-P', 'http://svc.example', '5', 'Brooklyn Center', 'south')
+
+    result | should.have.key('returncode').that.should.equal(2)
+    result['stderr'] | should.contain('Expected NAME=URL, NAME=gtfs:PATH or NAME=gtfs-rt:URL')
@@ -0,0 +1,335 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import zipfile
+
+import pytest
+from grappa import should
+
+from gtfs import *
+
+FEED={
+    'routes.txt': """route_id,route_short_name,route_long_name
+5,5,Brklyn Center - Fremont - 26th Av - Chicago - MOA
+901,,METRO Blue Line
+""",
+    'stops.txt': """stop_id,stop_name,stop_lat,stop_lon
+BCTC,Brooklyn Center Transit Center,45.06,-93.30
+44FM,44th Ave  and Fremont Ave ,45.04,-93.29
+MOA,Mall of America,44.85,-93.24
+""",
+    'calendar.txt': """service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date
+WK,1,1,1,1,1,0,0,20180101,20181231
+WE,0,0,0,0,0,1,1,20180101,20181231
+""",
+    'calendar_dates.txt': """service_id,date,exception_type
+WK,20181009,2
+""",
+    'trips.txt': """route_id,service_id,trip_id,trip_headsign,direction_id,direction
+5,WK,south-1,MOA,1,Southbound
+5,WK,south-2,MOA,1,Southbound
+5,WK,south-late,MOA,1,Southbound
+5,WE,south-weekend,MOA,1,Southbound
+5,WK,north-1,Brooklyn Center,0,Northbound
+""",
+    'stop_times.txt': """trip_id,arrival_time,departure_time,stop_id,stop_sequence
+south-1,08:10:00,08:10:00,BCTC,1
+south-1,08:20:00,08:20:00,44FM,2
+south-1,09:00:00,09:00:00,MOA,3
+south-2,08:40:00,08:40:00,BCTC,1
+south-2,08:50:00,08:50:00,44FM,2
+south-late,24:30:00,24:30:00,BCTC,1
+south-weekend,08:05:00,08:05:00,BCTC,1
+north-1,08:15:00,08:15:00,MOA,1
+north-1,08:55:00,08:55:00,BCTC,2
+""",
+}
+
+
+def local_millis(year, month, day, hour, minute):
+    return str(int(time.mktime((year, month, day, hour, minute, 0, 0, 0, -1))) * 1000)
+
+
+def local_seconds(year, month, day, hour, minute):
+    return int(local_millis(year, month, day, hour, minute)) // 1000
+
+
+def varint(value):
+    value &= (1 << 64) - 1
+    encoded = bytearray()
+    while value >= 0x80:
+        encoded.append(value & 0x7f | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def message(*fields):
+    # Encodes (field number, value) pairs: ints as varints, text and nested
+    # messages as length-delimited fields.
+    encoded = b''
+    for number, value in fields:
+        if isinstance(value, int):
+            encoded += varint(number << 3) + varint(value)
+        else:
+            value = value.encode('utf-8') if isinstance(value, str) else value
+            encoded += varint(number << 3 | 2) + varint(len(value)) + value
+    return encoded
+
+
+def trip_update(entity_id, trip_id, stop_times, route_id='5', start_date='20181008'):
+    # stop_times are (stop id, epoch) or (stop id, None, delay) tuples.
+    updates = []
+    for stop_id, epoch, *delay in stop_times:
+        event = message((2, epoch)) if epoch is not None else message((1, delay[0]))
+        updates.append((2, message((3, event), (4, stop_id))))
+    trip = message((1, trip_id), (3, start_date), (5, route_id))
+    return (2, message((1, entity_id), (3, message((1, trip), *updates))))
+
+
+def feed(*entities, full=True):
+    header = message((1, '2.0'), (2, 0 if full else 1), (3, local_seconds(2018, 10, 8, 8, 0)))
+    return message((1, header), *entities)
+
+
+class TestSchedule(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'gtfs.zip')
+        with zipfile.ZipFile(self.path, 'w') as feed:
+            for name, contents in FEED.items():
+                feed.writestr(name, contents)
+        self.schedule = Schedule.load(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_departures_returns_next_scheduled_departure(self):
+        departures = self.schedule.departures('Brklyn Center', 'Brooklyn Center', 'south',
+                                              local_millis(2018, 10, 8, 8, 0))
+        departures | should.equal([('10 Min', False)])
+
+    def test_departures_returns_several_departures(self):
+        departures = self.schedule.departures('Brklyn Center', '44th', 'south',
+                                              local_millis(2018, 10, 8, 8, 0), count=2)
+        departures | should.equal([('20 Min', False), ('50 Min', False)])
+
+    def test_departures_only_counts_matching_direction(self):
+        departures = self.schedule.departures('Brklyn Center', 'Brooklyn Center', 'north',
+                                              local_millis(2018, 10, 8, 8, 0))
+        departures | should.equal([('55 Min', False)])
+
+    def test_departures_uses_weekend_service(self):
+        departures = self.schedule.departures('Brklyn Center', 'Brooklyn Center', 'south',
+                                              local_millis(2018, 10, 13, 8, 0))
+        departures | should.equal([('5 Min', False)])
+
+    def test_departures_finds_trips_after_midnight(self):
+        departures = self.schedule.departures('Brklyn Center', 'Brooklyn Center', 'south',
+                                              local_millis(2018, 10, 9, 0, 15))
+        departures | should.equal([('15 Min', False)])
+
+    def test_departures_honours_removed_service_days(self):
+        departures = self.schedule.departures('Brklyn Center', 'Brooklyn Center', 'south',
+                                              local_millis(2018, 10, 9, 8, 0))
+        departures | should.equal([('{} Min'.format(24 * 60 + 10), False)])
+
+    def test_departures_returns_None_for_unknown_stop(self):
+        departures = self.schedule.departures('Brklyn Center', 'junk', 'south',
+                                              local_millis(2018, 10, 8, 8, 0))
+        departures | should.be.none
+
+    def test_departures_returns_None_for_stop_off_route(self):
+        departures = self.schedule.departures('Blue Line', 'Brooklyn Center', 'south',
+                                              local_millis(2018, 10, 8, 8, 0))
+        departures | should.be.none
+
+    def test_nearest_stops_come_nearest_first(self):
+        stops = self.schedule.nearest_stops(45.045, -93.29, 2000)
+        [self.schedule.stops[stop].value for _, stop in stops] | should.equal(['44FM', 'BCTC'])
+        stops[0][0] | should.be.lower.than(600)
+
+    def test_nearest_stops_limits_count(self):
+        self.schedule.nearest_stops(45.045, -93.29, 2000, count=1) | should.have.length(1)
+
+    def test_nearby_skips_departures_that_cant_be_reached_on_foot(self):
+        departures = self.schedule.nearby(45.05, -93.295, 2000, 5, local_millis(2018, 10, 8, 8, 0))
+        [(epoch, stop.value, direction) for epoch, _, _, direction, stop, _ in departures] | should.equal([
+            (local_seconds(2018, 10, 8, 8, 20), '44FM', 'Southbound'),
+            (local_seconds(2018, 10, 8, 8, 40), 'BCTC', 'Southbound'),
+            (local_seconds(2018, 10, 8, 8, 55), 'BCTC', 'Northbound'),
+        ])
+
+    def test_load_reuses_saved_index(self):
+        ingest = vars(Schedule)['ingest']
+        try:
+            Schedule.ingest = None
+            schedule = Schedule.load(self.path)
+        finally:
+            Schedule.ingest = ingest
+        schedule.stop_secs | should.equal(self.schedule.stop_secs)
+
+    def test_saved_index_restores_every_table(self):
+        ingested = Schedule.ingest(self.path)
+        vars(Schedule.load(self.path)) | should.equal(vars(ingested))
+
+    def test_load_reingests_unreadable_index(self):
+        index_path = self.path + INDEX_SUFFIX
+        with open(index_path, 'rb') as f:
+            data = f.read()
+        for junk in [b'\x80\x04K\x01.', b'{}\n', b'[]\n', data[:-4], data + b'x']:
+            with open(index_path, 'wb') as f:
+                f.write(junk)
+            Schedule.load(self.path).stop_secs | should.equal(self.schedule.stop_secs)
+            with open(index_path, 'rb') as f:
+                f.read() | should.equal(data)
+
+    def test_load_reingests_changed_feed(self):
+        with zipfile.ZipFile(self.path, 'a') as feed:
+            feed.writestr('agency.txt', 'agency_id\n')
+        os.utime(self.path, (0, 0))
+        schedule = Schedule.load(self.path)
+        schedule.stop_secs | should.equal(self.schedule.stop_secs)
+
+    def test_load_reports_malformed_zip(self):
+        path = os.path.join(self.dir, 'junk.zip')
+        with open(path, 'w') as f:
+            f.write('not a zip')
+        with self.assertLogs(level='ERROR') as logs:
+            Schedule.load(path) | should.be.none
+        logs.output[0] | should.contain('ERROR: Could not read GTFS feed')
+
+    def test_load_reports_missing_tables(self):
+        path = os.path.join(self.dir, 'other.zip')
+        with zipfile.ZipFile(path, 'w') as feed:
+            for name, contents in FEED.items():
+                if name != 'stop_times.txt':
+                    feed.writestr(name, contents)
+        with self.assertLogs(level='ERROR') as logs:
+            Schedule.load(path) | should.be.none
+        logs.output[0] | should.contain('stop_times.txt is missing')
+
+    def test_read_table_yields_rows_as_it_reads(self):
+        with zipfile.ZipFile(self.path) as feed:
+            rows = read_table(feed, 'stops.txt')
+            next(rows)['stop_id'] | should.equal('BCTC')
+            list(rows) | should.have.length.of(2)
+            list(read_table(feed, 'shapes.txt', required=False)) | should.equal([])
+
+    def test_load_reports_missing_files(self):
+        with self.assertLogs(level='ERROR'):
+            Schedule.load(os.path.join(self.dir, 'nonexistent.zip')) | should.be.none
+
+    def test_load_skips_rows_for_unknown_trips_and_stops(self):
+        path = os.path.join(self.dir, 'other.zip')
+        with zipfile.ZipFile(path, 'w') as feed:
+            for name, contents in FEED.items():
+                if name == 'stop_times.txt':
+                    contents += 'ghost,08:30:00,08:30:00,BCTC,1\nsouth-2,08:45:00,08:45:00,NOWHERE,2\n'
+                elif name == 'trips.txt':
+                    contents += '999,WK,orphan,MOA,1,Southbound\n'
+                feed.writestr(name, contents)
+        schedule = Schedule.load(path)
+        schedule.departures('Brklyn Center', 'Brooklyn Center', 'south',
+                            local_millis(2018, 10, 8, 8, 0), count=2) | should.equal(
+            [('10 Min', False), ('40 Min', False)])
+
+
+class TestRealtime(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        path = os.path.join(self.dir, 'gtfs.zip')
+        with zipfile.ZipFile(path, 'w') as f:
+            for name, contents in FEED.items():
+                f.writestr(name, contents)
+        self.feed_path = os.path.join(self.dir, 'trip-updates.pb')
+        self.realtime = Realtime(Schedule.load(path), self.feed_path, interval=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, data):
+        with open(self.feed_path, 'wb') as f:
+            f.write(data)
+
+    def departures(self, stop='44th', count=1):
+        return self.realtime.departures('Brklyn Center', stop, 'south', local_millis(2018, 10, 8, 8, 0), count)
+
+    def test_departures_come_from_the_feed(self):
+        self.write(feed(trip_update('e1', 'south-1', [('44FM', local_seconds(2018, 10, 8, 8, 25))]),
+                        trip_update('e2', 'south-2', [('44FM', local_seconds(2018, 10, 8, 8, 52))])))
+        self.departures(count=None) | should.equal([('25 Min', True), ('52 Min', True)])
+
+    def test_delays_apply_to_scheduled_times(self):
+        self.write(feed(trip_update('e1', 'south-1', [('44FM', None, 180)])))
+        self.departures() | should.equal([('23 Min', True)])
+
+    def test_unchanged_trips_are_skipped(self):
+        first = trip_update('e1', 'south-1', [('44FM', local_seconds(2018, 10, 8, 8, 25))])
+        self.realtime.apply(feed(first)) | should.equal((1, 0))
+        moved = trip_update('e2', 'south-2', [('44FM', local_seconds(2018, 10, 8, 8, 55))])
+        self.realtime.apply(feed(first, moved)) | should.equal((1, 0))
+        self.realtime.apply(feed(first, moved)) | should.equal((0, 0))
+
+    def test_full_snapshots_drop_missing_trips(self):
+        self.realtime.apply(feed(trip_update('e1', 'south-1', [('44FM', local_seconds(2018, 10, 8, 8, 25))]),
+                                 trip_update('e2', 'south-2', [('44FM', local_seconds(2018, 10, 8, 8, 52))])))
+        self.realtime.apply(feed(trip_update('e2', 'south-2', [('44FM', local_seconds(2018, 10, 8, 8, 52))])))
+        self.realtime.stops['44FM'] | should.have.length(1)
+
+    def test_differential_updates_keep_other_trips(self):
+        self.realtime.apply(feed(trip_update('e1', 'south-1', [('44FM', local_seconds(2018, 10, 8, 8, 25))]),
+                                 trip_update('e2', 'south-2', [('44FM', local_seconds(2018, 10, 8, 8, 52))])))
+        deleted = (2, message((1, 'e1'), (2, 1)))
+        self.realtime.apply(feed(deleted, full=False)) | should.equal((0, 1))
+        [departure[1] for departure in self.realtime.stops['44FM']] | should.equal(['e2'])
+
+    def test_malformed_snapshots_leave_the_last_one(self):
+        self.realtime.apply(feed(trip_update('e1', 'south-1', [('44FM', local_seconds(2018, 10, 8, 8, 25))])))
+        with pytest.raises(ValueError):
+            self.realtime.apply(feed(trip_update('e2', 'south-2', [('44FM', local_seconds(2018, 10, 8, 8, 52))]),
+                                     trip_update('e3', 'south-1', [('44FM', None, 60)], start_date='junk')))
+        [departure[1] for departure in self.realtime.stops['44FM']] | should.equal(['e1'])
+
+    def test_trips_missing_from_the_schedule_only_match_their_direction(self):
+        # Only southbound trips serve 44FM; both directions serve BCTC.
+        self.write(feed(trip_update('e1', 'extra-1', [('44FM', local_seconds(2018, 10, 8, 8, 5))]),
+                        trip_update('e2', 'extra-2', [('BCTC', local_seconds(2018, 10, 8, 8, 3))])))
+        self.departures() | should.equal([('5 Min', True)])
+        self.realtime.departures('Brklyn Center', 'Brooklyn Center', 'north',
+                                 local_millis(2018, 10, 8, 8, 0)) | should.equal([('55 Min', False)])
+
+    def test_stale_feed_is_reused_within_interval(self):
+        self.realtime.interval = 60
+        self.write(feed(trip_update('e1', 'south-1', [('44FM', local_seconds(2018, 10, 8, 8, 25))])))
+        self.departures()
+        self.write(feed(trip_update('e1', 'south-1', [('44FM', local_seconds(2018, 10, 8, 8, 30))])))
+        self.departures() | should.equal([('25 Min', True)])
+
+    def test_departures_fall_back_to_schedule_without_predictions(self):
+        self.write(feed())
+        self.departures() | should.equal([('20 Min', False)])
+
+    def test_nearby_uses_predictions(self):
+        self.write(feed(trip_update('e1', 'south-1', [('44FM', local_seconds(2018, 10, 8, 8, 25))])))
+        departures = self.realtime.nearby(45.04, -93.29, 100, 5, local_millis(2018, 10, 8, 8, 0))
+        [(epoch, realtime) for epoch, realtime, *_ in departures] | should.equal([
+            (local_seconds(2018, 10, 8, 8, 25), True)])
+
+    def test_truncated_messages_are_rejected(self):
+        data = feed(trip_update('e1', 'south-1', [('44FM', local_seconds(2018, 10, 8, 8, 25))]))
+        with pytest.raises(ValueError):
+            list(read_fields(memoryview(data[:-3])))
+
+
+def test_read_fields_decodes_negative_varints():
+    fields = list(read_fields(memoryview(message((1, -5)))))
+    [signed(value) for _, _, value in fields] | should.equal([-5])
+
+
+def test_parse_seconds_allows_times_past_midnight():
+    parse_seconds('25:01:30') | should.equal(25 * 3600 + 90)
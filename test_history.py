@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from grappa import should
+
+from history import *
+from next_bus import TIME_PATH, Departure
+
+HOST='http://history.fake'
+BCTC=HOST+TIME_PATH.format(route='5', direction='1', stop='BCTC')
+OSSEO=HOST+TIME_PATH.format(route='5', direction='1', stop='47OS')
+POLLED=1538989200000
+MINUTE=60000
+DAY=24*60*MINUTE
+
+
+def add_polls(store):
+    # Block 100 is predicted three times before leaving at 12.5 minutes,
+    # then comes round again. Block 101 is scheduled, then predicted.
+    store.add(BCTC, [Departure('12 Min', True, POLLED + 12*MINUTE, 100),
+                     Departure('10:12', False, POLLED + 72*MINUTE, 100)], POLLED)
+    store.add(BCTC, [Departure('13 Min', True, POLLED + 13*MINUTE, 100)], POLLED + 5*MINUTE)
+    store.add(BCTC, [Departure('2 Min', True, POLLED + 12*MINUTE + 30000, 100),
+                     Departure('9:27', False, POLLED + 27*MINUTE + 30000, 101)], POLLED + 10*MINUTE)
+    store.add(BCTC, [Departure('8 Min', True, POLLED + 28*MINUTE, 101)], POLLED + 20*MINUTE)
+    store.add(BCTC, [Departure('10 Min', True, POLLED + 50*MINUTE, 100)], POLLED + 40*MINUTE)
+    store.add(OSSEO, [Departure('Due', True, POLLED + DAY, 7)], POLLED + DAY)
+
+
+class TestHistoryStore(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store = HistoryStore(self.path)
+        add_polls(self.store)
+        self.store.flush()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_rows_are_partitioned_by_day(self):
+        sorted(os.listdir(self.path)) | should.equal(['2018-10-08.nbh', '2018-10-09.nbh'])
+
+    def test_read_returns_columns(self):
+        keys, columns = self.store.read()
+        keys | should.equal(['5/1/BCTC', '5/1/47OS'])
+        list(columns['polled'][:3]) | should.equal([POLLED, POLLED, POLLED + 5*MINUTE])
+        list(columns['time'][:2]) | should.equal([POLLED + 12*MINUTE, POLLED + 72*MINUTE])
+        list(columns['block']) | should.equal([100, 100, 100, 100, 101, 101, 100, 7])
+        list(columns['actual']) | should.equal([1, 0, 1, 1, 0, 1, 1, 1])
+        list(columns['key']) | should.equal([0] * 7 + [1])
+
+    def test_read_filters_by_time_and_stop(self):
+        keys, columns = self.store.read(since=POLLED + 10*MINUTE, until=POLLED + DAY)
+        list(columns['polled']) | should.equal([POLLED + 10*MINUTE] * 2 + [POLLED + 20*MINUTE, POLLED + 40*MINUTE])
+
+        self.store.partitions(since=POLLED + DAY) | should.equal([os.path.join(self.path, '2018-10-09.nbh')])
+        keys, columns = self.store.read(stop='5/1/47')
+        [keys[key] for key in columns['key']] | should.equal(['5/1/47OS'])
+
+    def test_read_skips_a_block_being_written(self):
+        path = os.path.join(self.path, '2018-10-08.nbh')
+        with open(path, 'ab') as f:
+            f.write(BLOCK_HEADER.pack(BLOCK_MAGIC, 10, 1000) + b'partial')
+        len(self.store.read()[1]['polled']) | should.equal(8)
+
+    def test_flushes_full_blocks(self):
+        store = HistoryStore(self.path, block_rows=2)
+        store.add(OSSEO, [Departure('Due', True, POLLED + DAY, 7)] * 2, POLLED + DAY)
+        len(self.store.read(stop='5/1/47')[1]['polled']) | should.equal(3)
+
+
+class TestStopStats(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        store = HistoryStore(self.path)
+        add_polls(store)
+        store.flush()
+        self.stats = stop_stats(*store.read())
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_prediction_errors_are_measured_against_departure(self):
+        bctc = self.stats[1]
+        (bctc['stop'], bctc['departures'], bctc['predictions']) | should.equal(('5/1/BCTC', 3, 2))
+        (bctc['mean_error'], bctc['mean_abs_error'], bctc['p90_abs_error']) | should.equal((0.0, 30.0, 30.0))
+
+    def test_headways_and_waits(self):
+        (self.stats[1]['mean_headway'], self.stats[1]['mean_wait']) | should.equal((18.8, 9.7))
+
+    def test_stops_without_headways(self):
+        self.stats[0] | should.equal({'stop': '5/1/47OS', 'departures': 1, 'predictions': 0,
+                                      'mean_error': None, 'mean_abs_error': None, 'p90_abs_error': None,
+                                      'mean_headway': None, 'mean_wait': None})
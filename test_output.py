@@ -0,0 +1,75 @@
+import io
+import json
+import unittest
+
+from grappa import should
+
+from output import *
+
+RECORDS=[
+    {'route': '5', 'departure': '16 Min', 'time': 1538971260000, 'realtime': True, 'stale': None},
+    {'route': '5', 'departure': '11:44', 'time': 1538973840000, 'realtime': False, 'stale': 60},
+]
+
+
+def write(output_format, records, **options):
+    out = io.BytesIO()
+    with RecordWriter(out, output_format, fields=['route', 'departure', 'time', 'realtime', 'stale'],
+                      **options) as writer:
+        writer.write_records(records)
+    return out.getvalue()
+
+
+class TestRecordWriter(unittest.TestCase):
+
+    def test_json_is_one_array(self):
+        json.loads(write('json', RECORDS).decode('utf-8')) | should.equal(RECORDS)
+        json.loads(write('json', []).decode('utf-8')) | should.equal([])
+
+    def test_ndjson_is_a_record_per_line(self):
+        [json.loads(line) for line in write('ndjson', RECORDS).splitlines()] | should.equal(RECORDS)
+
+    def test_csv_has_a_header_and_blank_nones(self):
+        write('csv', RECORDS).decode('utf-8').splitlines() | should.equal([
+            'route,departure,time,realtime,stale',
+            '5,16 Min,1538971260000,True,',
+            '5,11:44,1538973840000,False,60',
+        ])
+
+    def test_msgpack_is_a_map_per_record(self):
+        write('msgpack', [{'stale': None, 'realtime': True, 'time': 1538971260000}]) | should.equal(
+            b'\x83\xa5stale\xc0\xa8realtime\xc3\xa4time\xcf\x00\x00\x01\x66\x51\xd5\xd4\x60')
+
+    def test_flushes_when_the_buffer_fills(self):
+        out = io.BytesIO()
+        writer = RecordWriter(out, 'ndjson', buffer_size=100)
+        writer.write_records(RECORDS[:1])
+        out.getvalue() | should.equal(b'')
+        writer.write_records(RECORDS[1:])
+        len(out.getvalue().splitlines()) | should.equal(2)
+
+    def test_rejects_unknown_formats(self):
+        with self.assertRaises(ValueError):
+            RecordWriter(io.BytesIO(), 'xml')
+
+
+class TestPack(unittest.TestCase):
+
+    def pack(self, value):
+        buffer = bytearray()
+        pack(value, buffer)
+        return bytes(buffer)
+
+    def test_packs_ints_in_the_smallest_form(self):
+        [self.pack(n) for n in (5, -3, 200, -200, 70000, -70000)] | should.equal([
+            b'\x05', b'\xfd', b'\xcc\xc8', b'\xd1\xff\x38', b'\xce\x00\x01\x11\x70', b'\xd2\xff\xfe\xee\x90'])
+
+    def test_packs_strings_by_length(self):
+        self.pack('ab') | should.equal(b'\xa2ab')
+        self.pack('x' * 40)[:2] | should.equal(b'\xd9\x28')
+        self.pack('x' * 300)[:3] | should.equal(b'\xda\x01\x2c')
+
+    def test_packs_floats_bytes_and_lists(self):
+        self.pack(1.5) | should.equal(b'\xcb\x3f\xf8\x00\x00\x00\x00\x00\x00')
+        self.pack(b'\x00\x01') | should.equal(b'\xc4\x02\x00\x01')
+        self.pack([False, None]) | should.equal(b'\x92\xc2\xc0')
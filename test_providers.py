@@ -0,0 +1,162 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+
+import pook
+import pytest
+from grappa import should
+
+from next_bus import DIR_PATH, ROUTE_PATH, STOP_PATH, TIME_PATH, use_cache
+from providers import *
+from test_gtfs import FEED, feed, local_millis, local_seconds, trip_update
+from test_units import DIRS, ROUTES, STOPS, TIMES_ACTUAL, TIMES_NONACTUAL
+
+
+def mock_agency(host, times):
+    pook.get(host+ROUTE_PATH, reply=200, response_json=ROUTES)
+    pook.get(host+DIR_PATH.format(route='5'), reply=200, response_json=DIRS)
+    pook.get(host+STOP_PATH.format(route='5', direction='1'), reply=200, response_json=STOPS)
+    pook.get(host+TIME_PATH.format(route='5', direction='1', stop='BCTC'), reply=200, response_json=times)
+
+
+class CountingSession(object):
+
+    def __init__(self, session):
+        self.session = session
+        self.urls = []
+
+    def get(self, url, **kwargs):
+        self.urls.append(url)
+        return self.session.get(url, **kwargs)
+
+
+class TestProviders(unittest.TestCase):
+
+    def setUp(self):
+        use_cache(None)
+
+    @pook.on
+    def test_departures_from_all_asks_every_provider(self):
+        mock_agency('http://agency-a.fake', TIMES_ACTUAL)
+        mock_agency('http://agency-b.fake', TIMES_NONACTUAL)
+        providers = [NexTripProvider('a', 'http://agency-a.fake'),
+                     NexTripProvider('b', 'http://agency-b.fake')]
+
+        answers = departures_from_all(providers, 'Brklyn Center', 'Brooklyn Center', 'south',
+                                      '1538969940000')
+
+        answers | should.equal([('a', [('16 Min', True)]), ('b', [('22 Min', False)])])
+
+    @pook.on
+    def test_departures_from_all_keeps_answers_when_a_provider_fails(self):
+        mock_agency('http://agency-c.fake', TIMES_ACTUAL)
+        pook.get('http://agency-d.fake'+ROUTE_PATH, reply=404)
+        providers = [NexTripProvider('c', 'http://agency-c.fake'),
+                     NexTripProvider('d', 'http://agency-d.fake')]
+
+        answers = departures_from_all(providers, 'Brklyn Center', 'Brooklyn Center', 'south')
+
+        answers | should.equal([('c', [('16 Min', True)]), ('d', None)])
+
+    @pook.on
+    def test_provider_uses_its_own_session(self):
+        mock_agency('http://agency-e.fake', TIMES_ACTUAL)
+        provider = NexTripProvider('e', 'http://agency-e.fake')
+        provider.session = CountingSession(provider.session)
+
+        provider.departures('Brklyn Center', 'Brooklyn Center', 'south')
+
+        len(provider.session.urls) | should.equal(4)
+
+    def test_provider_limits_concurrent_queries(self):
+        running = []
+        most = []
+
+        class SlowProvider(Provider):
+            def lookup(self, *args):
+                running.append(1)
+                most.append(len(running))
+                time.sleep(0.02)
+                running.pop()
+
+        provider = SlowProvider('slow', concurrency=2)
+        threads = [threading.Thread(target=provider.departures, args=('r', 's', 'd'))
+                   for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        max(most) | should.equal(2)
+
+
+class TestScheduleProvider(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'gtfs.zip')
+        with zipfile.ZipFile(self.path, 'w') as feed:
+            for name, contents in FEED.items():
+                feed.writestr(name, contents)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_schedule_provider_answers_from_feed(self):
+        provider = parse_provider('metro=gtfs:' + self.path)
+        departures = provider.departures('Brklyn Center', 'Brooklyn Center', 'south',
+                                         local_millis(2018, 10, 8, 8, 0))
+        departures | should.equal([('10 Min', False)])
+
+    def test_realtime_provider_answers_from_feed(self):
+        feed_path = os.path.join(self.dir, 'trip-updates.pb')
+        with open(feed_path, 'wb') as f:
+            f.write(feed(trip_update('e1', 'south-1', [('44FM', local_seconds(2018, 10, 8, 8, 25))])))
+        provider = RealtimeProvider('metro', feed_path, self.path)
+        departures = provider.departures('Brklyn Center', '44th', 'south', local_millis(2018, 10, 8, 8, 0))
+        departures | should.equal([('25 Min', True)])
+
+
+def test_parse_provider_makes_nextrip_providers():
+    provider = parse_provider('metro=http://svc.example', timeout=3)
+    provider | should.be.an.instance.of(NexTripProvider)
+    provider.name | should.equal('metro')
+    provider.host | should.equal('http://svc.example')
+    provider.session.timeout | should.equal(3)
+
+
+def test_parse_provider_rejects_specs_without_name():
+    with pytest.raises(ValueError):
+        parse_provider('http://svc.example')
+
+
+def test_parse_provider_rejects_missing_gtfs_feeds():
+    with pytest.raises(ValueError):
+        parse_provider('metro=gtfs:/nonexistent.zip')
+
+
+def test_departures_from_all_survives_a_broken_provider():
+    class Broken(Provider):
+        def lookup(self, route, stop, direction, date_time, count):
+            raise OSError('feed vanished')
+
+    class Fixed(Provider):
+        def lookup(self, route, stop, direction, date_time, count):
+            return [('5 Min', True)]
+
+    answers = departures_from_all([Broken('a'), Fixed('b')], 'Route 5', 'Brooklyn Center', 'south')
+
+    answers | should.equal([('a', None), ('b', [('5 Min', True)])])
+
+
+def test_parse_provider_makes_realtime_providers():
+    provider = parse_provider('metro=gtfs-rt:http://feed.example/trip-updates.pb', gtfs_path='gtfs.zip')
+    provider | should.be.an.instance.of(RealtimeProvider)
+    (provider.feed, provider.gtfs_path) | should.equal(('http://feed.example/trip-updates.pb', 'gtfs.zip'))
+
+    with pytest.raises(ValueError):
+        parse_provider('metro=gtfs-rt:http://feed.example/trip-updates.pb')
@@ -0,0 +1,43 @@
+import subprocess
+import sys
+
+from grappa import should
+
+# Importing next_bus (and so `next_bus.py --help`) shouldn't pull in these.
+DEFERRED=['requests', 'urllib3', 'asyncio', 'http.server', 'difflib', 'sqlite3']
+# Cumulative import time allowed for next_bus itself, in microseconds.
+IMPORT_BUDGET=100000
+
+
+def import_times(*args):
+    # Module -> cumulative microseconds, from `python -X importtime`.
+    result = subprocess.run([sys.executable, '-X', 'importtime'] + list(args),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, cumulative, name = line[len('import time:'):].split('|')
+            if cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative)
+    return times
+
+
+def test_import_defers_slow_modules():
+    times = import_times('-c', 'import next_bus')
+
+    times | should.have.key('next_bus')
+    [module for module in DEFERRED if module in times] | should.be.empty
+
+
+def test_help_defers_slow_modules():
+    times = import_times('next_bus.py', '--help')
+
+    [module for module in DEFERRED if module in times] | should.be.empty
+
+
+def test_import_fits_budget():
+    # Best of a few runs, so a busy machine doesn't fail the test.
+    best = min(import_times('-c', 'import next_bus')['next_bus'] for _ in range(3))
+
+    best | should.be.lower.than(IMPORT_BUDGET)
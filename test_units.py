@@ -1,11 +1,21 @@
+import asyncio
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+
 import pook
 import pytest
+import threading
 import time
 import unittest
 
 from grappa import should
 
 from next_bus import *
+from archive import Archive, Recorder, ResponseLog
+from server import DepartureService
 
 FAKE_HOST='http://fake.fake'
 ROUTES=[
@@ -114,6 +124,10 @@ TIMES_NONACTUAL=[
       }
   ]
 
+ROUTE_RECORDS=[Route.from_json(route) for route in ROUTES]
+DIR_RECORDS=[Direction.from_json(direction) for direction in DIRS]
+STOP_RECORDS=[Stop.from_json(stop) for stop in STOPS]
+
 
 class TestLookupRoute(unittest.TestCase):
 
@@ -137,8 +151,7 @@ class TestLookupRoute(unittest.TestCase):
 
     def test_lookup_route_returns_match(self):
         route = lookup_route('Brklyn Center', self.route_url)
-        route | should.have.key("Description")
-        route | should.have.key("ProviderID")
+        route | should.equal(Route("5 - Brklyn Center - Fremont - 26th Av - Chicago - MOA", "5"))
 
 
 class TestLookupDirection(unittest.TestCase):
@@ -150,25 +163,25 @@ class TestLookupDirection(unittest.TestCase):
 
     def test_lookup_direction_returns_None_if_not_200_response(self):
         self.mock = pook.get(self.dir_url.format(route=ROUTES[2]['Route']), reply=404)
-        route = lookup_direction('ignored', ROUTES[2], self.dir_url)
+        route = lookup_direction('ignored', ROUTE_RECORDS[2], self.dir_url)
         route | should.be.none
 
     def test_lookup_direction_returns_empty_list_if_not_found_in_response(self):
-        route = lookup_direction('junk', ROUTES[2], self.dir_url)
+        route = lookup_direction('junk', ROUTE_RECORDS[2], self.dir_url)
         route | should.be.none
 
     def test_lookup_direction_returns_None_if_more_than_one_found(self):
-        route = lookup_direction('BOUND', ROUTES[2], self.dir_url)
+        route = lookup_direction('BOUND', ROUTE_RECORDS[2], self.dir_url)
         route | should.be.none
 
     def test_lookup_direction_returns_match(self):
-        route = lookup_direction('SOUTHBOUND', ROUTES[2], self.dir_url)
-        route | should.have.key("Value").that.should.equal("1")
+        route = lookup_direction('SOUTHBOUND', ROUTE_RECORDS[2], self.dir_url)
+        route.value | should.equal("1")
 
     def test_lookup_direction_returns_caseinsensitive_match(self):
         self.mock = pook.get(self.dir_url.format(route=ROUTES[1]['Route']), reply=200, response_json=DIRS)
-        route = lookup_direction('north', ROUTES[1], self.dir_url)
-        route | should.have.key("Value").that.should.equal("4")
+        route = lookup_direction('north', ROUTE_RECORDS[1], self.dir_url)
+        route.value | should.equal("4")
 
 
 class TestLookupStop(unittest.TestCase):
@@ -181,20 +194,371 @@ class TestLookupStop(unittest.TestCase):
 
     def test_lookup_stop_returns_None_if_not_200_response(self):
         self.mock = pook.get(self.stop_url, reply=404)
-        route = lookup_stop('ignored', ROUTES[2], DIRS[1], self.stop_url_template)
+        route = lookup_stop('ignored', ROUTE_RECORDS[2], DIR_RECORDS[1], self.stop_url_template)
         route | should.be.none
 
     def test_lookup_stop_returns_empty_list_if_not_found_in_response(self):
-        route = lookup_stop('junk', ROUTES[2], DIRS[1], self.stop_url_template)
+        route = lookup_stop('junk', ROUTE_RECORDS[2], DIR_RECORDS[1], self.stop_url_template)
         route | should.be.none
 
     def test_lookup_stop_returns_None_if_more_than_one_found(self):
-        route = lookup_stop('Ave', ROUTES[2], DIRS[1], self.stop_url_template)
+        route = lookup_stop('Ave', ROUTE_RECORDS[2], DIR_RECORDS[1], self.stop_url_template)
         route | should.be.none
 
     def test_lookup_stop_returns_match(self):
-        route = lookup_stop('Brooklyn Center', ROUTES[2], DIRS[1], self.stop_url_template)
-        route | should.have.key("Value").that.should.equal("BCTC")
+        route = lookup_stop('Brooklyn Center', ROUTE_RECORDS[2], DIR_RECORDS[1], self.stop_url_template)
+        route.value | should.equal("BCTC")
+
+
+class TestMatchIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = MatchIndex(STOP_RECORDS, 'text')
+
+    def test_search_finds_case_insensitive_substrings(self):
+        self.index.search('brooklyn center') | should.equal([2])
+        self.index.search('ave') | should.equal([0, 1])
+        self.index.search('junk') | should.equal([])
+
+    def test_search_handles_short_patterns(self):
+        self.index.search('47') | should.equal([1])
+
+    def test_prefix_matches_words_in_any_order(self):
+        self.index.prefix('fremont 44') | should.equal([0])
+        self.index.prefix('trans') | should.equal([2])
+
+    def test_resolve_prefers_whole_words(self):
+        index = MatchIndex([Stop('Lake St', 'LAST'), Stop('Lakeview Ave', 'LAVI')], 'text')
+        index.resolve('lake') | should.equal([0])
+
+    def test_resolve_prefers_exact_match(self):
+        index = MatchIndex([Stop('Lake', 'LAKE'), Stop('Lake St', 'LAST')], 'text')
+        index.resolve('LAKE') | should.equal([0])
+
+    def test_resolve_keeps_ambiguous_matches(self):
+        self.index.resolve('Ave') | should.equal([0, 1])
+
+    def test_suggest_ranks_close_misspellings(self):
+        self.index.suggest('Brooklin Centre') | should.equal(['Brooklyn Center Transit Center'])
+
+    def test_suggest_ignores_unrelated_text(self):
+        self.index.suggest('NON-EXISTANT') | should.equal([])
+
+    def test_match_index_is_built_once_per_response(self):
+        match_index(STOP_RECORDS, 'text') | should.equal(match_index(STOP_RECORDS, 'text'))
+
+
+class TestMetadataCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = MetadataCache(':memory:')
+        self.route_url = 'http://cache.fake'+ROUTE_PATH
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        use_cache(None)
+        shutil.rmtree(self.dir)
+
+    def test_cache_returns_None_when_empty(self):
+        self.cache.get(self.route_url) | should.be.none
+
+    def test_cache_returns_stored_value(self):
+        self.cache.put(self.route_url, ROUTES)
+        self.cache.get(self.route_url) | should.equal(ROUTES)
+
+    def test_cache_returns_records(self):
+        self.cache.put(self.route_url, ROUTE_RECORDS)
+        self.cache.get(self.route_url, Route) | should.equal(ROUTE_RECORDS)
+
+    def test_cache_drops_entries_from_older_versions(self):
+        path = os.path.join(self.dir, 'cache.sqlite3')
+        db = sqlite3.connect(path)
+        with db:
+            db.execute('CREATE TABLE entries (url TEXT PRIMARY KEY, body TEXT, stored REAL, used REAL)')
+            db.execute('INSERT INTO entries VALUES (?, ?, ?, ?)',
+                       (self.route_url, json.dumps(ROUTES), time.time(), time.time()))
+        db.close()
+        MetadataCache(path).get(self.route_url, Route) | should.be.none
+
+    def test_cache_expires_entries_after_ttl(self):
+        self.cache.ttl = -1
+        self.cache.put(self.route_url, ROUTES)
+        self.cache.get(self.route_url) | should.be.none
+
+    def test_cache_ignores_entries_when_refreshing(self):
+        self.cache.put(self.route_url, ROUTES)
+        self.cache.refresh = True
+        self.cache.get(self.route_url) | should.be.none
+
+    def test_cache_returns_same_object_until_replaced(self):
+        self.cache.put(self.route_url, ROUTES)
+        first = self.cache.get(self.route_url)
+        (self.cache.get(self.route_url) is first) | should.be.true
+        self.cache.put(self.route_url, ROUTES)
+        (self.cache.get(self.route_url) is first) | should.be.false
+
+    def test_cache_hits_do_not_write(self):
+        self.cache.put(self.route_url, ROUTES)
+        changes = self.cache.db.total_changes
+        self.cache.get(self.route_url) | should.equal(ROUTES)
+        self.cache.db.total_changes | should.equal(changes)
+
+    def test_corrupt_cache_file_runs_uncached(self):
+        path = os.path.join(self.dir, 'cache.sqlite3')
+        with open(path, 'w') as f:
+            f.write('not a database' * 100)
+        with self.assertLogs(level='WARNING') as logs:
+            cache = MetadataCache(path)
+        cache.put(self.route_url, ROUTES)
+        cache.get(self.route_url) | should.be.none
+        cache.stale(self.route_url) | should.be.none
+        logs.output[0] | should.contain('WARNING: Not using the metadata cache')
+
+    def test_unwritable_cache_dir_runs_uncached(self):
+        blocker = os.path.join(self.dir, 'file')
+        open(blocker, 'w').close()
+        with self.assertLogs(level='WARNING'):
+            cache = MetadataCache(os.path.join(blocker, 'cache.sqlite3'))
+        cache.get(self.route_url) | should.be.none
+
+    def test_cache_evicts_least_recently_used(self):
+        self.cache.max_entries = 2
+        self.cache.put('first', ROUTES)
+        self.cache.put('second', DIRS)
+        time.sleep(0.01)
+        self.cache.get('first')
+        self.cache.put('third', STOPS)
+        self.cache.get('first') | should.equal(ROUTES)
+        self.cache.get('second') | should.be.none
+        self.cache.get('third') | should.equal(STOPS)
+
+    @pook.on
+    def test_lookup_route_is_served_from_cache(self):
+        use_cache(self.cache)
+        mock = pook.get(self.route_url, reply=200, response_json=ROUTES, times=1)
+        lookup_route('Brklyn Center', self.route_url)
+        route = lookup_route('Blue', self.route_url)
+        route.route | should.equal("901")
+        mock.calls | should.equal(1)
+
+    @pook.on
+    def test_lookup_route_does_not_cache_errors(self):
+        use_cache(self.cache)
+        pook.get(self.route_url, reply=404)
+        lookup_route('Brklyn Center', self.route_url)
+        self.cache.get(self.route_url) | should.be.none
+
+
+class TestCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'catalog.tsv')
+        self.route_url = 'http://catalog.fake'+ROUTE_PATH
+        self.catalog = Catalog(self.path)
+        self.catalog.save({self.route_url: ('"v1"', '', json.dumps(ROUTE_RECORDS))})
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.path))
+
+    def test_catalog_returns_saved_records(self):
+        Catalog(self.path).get(self.route_url, Route) | should.equal(ROUTE_RECORDS)
+
+    def test_catalog_returns_None_for_unknown_urls(self):
+        Catalog(self.path).get('http://catalog.fake/other') | should.be.none
+
+    def test_catalog_ignores_other_versions(self):
+        with open(self.path, 'w') as f:
+            f.write('{"version": 0}\n' + self.route_url + '\t\t\t[]\n')
+        Catalog(self.path).get(self.route_url) | should.be.none
+
+    def test_catalog_is_ignored_when_refreshing(self):
+        Catalog(self.path, refresh=True).get(self.route_url) | should.be.none
+
+    def test_catalog_expires_after_ttl(self):
+        Catalog(self.path, ttl=60).get(self.route_url, Route) | should.equal(ROUTE_RECORDS)
+        with open(self.path) as f:
+            lines = f.readlines()
+        lines[0] = json.dumps({'version': CATALOG_VERSION, 'saved': time.time() - 120}) + '\n'
+        with open(self.path, 'w') as f:
+            f.writelines(lines)
+        Catalog(self.path, ttl=60).get(self.route_url) | should.be.none
+        Catalog(self.path).get(self.route_url, Route) | should.equal(ROUTE_RECORDS)
+
+    def test_catalog_answers_lookups(self):
+        use_catalog(Catalog(self.path))
+        try:
+            lookup_route('Blue', self.route_url).route | should.equal('901')
+        finally:
+            use_catalog(None)
+
+
+class TestWarmCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.host = 'http://warm.fake'
+        self.path = os.path.join(tempfile.mkdtemp(), 'catalog.tsv')
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.path))
+
+    @pook.on
+    def test_warm_saves_every_route_direction_and_stop(self):
+        pook.get(self.host+ROUTE_PATH, reply=200, response_json=ROUTES[2:], times=1)
+        pook.get(self.host+DIR_PATH.format(route='5'), reply=200, response_json=DIRS, times=1)
+        for direction in ('4', '1'):
+            pook.get(self.host+STOP_PATH.format(route='5', direction=direction),
+                     reply=200, response_json=STOPS, times=1)
+
+        stats = warm_catalog(Catalog(self.path), self.host, rate=0)
+
+        stats['requests'] | should.equal(4)
+        stats['stops'] | should.equal(6)
+        catalog = Catalog(self.path)
+        catalog.get(self.host+STOP_PATH.format(route='5', direction='1'), Stop) | should.equal(STOP_RECORDS)
+
+    @pook.on
+    def test_warm_only_refetches_stops_of_changed_routes(self):
+        pook.get(self.host+ROUTE_PATH, reply=200, response_json=ROUTES[2:], times=2)
+        pook.get(self.host+DIR_PATH.format(route='5'), reply=200, response_json=DIRS, times=2)
+        stops = [pook.get(self.host+STOP_PATH.format(route='5', direction=direction),
+                          reply=200, response_json=STOPS, times=1) for direction in ('4', '1')]
+
+        warm_catalog(Catalog(self.path), self.host, rate=0)
+        stats = warm_catalog(Catalog(self.path), self.host, rate=0)
+
+        stats['requests'] | should.equal(2)
+        stats['changed'] | should.equal(0)
+        stats['stops'] | should.equal(6)
+        [mock.calls for mock in stops] | should.equal([1, 1])
+
+    @pook.on
+    def test_warm_takes_turns_under_the_rate_limit(self):
+        class CountingLimiter(object):
+            def __init__(self):
+                self.endpoints = []
+
+            def acquire(self, endpoint_name, max_wait=None):
+                self.endpoints.append(endpoint_name)
+                return 0
+
+        pook.get(self.host+ROUTE_PATH, reply=200, response_json=ROUTES[2:], times=1)
+        pook.get(self.host+DIR_PATH.format(route='5'), reply=200, response_json=DIRS, times=1)
+        for direction in ('4', '1'):
+            pook.get(self.host+STOP_PATH.format(route='5', direction=direction),
+                     reply=200, response_json=STOPS, times=1)
+        limiter = CountingLimiter()
+        use_rate_limiter(limiter)
+        try:
+            warm_catalog(Catalog(self.path), self.host, concurrency=1, rate=0)
+        finally:
+            use_rate_limiter(None)
+
+        limiter.endpoints | should.equal(['Route', 'Direction', 'Stop', 'Stop'])
+
+    @pook.on
+    def test_warm_skips_endpoints_whose_breaker_is_open(self):
+        mock = pook.get(self.host+ROUTE_PATH, reply=200, response_json=ROUTES[2:], times=1)
+        breaker = get_breaker(self.host+ROUTE_PATH, 'Route')
+        for _ in range(BREAKER_MIN_CALLS):
+            breaker.record(False, 0)
+        try:
+            fetch_entry(self.host+ROUTE_PATH, 'Route') | should.equal((None, False))
+        finally:
+            breakers.clear()
+        mock.calls | should.equal(0)
+
+    @pook.on
+    def test_warm_returns_None_without_routes(self):
+        pook.get(self.host+ROUTE_PATH, reply=500, times=3)
+        warm_catalog(Catalog(self.path), self.host, rate=0) | should.be.none
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_rate_limiter_spaces_out_calls(self):
+        limiter = RateLimiter(100)
+        start = time.monotonic()
+        for _ in range(5):
+            limiter.wait()
+        (time.monotonic() - start) | should.be.above(0.039)
+
+
+def drain_shared_bucket(path, rate, calls):
+    limiter = SharedRateLimiter(path, {RATE_ALL: rate})
+    for _ in range(calls):
+        limiter.acquire('Time')
+
+
+class TestSharedRateLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'rate.json')
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.path))
+
+    def test_parse_rate_limits(self):
+        parse_rate_limits(['10', 'Time=2.5']) | should.equal({RATE_ALL: 10.0, 'Time': 2.5})
+        for spec in ('Routes=1', 'Time=fast', '0'):
+            with pytest.raises(ValueError):
+                parse_rate_limits([spec])
+
+    def test_limiters_on_one_file_share_a_bucket(self):
+        first = SharedRateLimiter(self.path, {RATE_ALL: 5})
+        second = SharedRateLimiter(self.path, {RATE_ALL: 5})
+        [first.acquire('Route') for _ in range(3)] + [second.acquire('Stop') for _ in range(2)] | \
+            should.equal([0] * 5)
+        second.acquire('Time') | should.be.above(0.1)
+
+    def test_endpoint_limits_apply_to_their_endpoint(self):
+        limiter = SharedRateLimiter(self.path, {'Time': 1})
+        limiter.acquire('Time') | should.equal(0)
+        limiter.acquire('Route') | should.equal(0)
+        limiter.acquire('Time', max_wait=0.1) | should.be.none
+
+    def test_processes_together_stay_under_the_rate(self):
+        import concurrent.futures
+        start = time.monotonic()
+        with concurrent.futures.ProcessPoolExecutor(3) as executor:
+            list(executor.map(drain_shared_bucket, [self.path] * 3, [100] * 3, [50] * 3))
+        # 150 requests at 100 per second, after a burst of 100.
+        (time.monotonic() - start) | should.be.above(0.45)
+
+
+class TestPooledSession(unittest.TestCase):
+
+    def setUp(self):
+        self.route_url = 'http://retry.fake'+ROUTE_PATH
+        use_session(PooledSession(retries=2, backoff=0))
+
+    def tearDown(self):
+        use_session(None)
+
+    @pook.on
+    def test_make_request_retries_server_errors(self):
+        failing = pook.get(self.route_url, reply=503, times=1)
+        pook.get(self.route_url, reply=200, response_json=ROUTES)
+        result = make_request(self.route_url, 'Route')
+        result | should.equal(ROUTE_RECORDS)
+        failing.calls | should.equal(1)
+
+    @pook.on
+    def test_make_request_gives_up_after_retries(self):
+        failing = pook.get(self.route_url, reply=500, times=3)
+        result = make_request(self.route_url, 'Route')
+        result | should.be.none
+        failing.calls | should.equal(3)
+
+    @pook.on
+    def test_make_request_does_not_retry_client_errors(self):
+        failing = pook.get(self.route_url, reply=404, times=1)
+        result = make_request(self.route_url, 'Route')
+        result | should.be.none
+        failing.calls | should.equal(1)
+
+    def test_get_session_reuses_one_session(self):
+        use_session(None)
+        get_session() | should.equal(get_session())
 
 
 class TestLookupTime(unittest.TestCase):
@@ -206,24 +570,498 @@ class TestLookupTime(unittest.TestCase):
 
     def test_lookup_time_returns_None_if_not_200_response(self):
         mock = pook.get(self.time_url, reply=404)
-        next_time = lookup_next_time('ignored', ROUTES[2], DIRS[1], STOPS[2], self.time_url_template)
+        next_time = lookup_next_time('ignored', ROUTE_RECORDS[2], DIR_RECORDS[1], STOP_RECORDS[2], self.time_url_template)
         next_time | should.be.none
 
     def test_lookup_time_returns_None_if_no_times(self):
         mock = pook.get(self.time_url, reply=200, response_json="[]")
-        next_time = lookup_next_time('ignored', ROUTES[2], DIRS[1], STOPS[2], self.time_url_template)
+        next_time = lookup_next_time('ignored', ROUTE_RECORDS[2], DIR_RECORDS[1], STOP_RECORDS[2], self.time_url_template)
         next_time | should.be.none
 
     def test_lookup_time_returns_first_match(self):
         mock = pook.get(self.time_url, reply=200, response_json=TIMES_ACTUAL)
-        next_time = lookup_next_time('ignored', ROUTES[2], DIRS[1], STOPS[2], self.time_url_template)
+        next_time = lookup_next_time('ignored', ROUTE_RECORDS[2], DIR_RECORDS[1], STOP_RECORDS[2], self.time_url_template)
         next_time | should.equal("16 Min")
 
     def test_lookup_time_converts_non_actual_times(self):
         mock = pook.get(self.time_url, reply=200, response_json=TIMES_NONACTUAL)
-        next_time = lookup_next_time('1538969940000', ROUTES[2], DIRS[1], STOPS[2], self.time_url_template)
+        next_time = lookup_next_time('1538969940000', ROUTE_RECORDS[2], DIR_RECORDS[1], STOP_RECORDS[2], self.time_url_template)
         next_time | should.equal("22 Min")
 
+    def test_lookup_departures_returns_every_departure(self):
+        mock = pook.get(self.time_url, reply=200, response_json=TIMES_ACTUAL)
+        departures = lookup_departures('1538969940000', ROUTE_RECORDS[2], DIR_RECORDS[1], STOP_RECORDS[2], self.time_url_template)
+        departures | should.equal([("16 Min", True), ("65 Min", False)])
+
+    def test_lookup_departures_limits_count(self):
+        mock = pook.get(self.time_url, reply=200, response_json=TIMES_NONACTUAL)
+        departures = lookup_departures('1538969940000', ROUTE_RECORDS[2], DIR_RECORDS[1], STOP_RECORDS[2], self.time_url_template,
+                                       count=1)
+        departures | should.equal([("22 Min", False)])
+
+    def test_lookup_departures_returns_None_if_no_times(self):
+        mock = pook.get(self.time_url, reply=200, response_json="[]")
+        departures = lookup_departures('ignored', ROUTE_RECORDS[2], DIR_RECORDS[1], STOP_RECORDS[2], self.time_url_template)
+        departures | should.be.none
+
+    def test_make_request_builds_departure_records(self):
+        mock = pook.get(self.time_url, reply=200, response_json=TIMES_ACTUAL)
+        make_request(self.time_url, 'Time') | should.equal([Departure('16 Min', True, 1538971260000, 1078),
+                                                           Departure('11:44', False, 1538973840000, 1220)])
+
+    def test_lookup_time_returns_None_for_malformed_response(self):
+        mock = pook.get(self.time_url, reply=200, response_body='{"Message": "An error has occurred."}')
+        next_time = lookup_next_time('ignored', ROUTE_RECORDS[2], DIR_RECORDS[1], STOP_RECORDS[2], self.time_url_template)
+        next_time | should.be.none
+
+
+class TestRecordResponses(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.time_url = 'http://record.fake'+TIME_PATH.format(route='5', direction='1', stop='BCTC')
+        use_cache(None)
+
+    def tearDown(self):
+        use_recorder(None)
+        shutil.rmtree(self.path)
+
+    @pook.on
+    def test_make_request_records_whole_responses(self):
+        pook.get(self.time_url, reply=200, response_json=TIMES_ACTUAL)
+        use_recorder(Recorder(self.path))
+
+        make_request(self.time_url, 'Time', limit=1)
+
+        log = ResponseLog(self.path)
+        entry = log.responses[TIME_PATH.format(route='5', direction='1', stop='BCTC')][0]
+        json.loads(bytes(log.body(entry)).decode('utf-8')) | should.equal(TIMES_ACTUAL)
+        times, _ = Archive(self.path).load_index()[self.time_url]
+        times | should.have.length(1)
+
+    @pook.on
+    def test_make_request_records_failed_responses(self):
+        pook.get(self.time_url, reply=404, response_body='missing')
+        use_recorder(Recorder(self.path))
+
+        make_request(self.time_url, 'Time') | should.be.none
+
+        log = ResponseLog(self.path)
+        [entry[0] for entry in log.responses[TIME_PATH.format(route='5', direction='1', stop='BCTC')]] \
+            | should.equal([404])
+
+
+class TestIterJsonArray(unittest.TestCase):
+
+    def setUp(self):
+        self.text = json.dumps(TIMES_ACTUAL, indent=2)
+
+    def test_iter_json_array_decodes_every_split(self):
+        for split in range(len(self.text)):
+            items = list(iter_json_array([self.text[:split], self.text[split:]]))
+            items | should.equal(TIMES_ACTUAL)
+
+    def test_iter_json_array_stops_reading_once_done(self):
+        chunks = iter(self.text)
+        first = next(iter_json_array(chunks))
+        first | should.equal(TIMES_ACTUAL[0])
+        len(list(chunks)) | should.be.above(0)
+
+    def test_iter_json_array_handles_empty_arrays(self):
+        list(iter_json_array([' [ ', ']'])) | should.equal([])
+
+    def test_iter_json_array_rejects_non_arrays(self):
+        with pytest.raises(ValueError):
+            list(iter_json_array(['{"Message": "error"}']))
+
+    def test_iter_json_array_rejects_truncated_arrays(self):
+        with pytest.raises(ValueError):
+            list(iter_json_array([self.text[:-10]]))
+
+
+class TestNextBusMany(unittest.TestCase):
+
+    @pook.on
+    def setUp(self):
+        self.host = 'http://many.fake'
+        self.mocks = [
+            pook.get(self.host+ROUTE_PATH, reply=200, response_json=ROUTES, times=1),
+            pook.get(self.host+DIR_PATH.format(route='5'), reply=200, response_json=DIRS, times=1),
+            pook.get(self.host+STOP_PATH.format(route='5', direction='1'), reply=200, response_json=STOPS, times=1),
+        ]
+
+    def run_many(self, queries):
+        return asyncio.get_event_loop().run_until_complete(
+            next_bus_many(queries, date_time='1538969940000', host=self.host, concurrency=4))
+
+    def test_next_bus_many_shares_metadata_lookups(self):
+        pook.get(self.host+TIME_PATH.format(route='5', direction='1', stop='BCTC'),
+                 reply=200, response_json=TIMES_ACTUAL, times=1)
+        pook.get(self.host+TIME_PATH.format(route='5', direction='1', stop='44FM'),
+                 reply=200, response_json=TIMES_NONACTUAL, times=1)
+
+        results = self.run_many([('Brklyn Center', 'Brooklyn Center', 'south'),
+                                 ('Brklyn Center', '44th', 'south'),
+                                 ('Brklyn Center', 'Brooklyn Center', 'south')])
+
+        results | should.equal(['16 Min', '22 Min', '16 Min'])
+        [mock.calls for mock in self.mocks] | should.equal([1, 1, 1])
+
+    def test_next_bus_many_returns_None_for_failed_queries(self):
+        pook.get(self.host+TIME_PATH.format(route='5', direction='1', stop='BCTC'),
+                 reply=200, response_json=TIMES_ACTUAL, times=1)
+
+        results = self.run_many([('Brklyn Center', 'Brooklyn Center', 'south'),
+                                 ('Brklyn Center', 'Brooklyn Center', 'west'),
+                                 ('junk', 'Brooklyn Center', 'south')])
+
+        results | should.equal(['16 Min', None, None])
+
+    def test_next_bus_many_returns_records_when_detailed(self):
+        pook.get(self.host+TIME_PATH.format(route='5', direction='1', stop='BCTC'),
+                 reply=200, response_json=TIMES_ACTUAL, times=1)
+
+        results = asyncio.get_event_loop().run_until_complete(
+            next_bus_many([('Brklyn Center', 'Brooklyn Center', 'south'), ('junk', 'Brooklyn Center', 'south')],
+                          date_time='1538969940000', host=self.host, detailed=True))
+
+        results[1] | should.be.none
+        [(r['route'], r['direction'], r['stop'], r['departure'], r['realtime'], r['stale'])
+         for r in results[0]] | should.equal([('5', '1', 'BCTC', '16 Min', True, None)])
+
+
+class TestDepartureCache(unittest.TestCase):
+
+    def setUp(self):
+        self.time_url_template = 'http://departures.fake'+TIME_PATH
+        self.time_url = self.time_url_template.format(route='5', direction='1', stop='BCTC')
+        use_departure_cache(DepartureCache(ttl=60))
+
+    def tearDown(self):
+        use_departure_cache(None)
+
+    def lookup(self, date_time, count=1):
+        return lookup_departures(date_time, ROUTE_RECORDS[2], DIR_RECORDS[1], STOP_RECORDS[2],
+                                 self.time_url_template, count=count)
+
+    @pook.on
+    def test_departure_cache_answers_repeated_lookups(self):
+        mock = pook.get(self.time_url, reply=200, response_json=TIMES_NONACTUAL, times=1)
+        self.lookup('1538969940000') | should.equal([('22 Min', False)])
+        self.lookup('1538970000000') | should.equal([('21 Min', False)])
+        mock.calls | should.equal(1)
+
+    @pook.on
+    def test_departure_cache_recomputes_realtime_minutes(self):
+        pook.get(self.time_url, reply=200, response_json=TIMES_ACTUAL, times=1)
+        self.lookup('1538969940000') | should.equal([('16 Min', True)])
+        self.lookup('1538970960000') | should.equal([('5 Min', True)])
+
+    @pook.on
+    def test_departure_cache_fetches_again_for_more_departures(self):
+        mock = pook.get(self.time_url, reply=200, response_json=TIMES_ACTUAL, times=2)
+        self.lookup('1538969940000')
+        self.lookup('1538969940000', count=None) | should.have.length(2)
+        mock.calls | should.equal(2)
+
+    @pook.on
+    def test_departure_cache_keeps_at_most_max_entries(self):
+        cache = DepartureCache(ttl=60, max_entries=3)
+        urls = [self.time_url_template.format(route='5', direction='1', stop='S{}'.format(i)) for i in range(10)]
+        for url in urls:
+            pook.get(url, reply=200, response_json=TIMES_ACTUAL, times=1)
+            cache.fetch(url)
+            cache.fetch(urls[0])  # kept in use, so never the one dropped
+            len(cache) | should.be.lower.than(4)
+        list(cache.entries) | should.equal([urls[8], urls[9], urls[0]])
+
+    @pook.on
+    def test_departure_cache_expires_after_ttl(self):
+        get_departure_cache().ttl = -1
+        mock = pook.get(self.time_url, reply=200, response_json=TIMES_ACTUAL, times=2)
+        self.lookup('1538969940000')
+        self.lookup('1538969940000')
+        mock.calls | should.equal(2)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def setUp(self):
+        self.breaker = CircuitBreaker(window=4, min_calls=4, error_rate=0.5, slow=1, cooldown=60)
+
+    def test_breaker_trips_when_half_the_calls_fail(self):
+        for ok in (True, False, True):
+            self.breaker.record(ok, 0.1)
+        self.breaker.allow() | should.be.true
+        self.breaker.record(False, 0.1)
+        self.breaker.allow() | should.be.false
+
+    def test_breaker_counts_slow_calls_as_failures(self):
+        for _ in range(2):
+            self.breaker.record(True, 0.1)
+            self.breaker.record(True, 5)
+        self.breaker.state | should.equal('open')
+
+    def test_breaker_lets_one_trial_call_through_after_cooldown(self):
+        for _ in range(4):
+            self.breaker.record(False, 0.1)
+        self.breaker.opened -= 60
+        self.breaker.allow() | should.be.true
+        self.breaker.allow() | should.be.false
+        self.breaker.record(True, 0.1)
+        self.breaker.state | should.equal('closed')
+
+    def test_failed_trial_trips_breaker_again(self):
+        for _ in range(4):
+            self.breaker.record(False, 0.1)
+        self.breaker.opened -= 60
+        self.breaker.allow()
+        self.breaker.record(False, 0.1)
+        self.breaker.allow() | should.be.false
+
+
+class TestStaleAnswers(unittest.TestCase):
+
+    def setUp(self):
+        self.route_url = 'http://stale.fake'+ROUTE_PATH
+        self.time_url = 'http://stale.fake'+TIME_PATH.format(route='5', direction='1', stop='BCTC')
+        self.cache = MetadataCache(':memory:', ttl=-1)
+        self.cache.put(self.route_url, ROUTE_RECORDS)
+        use_session(PooledSession(retries=0))
+
+    def tearDown(self):
+        use_session(None)
+        use_departure_cache(None)
+        start_deadline(None)
+        breakers.clear()
+
+    @pook.on
+    def test_make_request_answers_from_expired_cache_on_server_errors(self):
+        pook.get(self.route_url, reply=503)
+        make_request(self.route_url, 'Route', cache=self.cache) | should.equal(ROUTE_RECORDS)
+
+    @pook.on
+    def test_make_request_does_not_answer_client_errors_from_expired_cache(self):
+        pook.get(self.route_url, reply=404)
+        make_request(self.route_url, 'Route', cache=self.cache) | should.be.none
+
+    @pook.on
+    def test_tripped_endpoint_is_not_asked(self):
+        mock = pook.get(self.route_url, reply=200, response_json=ROUTES, times=1)
+        for _ in range(BREAKER_MIN_CALLS):
+            get_breaker(self.route_url, 'Route').record(False, 0)
+        make_request(self.route_url, 'Route', cache=self.cache) | should.equal(ROUTE_RECORDS)
+        mock.calls | should.equal(0)
+
+    @pook.on
+    def test_make_request_stops_asking_after_deadline(self):
+        mock = pook.get(self.route_url, reply=200, response_json=ROUTES, times=1)
+        start_deadline(0)
+        make_request(self.route_url, 'Route', cache=self.cache) | should.equal(ROUTE_RECORDS)
+        make_request(self.route_url, 'Route') | should.be.none
+        mock.calls | should.equal(0)
+
+    @pook.on
+    def test_make_request_does_not_queue_past_deadline(self):
+        mock = pook.get(self.route_url, reply=200, response_json=ROUTES, times=1)
+        path = os.path.join(tempfile.mkdtemp(), 'rate.json')
+        try:
+            limiter = SharedRateLimiter(path, {'Route': 1})
+            limiter.acquire('Route')
+            use_rate_limiter(limiter)
+            start_deadline(0.2)
+            make_request(self.route_url, 'Route', cache=self.cache) | should.equal(ROUTE_RECORDS)
+            mock.calls | should.equal(0)
+        finally:
+            use_rate_limiter(None)
+            shutil.rmtree(os.path.dirname(path))
+
+    @pook.on
+    def test_departures_fall_back_to_stale_ones(self):
+        pook.get(self.time_url, reply=503)
+        now = int(time.time()) * 1000
+        cache = DepartureCache(ttl=15)
+        cache.entries[self.time_url] = (time.time() - 60, None, [Departure('1 Min', True, now - 60000),
+                                                                 Departure('5 Min', True, now + 240000)])
+        use_departure_cache(cache)
+
+        departures_from(fetch_departures(self.time_url, str(now)), str(now)) | should.equal([('4 Min', True)])
+
+    @pook.on
+    def test_records_say_how_stale_departures_are(self):
+        pook.get(self.time_url, reply=503)
+        now = int(time.time()) * 1000
+        cache = DepartureCache(ttl=15)
+        cache.entries[self.time_url] = (time.time() - 60, None, [Departure('5 Min', True, now + 240000)])
+        use_departure_cache(cache)
+
+        times, stale = fetch_aged_departures(self.time_url, str(now))
+        records = departure_records((ROUTE_RECORDS[2], DIR_RECORDS[1], STOP_RECORDS[2]), times, str(now), stale)
+        [(r['stop'], r['departure'], r['time'], r['stale']) for r in records] | should.equal(
+            [('BCTC', '4 Min', now + 240000, 60)])
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def test_single_flight_shares_concurrent_calls(self):
+        flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def slow_fetch():
+            calls.append(1)
+            release.wait(5)
+            return TIMES_ACTUAL
+
+        threads = [threading.Thread(target=lambda: results.append(flight.do('key', slow_fetch)))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        len(calls) | should.equal(1)
+        results | should.equal([TIMES_ACTUAL] * 5)
+
+    def test_single_flight_calls_again_once_finished(self):
+        flight = SingleFlight()
+        calls = []
+        flight.do('key', calls.append, 1)
+        flight.do('key', calls.append, 2)
+        calls | should.equal([1, 2])
+
+    def test_single_flight_shares_exceptions(self):
+        def broken():
+            raise ValueError('boom')
+        with pytest.raises(ValueError):
+            SingleFlight().do('key', broken)
+
+
+class TestDepartureService(unittest.TestCase):
+
+    @pook.on
+    def setUp(self):
+        self.host = 'http://serve.fake'
+        self.mocks = [
+            pook.get(self.host+ROUTE_PATH, reply=200, response_json=ROUTES, times=1),
+            pook.get(self.host+DIR_PATH.format(route='5'), reply=200, response_json=DIRS, times=1),
+            pook.get(self.host+STOP_PATH.format(route='5', direction='1'), reply=200, response_json=STOPS, times=1),
+        ]
+        self.service = DepartureService(self.host, date_time='1538969940000')
+
+    def test_service_keeps_resolved_details(self):
+        pook.get(self.host+TIME_PATH.format(route='5', direction='1', stop='44FM'),
+                 reply=200, response_json=TIMES_NONACTUAL, times=2)
+
+        self.service.next_time('Brklyn Center', '44th', 'south') | should.equal('22 Min')
+        self.service.next_time('BRKLYN CENTER', '44TH', 'SOUTH') | should.equal('22 Min')
+        [mock.calls for mock in self.mocks] | should.equal([1, 1, 1])
+
+    def test_service_returns_None_for_unknown_stop(self):
+        self.service.next_time('Brklyn Center', 'junk', 'south') | should.be.none
+
+
+class TestWatchNextTime(unittest.TestCase):
+
+    @pook.on
+    def setUp(self):
+        self.time_url_template = 'http://watch.fake'+TIME_PATH
+        self.time_url = self.time_url_template.format(route='5', direction='1', stop='BCTC')
+        self.sleeps = []
+
+    def watch(self, polls):
+        return list(watch_next_time('1538969940000', ROUTE_RECORDS[2], DIR_RECORDS[1], STOP_RECORDS[2], self.time_url_template,
+                                    10, polls=polls, sleep=self.sleeps.append))
+
+    def test_watch_only_yields_changes(self):
+        pook.get(self.time_url, reply=200, response_json=TIMES_ACTUAL, times=2)
+        pook.get(self.time_url, reply=200, response_json=TIMES_NONACTUAL, times=1)
+
+        self.watch(3) | should.equal(['16 Min', '22 Min'])
+        len(self.sleeps) | should.equal(2)
+
+    def test_watch_keeps_polling_through_errors(self):
+        pook.get(self.time_url, reply=404, times=1)
+        pook.get(self.time_url, reply=200, response_json=TIMES_ACTUAL, times=1)
+
+        self.watch(2) | should.equal(['16 Min'])
+
+    def test_watch_yields_departures_when_detailed(self):
+        pook.get(self.time_url, reply=200, response_json=TIMES_ACTUAL, times=1)
+
+        (next_time, times, stale), = watch_next_time('1538969940000', ROUTE_RECORDS[2], DIR_RECORDS[1],
+                                                     STOP_RECORDS[2], self.time_url_template, 10, polls=1,
+                                                     sleep=self.sleeps.append, detailed=True)
+        (next_time, stale) | should.equal(('16 Min', None))
+        times | should.equal([Departure.from_json(TIMES_ACTUAL[0])])
+
+    def test_watch_delay_grows_with_time_to_departure(self):
+        times = [Departure.from_json(t) for t in TIMES_NONACTUAL]
+        watch_delay(times, '1538971200000', 10) | should.equal(10)
+        watch_delay(times, '1538970360000', 10) | should.equal(30)
+        watch_delay(times, '1538900000000', 10) | should.equal(40)
+        watch_delay([], None, 10) | should.equal(10)
+
+
+class TestWithinBudget(unittest.TestCase):
+
+    def test_within_budget_returns_result(self):
+        within_budget(1, lambda x: x * 2, 21) | should.equal(42)
+
+    def test_within_budget_without_budget_waits(self):
+        within_budget(None, lambda: '16 Min') | should.equal('16 Min')
+
+    def test_within_budget_gives_up_on_slow_calls(self):
+        within_budget(0.05, time.sleep, 1) | should.be.none
+
+
+class TestTracing(unittest.TestCase):
+
+    def setUp(self):
+        self.host = 'http://trace.fake'
+        self.events = []
+        add_trace_hook(self.events.append)
+        use_session(PooledSession(retries=1, backoff=0))
+
+    def tearDown(self):
+        remove_trace_hook(self.events.append)
+        use_session(None)
+        use_cache(None)
+
+    @pook.on
+    def test_trace_reports_each_stage(self):
+        pook.get(self.host+ROUTE_PATH, reply=200, response_json=ROUTES, times=1)
+        lookup_route('Brklyn Center', self.host+ROUTE_PATH)
+
+        [(event['stage'], event['name']) for event in self.events] | should.equal(
+            [('make_request', 'Route'), ('fetch_first', 'Route')])
+        self.events[0] | should.have.keys('seconds', 'bytes', 'status', 'decode_seconds', 'url', 'time')
+        self.events[0]['bytes'] | should.be.above(0)
+        self.events[1] | should.have.key('match_seconds')
+
+    @pook.on
+    def test_trace_reports_cache_hits(self):
+        use_cache(MetadataCache(':memory:'))
+        pook.get(self.host+ROUTE_PATH, reply=200, response_json=ROUTES, times=1)
+        lookup_route('Brklyn Center', self.host+ROUTE_PATH)
+        lookup_route('Brklyn Center', self.host+ROUTE_PATH)
+
+        [event.get('cache') for event in self.events if event['stage'] == 'make_request'] | should.equal(
+            ['miss', 'hit'])
+
+    @pook.on
+    def test_trace_reports_retries(self):
+        pook.get(self.host+TIME_PATH.format(route='5', direction='1', stop='BCTC'), reply=503, times=1)
+        pook.get(self.host+TIME_PATH.format(route='5', direction='1', stop='BCTC'),
+                 reply=200, response_json=TIMES_ACTUAL, times=1)
+        lookup_next_time(None, ROUTE_RECORDS[2], DIR_RECORDS[1], STOP_RECORDS[2], self.host+TIME_PATH)
+
+        [event['stage'] for event in self.events] | should.equal(['make_request', 'lookup_next_time'])
+        self.events[0]['retries'] | should.equal(1)
+
 
 # Simple helper method tests below
 
@@ -235,6 +1073,15 @@ def test_compute_time_to_depature_with_provided_datetime():
     next_time = compute_time_to_departure("\\/Date(1538971260000-0500)\\/", '1538969940000')
     next_time | should.equal("22 Min")
 
+def test_compute_times_to_departure_converts_every_time():
+    next_times = compute_times_to_departure(["\\/Date(1538971260000-0500)\\/",
+                                             "\\/Date(1538973840000+0000)\\/"], '1538969940000')
+    next_times | should.equal(["22 Min", "65 Min"])
+
+def test_compute_time_to_depature_rounds_down():
+    next_time = compute_time_to_departure("\\/Date(1538969999999-0500)\\/", '1538969940000')
+    next_time | should.equal("0 Min")
+
 def test_compute_time_to_depature_without_provided_datetime():
     # This test could be flakey if we are right on the minute boundary
     # when getting time in setup...